@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+######################################################
+## Headless batch rendering of ROMS fields to PNG
+## frames or MP4 animations, no wx needed
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from lib import RomsGrid, TimeAxis, hslice, parse_level
+from render import LodMesh
+from ncio import RomsDataset, open_dataset, time_dimension
+from derived import add_derived
+
+
+class FrameRenderer(object):
+    """
+    Renders horizontal slices of one variable to image files with the
+    Agg backend, through the same slicing (lib.hslice) and LodMesh code
+    as the GUI. The files, grid and figure are opened once and reused for
+    every frame: only the QuadMesh data and the title change.
+    Usage: renderer = FrameRenderer(files, 'grd.nc', 'temp', level=-100.)
+           renderer.render(tindex, 'temp_0000.png')
+    """
+    def __init__(self, files, grdname, varname, level='surface', vmin=None,
+                 vmax=None, cmap='jet', figsize=(12, 8), dpi=100):
+        self.ncfile = open_dataset(files)
+        self.grd = RomsDataset(grdname)
+        self.grid = RomsGrid(self.grd, self.ncfile)
+        add_derived(self.ncfile, self.grid)
+        self.varname, self.level, self.dpi = varname, level, dpi
+        self.var = self.ncfile.variables[varname]
+        self.time_axis = TimeAxis(self.ncfile.variables[time_dimension(self.ncfile)])
+
+        # the mesh detail level follows the size of the axes in output pixels
+        self.fig = Figure(facecolor='w', figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        gridtype = self.var.dimensions[-1].split('_')[-1]
+        lon, lat = self.grid.lon(gridtype), self.grid.lat(gridtype)
+        self.ax.set_xlim([lon.min(), lon.max()])
+        self.ax.set_ylim([lat.min(), lat.max()])
+        self.ax.set_aspect('equal')
+        kwargs = dict(cmap=cmap)
+        if vmin is not None and vmax is not None:
+            kwargs.update(vmin=vmin, vmax=vmax)
+        self.mesh = LodMesh(self.ax, **kwargs)
+        self.mesh.set_grid(lon, lat)
+        self.colorbar = None
+
+    def title(self, tindex):
+        title = "%s   %s" % (self.varname, self.time_axis.labels[tindex])
+        if len(self.var.dimensions) == 4 and self.level != 'surface':
+            title = "%s @ %s   %s" % (self.varname, self.level,
+                                      self.time_axis.labels[tindex])
+        return title
+
+    def render(self, tindex, filename):
+        field = hslice(self.var, self.grid, tindex, self.level)
+        self.mesh.set_data(field)
+        if self.colorbar is None:
+            self.colorbar = self.fig.colorbar(self.mesh.artist, ax=self.ax,
+                                              shrink=0.8)
+        else:
+            self.colorbar.update_normal(self.mesh.artist)
+        self.ax.set_title(self.title(tindex))
+        self.fig.savefig(filename, dpi=self.dpi)
+        return filename
+
+    def close(self):
+        self.ncfile.close()
+        self.grd.close()
+
+
+# every pool process keeps its own renderer (and netcdf handles)
+_renderer = None
+
+
+def _init_worker(args, kwargs):
+    global _renderer
+    _renderer = FrameRenderer(*args, **kwargs)
+
+
+def _render_frame(task):
+    tindex, filename = task
+    return tindex, _renderer.render(tindex, filename)
+
+
+def parse_records(spec, ntimes):
+    """
+    Time records from 'all', 'start:stop[:step]' (python slice) or a
+    comma separated list of indexes (negative ones count from the end).
+    An empty selection or an index out of range is a ValueError.
+    """
+    spec = spec.strip()
+    if spec == 'all':
+        records = list(range(ntimes))
+    elif ':' in spec:
+        parts = [int(p) if p else None for p in spec.split(':')]
+        records = list(range(ntimes))[slice(*parts)]
+    else:
+        records = [int(p) for p in spec.split(',')]
+        for record in records:
+            if not -ntimes <= record < ntimes:
+                raise ValueError("Record %d out of range (%d records)" % (record, ntimes))
+        records = [record % ntimes for record in records]
+    if not records:
+        raise ValueError("No records selected by %r (%d records)" % (spec, ntimes))
+    return records
+
+
+def color_limits(files, grdname, varname, records, level):
+    """Colour limits shared by all frames, from the first, middle and last records"""
+    renderer = FrameRenderer(files, grdname, varname, level)
+    try:
+        samples = sorted(set([records[0], records[len(records) // 2], records[-1]]))
+        fields = np.array([hslice(renderer.var, renderer.grid, t, level) for t in samples])
+        return float(np.nanmin(fields)), float(np.nanmax(fields))
+    finally:
+        renderer.close()
+
+
+def render_frames(files, grdname, varname, records, outdir, level='surface',
+                  workers=None, prefix=None, verbose=True, **kwargs):
+    """
+    Renders varname at the given time records to PNG frames in outdir,
+    numbered in sequence (prefix_00000.png, ...). The records are split
+    in contiguous runs across a pool of worker processes, each with its
+    own open files, grid geometry and figure, so a long animation scales
+    with the number of cores. Colour limits are fixed for all frames:
+    vmin/vmax in kwargs, or estimated from a few records.
+    Returns the list of frame filenames, in record order.
+    """
+    if not len(records):
+        raise ValueError("No records to render")
+    workers = workers or multiprocessing.cpu_count()
+    prefix = prefix or varname
+    if kwargs.get('vmin') is None or kwargs.get('vmax') is None:
+        kwargs['vmin'], kwargs['vmax'] = color_limits(files, grdname, varname,
+                                                      records, level)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = [(tindex, os.path.join(outdir, "%s_%05d.png" % (prefix, n)))
+             for n, tindex in enumerate(records)]
+    initargs = ((files, grdname, varname, level), kwargs)
+
+    start = time.time()
+    if workers == 1:
+        _init_worker(*initargs)
+        results = [_render_frame(task) for task in tasks]
+        _renderer.close()
+    else:
+        # contiguous runs of records per process: reads stay sequential
+        # and each process reuses its cached zeta/z fields
+        chunksize = max(1, len(tasks) // (4 * workers))
+        pool = multiprocessing.Pool(workers, _init_worker, initargs)
+        try:
+            results = []
+            for result in pool.imap(_render_frame, tasks, chunksize):
+                results.append(result)
+                if verbose and len(results) % 10 == 0:
+                    log("%d/%d frames" % (len(results), len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    if verbose:
+        log("%d frames in %.1f s (%.2f frames/s, %d workers)"
+            % (len(tasks), elapsed, len(tasks) / max(elapsed, 1e-9), workers))
+    return [filename for tindex, filename in results]
+
+
+def encode_movie(frames, output, fps=10):
+    """Encodes a sequence of numbered PNG frames to MP4 with ffmpeg"""
+    pattern = os.path.join(os.path.dirname(frames[0]),
+                           os.path.basename(frames[0])[:-len('00000.png')] + '%05d.png')
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+               '-i', pattern, '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+               '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', output]
+    try:
+        subprocess.check_call(command)
+    except OSError:
+        raise RuntimeError("ffmpeg is needed to write %s" % output)
+    return output
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render ROMS fields to PNG "
+                                     "frames or an MP4 animation, without a display")
+    parser.add_argument('files', nargs='+',
+                        help="ROMS history file(s), a glob pattern or a directory")
+    parser.add_argument('-g', '--grid', required=True, help="ROMS grid file")
+    parser.add_argument('-v', '--var', required=True, help="variable name")
+    parser.add_argument('-t', '--times', default='all',
+                        help="records: all, start:stop[:step] or i,j,k [all]")
+    parser.add_argument('-l', '--level', default='surface',
+                        help="surface, bottom or a depth in m [surface]")
+    parser.add_argument('-o', '--output', default='frames',
+                        help="directory for PNG frames, or a .mp4 file [frames]")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes [number of cores]")
+    parser.add_argument('--vmin', type=float, default=None)
+    parser.add_argument('--vmax', type=float, default=None)
+    parser.add_argument('--cmap', default='jet')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--fps', type=int, default=10)
+    opts = parser.parse_args(argv)
+
+    files = opts.files[0] if len(opts.files) == 1 else opts.files
+    level = parse_level(opts.level)
+
+    ncfile, grd = open_dataset(files), RomsDataset(opts.grid)
+    try:
+        add_derived(ncfile, RomsGrid(grd, ncfile))
+        ntimes = ncfile.variables[opts.var].shape[0]
+    finally:
+        ncfile.close()
+        grd.close()
+    try:
+        records = parse_records(opts.times, ntimes)
+    except ValueError as err:
+        parser.error(str(err))
+
+    with_movie = opts.output.lower().endswith('.mp4')
+    outdir = tempfile.mkdtemp(prefix='pyromsgui_') if with_movie else opts.output
+
+    try:
+        frames = render_frames(files, opts.grid, opts.var, records, outdir,
+                               level=level, workers=opts.workers, vmin=opts.vmin,
+                               vmax=opts.vmax, cmap=opts.cmap, dpi=opts.dpi)
+        if with_movie:
+            encode_movie(frames, opts.output, opts.fps)
+            log("wrote %s" % opts.output)
+    finally:
+        if with_movie:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: headless batch rendering, frames/s
+## against the number of worker processes
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from batch import render_frames
+from synthetic import make_history
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench_his.nc')
+    nframes = 48
+    make_history(filename, L=500, M=400, N=10, ntimes=nframes)
+    records = list(range(nframes))
+
+    print("%d frames of a 400 x 500 grid, %d cores" % (nframes, multiprocessing.cpu_count()))
+    workers, base = 1, None
+    while workers <= multiprocessing.cpu_count():
+        outdir = os.path.join(tmpdir, 'frames_%d' % workers)
+        t0 = time.time()
+        render_frames(filename, filename, 'temp', records, outdir, level='surface',
+                      workers=workers, vmin=-10, vmax=30, verbose=False)
+        elapsed = time.time() - t0
+        base = base or elapsed
+        print("%2d workers: %7.2f s  %6.2f frames/s  speedup %.2f"
+              % (workers, elapsed, nframes / elapsed, base / elapsed))
+        workers *= 2
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: redraw time of a dense coastline plotted
+## vertex by vertex vs the clipped, simplified
+## CoastlineLayer
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.io as sp
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from coastline import Coastline, CoastlineLayer
+
+
+def synthetic_coastline(npolygons=2000, nvertices=1000, seed=0):
+    """Jagged closed polylines all over the globe, separated by NaN like Seagrid files"""
+    rng = np.random.RandomState(seed)
+    lon, lat = [], []
+    theta = np.linspace(0, 2 * np.pi, nvertices)
+    for ind in range(npolygons):
+        x0, y0 = rng.uniform(-180, 180), rng.uniform(-80, 80)
+        radius = rng.uniform(0.2, 3) * (1 + 0.1 * np.cumsum(rng.randn(nvertices)) / np.sqrt(nvertices))
+        radius[-1] = radius[0]
+        lon.extend(x0 + radius * np.cos(theta))
+        lat.extend(y0 + radius * np.sin(theta))
+        lon.append(np.nan)
+        lat.append(np.nan)
+    return np.array(lon), np.array(lat)
+
+
+def redraw_time(canvas, repeat=3):
+    canvas.draw()
+    t0 = time.time()
+    for ind in range(repeat):
+        canvas.draw()
+    return (time.time() - t0) / repeat
+
+
+def figure():
+    fig = Figure(figsize=(10, 8))
+    canvas = FigureCanvasAgg(fig)
+    return fig.add_subplot(111), canvas
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'coast.mat')
+    lon, lat = synthetic_coastline()
+    sp.savemat(filename, dict(lon=lon[:, None], lat=lat[:, None]))
+    print("%d coastline vertices" % np.isfinite(lon).sum())
+
+    # a regional grid, and the whole globe without clipping
+    for label, bbox, view in [('regional', (-60., -30., -40., -10.), (-60., -30., -40., -10.)),
+                              ('global', None, (-180., 180., -90., 90.))]:
+        ax, canvas = figure()
+        t0 = time.time()
+        coast = sp.loadmat(filename)
+        ax.plot(coast['lon'], coast['lat'], 'k')
+        ax.set_xlim(view[:2])
+        ax.set_ylim(view[2:])
+        tload = time.time() - t0
+        tplot = redraw_time(canvas)
+
+        t0 = time.time()
+        coast = Coastline.load(filename, bbox, cachedir=tmpdir)
+        tbuild = time.time() - t0
+        t0 = time.time()
+        coast = Coastline.load(filename, bbox, cachedir=tmpdir)
+        tcached = time.time() - t0
+        ax, canvas = figure()
+        ax.set_xlim(view[:2])
+        ax.set_ylim(view[2:])
+        layer = CoastlineLayer(ax, coast)
+        tlayer = redraw_time(canvas)
+
+        print("%s view %s" % (label, view))
+        print("  ax.plot        : load %6.3f s                     redraw %7.3f s   %7.2f MB"
+              % (tload, tplot, lon.nbytes * 2 / 2.**20))
+        print("  CoastlineLayer : build %6.3f s (cached %6.3f s)   redraw %7.3f s   %7.2f MB"
+              % (tbuild, tcached, tlayer, coast.nbytes / 2.**20))
+        print("  %r, level %d drawn (%d vertices), redraw speedup %.1fx"
+              % (coast, layer.level, len(coast.levels[layer.level][0]), tplot / tlayer))
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: derived variables computed on whole
+## variables vs evaluated on the shown slice through
+## the slice cache
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import RomsGrid, hslice
+from ncio import RomsDataset
+from cache import SliceCache
+from derived import add_derived
+from synthetic import make_grid, make_history
+
+
+def timed(func):
+    t0 = time.time()
+    out = func()
+    return time.time() - t0, out
+
+
+if __name__ == '__main__':
+    # grid size: L M N, 600 x 450 x 20 by default
+    L, M, N = [int(arg) for arg in sys.argv[1:4]] if len(sys.argv) > 3 else (600, 450, 20)
+    workdir = tempfile.mkdtemp(prefix='pyromsgui_bench_')
+    try:
+        grdname = make_grid(os.path.join(workdir, 'grd.nc'), L, M)
+        hisname = make_history(os.path.join(workdir, 'his.nc'), L, M, N, ntimes=2,
+                               land=True, velocities=True)
+        ncfile = RomsDataset(hisname)
+        grid = RomsGrid(RomsDataset(grdname), ncfile)
+        grid.metrics()
+        cache = SliceCache()
+        add_derived(ncfile, grid, cache)
+        u, v = ncfile.variables['u'], ncfile.variables['v']
+
+        def whole():
+            # what a variable computed up front costs: every level of the record
+            ur, vr = np.asarray(u[0]), np.asarray(v[0])
+            ur = np.concatenate([ur[..., :1], 0.5 * (ur[..., :-1] + ur[..., 1:]), ur[..., -1:]], -1)
+            vr = np.concatenate([vr[:, :1], 0.5 * (vr[:, :-1] + vr[:, 1:]), vr[:, -1:]], 1)
+            return np.hypot(ur, vr)[-1]
+
+        twhole, ref = timed(whole)
+        tspeed, speed = timed(lambda: hslice(ncfile.variables['speed'], grid, 0, 'surface'))
+        tagain, _ = timed(lambda: hslice(ncfile.variables['speed'], grid, 0, 'surface'))
+        tvort, _ = timed(lambda: hslice(ncfile.variables['vorticity'], grid, 0, 'surface'))
+        tzoom, _ = timed(lambda: ncfile.variables['vorticity'][1, -1, M // 3:M // 2, L // 3:L // 2])
+        entries = len(cache)
+        tdepth, _ = timed(lambda: hslice(ncfile.variables['speed'], grid, 1, -50.))
+        entries = len(cache) - entries
+
+        same = np.allclose(ref[1:-1, 1:-1], speed[1:-1, 1:-1], equal_nan=True)
+        print("grid %d x %d x %d" % (M, L, N))
+        print("speed of the whole record : %7.3f s" % twhole)
+        print("speed, surface slice      : %7.3f s  (same values: %s)" % (tspeed, same))
+        print("speed again (cached)      : %7.3f s" % tagain)
+        print("vorticity, shares u and v : %7.3f s" % tvort)
+        print("vorticity, zoomed window  : %7.3f s" % tzoom)
+        print("speed at -50 m            : %7.3f s  (%d cache entries)" % (tdepth, entries))
+        print("speedup %.0fx" % (twhole / tspeed))
+        print(cache)
+        ncfile.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
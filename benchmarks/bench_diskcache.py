@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: reads from compressed netcdf vs the
+## local memmapped disk cache of decompressed planes
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from diskcache import DiskCache
+from ncio import RomsDataset
+from synthetic import make_history
+
+
+def read_all(ncfile, ntimes, M, L):
+    """Surface maps and a vertical column strip of every record"""
+    temp = ncfile.variables['temp']
+    for t in range(ntimes):
+        temp[t, -1, ...]
+        temp[t, :, M // 2, L // 4:3 * L // 4]
+
+
+def timed(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench_his.nc')
+    L, M, N, ntimes = 800, 600, 10, 12
+    make_history(filename, L=L, M=M, N=N, ntimes=ntimes)
+    disk = DiskCache(os.path.join(tmpdir, 'cache'))
+
+    # a new dataset each time: a reopened run, nothing in memory
+    tnc = timed(read_all, RomsDataset(filename), ntimes, M, L)
+    tfill = timed(read_all, RomsDataset(filename, disk_cache=disk), ntimes, M, L)
+    thit = timed(read_all, RomsDataset(filename, disk_cache=disk), ntimes, M, L)
+    print("%d records of %d x %d x %d, zlib" % (ntimes, N, M, L))
+    print("netcdf                 : %7.3f s" % tnc)
+    print("disk cache, first pass : %7.3f s (decompress + write)" % tfill)
+    print("disk cache, reopened   : %7.3f s  speedup %.1fx" % (thit, tnc / thit))
+    print(disk)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: peak memory and time of reading a 3D
+## field with netCDF4 masked arrays vs the float32/NaN
+## reads of LazyVariable
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ncio import RomsDataset
+from synthetic import make_history
+
+
+def masked_read(var, t):
+    """The former path: masked array from netCDF4, then NaN filled"""
+    field = np.ma.filled(np.ma.asarray(var[t], dtype=np.float32), np.nan)
+    field[np.abs(field) > 1e20] = np.nan
+    return field
+
+
+def nan_read(var, t):
+    return var[t]
+
+
+def measure(func, var, ntimes, repeat=3):
+    """Best seconds per record, and peak traced bytes"""
+    best = float('inf')
+    for ind in range(repeat):
+        t0 = time.time()
+        for t in range(ntimes):
+            func(var, t)
+        best = min(best, (time.time() - t0) / ntimes)
+    tracemalloc.start()
+    func(var, 0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench_his.nc')
+    L, M, N, ntimes = 600, 400, 20, 4
+    make_history(filename, L=L, M=M, N=N, ntimes=ntimes, land=True)
+    field_bytes = N * M * L * 4.
+
+    old = measure(masked_read, nc.Dataset(filename).variables['temp'], ntimes)
+    new = measure(nan_read, RomsDataset(filename).variables['temp'], ntimes)
+    print("temp[t] of %d x %d x %d float32 (%.0f MB), land as fill values"
+          % (N, M, L, field_bytes / 2**20))
+    for label, (seconds, peak) in [('masked arrays', old), ('float32 + NaN', new)]:
+        print("%-14s: %7.3f s/record   peak %6.0f MB (%.1fx the field)"
+              % (label, seconds, peak / 2.**20, peak / field_bytes))
+    print("speedup %.1fx, peak memory %.1fx lower" % (old[0] / new[0], old[1] / float(new[1])))
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: opening a domain with and without the
+## persistent grid cache - grid fields, LOD mesh
+## levels, KD-tree, metrics and z at rest
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import netCDF4 as nc
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import RomsGrid
+from ncio import RomsDataset
+from render import LodMesh, pyramid_coords
+from gridcache import GridCache
+from synthetic import make_grid
+
+
+def make_vertical(filename, N=30):
+    """A file with only the vertical coordinate parameters of a history file"""
+    ncfile = nc.Dataset(filename, 'w')
+    ncfile.createDimension('s_rho', N)
+    ncfile.createDimension('s_w', N + 1)
+    sc = ( np.arange(1, N + 1) - N - 0.5 ) / N
+    sw = ( np.arange(N + 1) - N ) / float(N)
+    for name, value in [('theta_s', 7.), ('theta_b', 0.1), ('hc', 50.), ('Vtransform', 2)]:
+        ncfile.createVariable(name, 'f8', ())[:] = value
+    ncfile.createVariable('s_rho', 'f8', ('s_rho',))[:] = sc
+    ncfile.createVariable('Cs_r', 'f8', ('s_rho',))[:] = sc ** 3
+    ncfile.createVariable('s_w', 'f8', ('s_w',))[:] = sw
+    ncfile.createVariable('Cs_w', 'f8', ('s_w',))[:] = sw ** 3
+    ncfile.close()
+    return filename
+
+
+def open_domain(grdname, hisname, cache):
+    """What the viewer does with a grid: returns the time of each step"""
+    times = []
+    def step(name, func):
+        t0 = time.time()
+        out = func()
+        times.append( (name, time.time() - t0) )
+        return out
+
+    grid = step('open', lambda: RomsGrid(RomsDataset(grdname), RomsDataset(hisname),
+                                         cache=cache))
+    lon, lat, h = step('grid fields', lambda: (grid.lonr, grid.latr, grid.h))
+    fig = Figure(figsize=(10, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_xlim(lon.min(), lon.max())
+    ax.set_ylim(lat.min(), lat.max())
+    mesh = LodMesh(ax)
+    coords = step('lod levels', lambda: grid.cached('lod_rho', lambda: pyramid_coords(lon, lat),
+                                                   many=True))
+    step('first map', lambda: (mesh.set_grid(lon, lat, coords), mesh.set_data(h),
+                               fig.canvas.draw()))
+    step('kd-tree', lambda: grid.index('rho'))
+    step('metrics', lambda: (grid.metrics(), grid.spacing('rho')))
+    step('z at rest', lambda: (grid.z_rest(), grid.z_rest(w=True)))
+    return times
+
+
+if __name__ == '__main__':
+    # grid size: L M N, 1500 x 1000 x 30 by default
+    L, M, N = [int(arg) for arg in sys.argv[1:4]] if len(sys.argv) > 3 else (1500, 1000, 30)
+    workdir = tempfile.mkdtemp(prefix='pyromsgui_bench_')
+    try:
+        grdname = make_grid(os.path.join(workdir, 'grd.nc'), L, M)
+        hisname = make_vertical(os.path.join(workdir, 'vertical.nc'), N)
+        directory = os.path.join(workdir, 'grids')
+        runs = [('no cache', open_domain(grdname, hisname, None)),
+                ('first open', open_domain(grdname, hisname, GridCache(directory)))]
+        cache = GridCache(directory) # a new session
+        runs.append( ('reopened', open_domain(grdname, hisname, cache)) )
+
+        print("grid %d x %d x %d" % (M, L, N))
+        print("%-12s" % "" + "".join("%12s" % name for name, t in runs[0][1]) + "%12s" % "total")
+        for label, times in runs:
+            print("%-12s" % label + "".join("%12.3f" % t for name, t in times) +
+                  "%12.3f" % sum(t for name, t in times))
+        print(cache)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
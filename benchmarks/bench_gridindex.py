@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: lib.GridIndex vs brute-force lib.near2d
+## for the nearest grid point lookups done by vslice
+######################################################
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import near2d, GridIndex
+
+
+def curvilinear_grid(L, M, angle=20.):
+    """Rotated and slightly stretched lon/lat grid of shape (M, L)"""
+    xi, eta = np.meshgrid(np.linspace(0, 10, L), np.linspace(0, 8, M))
+    eta = eta + 0.3 * np.sin(xi / 2.)
+    rad = np.deg2rad(angle)
+    lon = -50 + xi * np.cos(rad) - eta * np.sin(rad)
+    lat = -30 + xi * np.sin(rad) + eta * np.cos(rad)
+    return lon, lat
+
+
+def run(L, M, npoints, brute_max=200):
+    lon, lat = curvilinear_grid(L, M)
+    xs = np.linspace(lon.min() + 1, lon.max() - 1, npoints)
+    ys = np.linspace(lat.min() + 1, lat.max() - 1, npoints)
+
+    t0 = time.time()
+    index = GridIndex(lon, lat)
+    tbuild = time.time() - t0
+
+    t0 = time.time()
+    lines, cols = index.query(xs, ys)
+    tquery = time.time() - t0
+
+    # brute force is timed on a subset and extrapolated for big sections
+    nbrute = min(npoints, brute_max)
+    t0 = time.time()
+    mismatch = 0
+    for ind in range(nbrute):
+        line, col = near2d(lon, lat, xs[ind], ys[ind])
+        mismatch += (line, col) != (lines[ind], cols[ind])
+    tbrute = (time.time() - t0) * npoints / float(nbrute)
+
+    print("grid %5d x %-5d points %6d | near2d %9.3f s | "
+          "GridIndex build %7.3f s query %7.4f s | speedup %8.1fx | "
+          "mismatches %d/%d" % (M, L, npoints, tbrute, tbuild, tquery,
+                                tbrute / (tbuild + tquery), mismatch, nbrute))
+
+
+if __name__ == '__main__':
+    for L, M in [(200, 150), (1000, 750), (2000, 1500)]:
+        for npoints in [100, 1000]:
+            run(L, M, npoints)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: opening a multi-file run of diagnostics-
+## like files (hundreds of variables each), with the
+## metadata scanned vs served from the cache
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import metadata
+from ncio import RomsDataset
+from metadata import FileMetadata, scan_dataset
+
+
+def make_diagnostics(filename, nvars, L=60, M=40, N=10):
+    """A ROMS diagnostics-like file with nvars compressed 4D terms"""
+    ncfile = nc.Dataset(filename, 'w')
+    ncfile.type = 'ROMS/TOMS diagnostics file'
+    for name, size in [('ocean_time', None), ('s_rho', N), ('eta_rho', M), ('xi_rho', L)]:
+        ncfile.createDimension(name, size)
+    time_var = ncfile.createVariable('ocean_time', 'f8', ('ocean_time',))
+    time_var.units = 'seconds since 2000-01-01 00:00:00'
+    time_var[:] = [0.]
+    dims = ('ocean_time', 's_rho', 'eta_rho', 'xi_rho')
+    for n in range(nvars):
+        var = ncfile.createVariable('term_%03d' % n, 'f4', dims, zlib=True,
+                                    chunksizes=(1, 1, M, L), fill_value=1e37)
+        var.long_name = 'momentum/tracer balance term %d' % n
+        var.units = 'meter second-2'
+        var.time = 'ocean_time'
+        var.field = 'term_%03d, scalar, series' % n
+    ncfile.close()
+    return filename
+
+
+def open_all(paths):
+    t0 = time.time()
+    for path in paths:
+        RomsDataset(path).close()
+    return time.time() - t0
+
+
+if __name__ == '__main__':
+    # number of files and variables per file: 30 300 by default
+    nfiles, nvars = [int(arg) for arg in sys.argv[1:3]] if len(sys.argv) > 2 else (30, 300)
+    workdir = tempfile.mkdtemp(prefix='pyromsgui_bench_')
+    metadata.CACHE_DIR = workdir # the cache of the user is left alone
+    try:
+        template = make_diagnostics(os.path.join(workdir, 'dia_000.nc'), nvars)
+        paths = [template]
+        for n in range(1, nfiles):
+            paths.append(os.path.join(workdir, 'dia_%03d.nc' % n))
+            shutil.copy(template, paths[-1])
+
+        # netCDF4 alone, and the crawl of chunking, filters and attributes
+        t0 = time.time()
+        for path in paths:
+            nc.Dataset(path).close()
+        topen = time.time() - t0
+        t0 = time.time()
+        for path in paths:
+            dataset = nc.Dataset(path)
+            scan_dataset(dataset)
+            dataset.close()
+        tcrawl = time.time() - t0 - topen
+
+        tcold = open_all(paths)
+        twarm = open_all(paths)
+        meta = FileMetadata.load(template)
+
+        print("%d files x %d variables (%s)" % (nfiles, nvars, meta))
+        print("netCDF4 open only          : %7.3f s" % topen)
+        print("metadata crawl             : %7.3f s" % tcrawl)
+        print("RomsDataset, cold cache    : %7.3f s" % tcold)
+        print("RomsDataset, cached        : %7.3f s" % twarm)
+        print("crawl saved per reopen     : %7.3f s" % (tcold - twarm))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
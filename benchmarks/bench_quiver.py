@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: drawing every velocity vector of a big
+## grid vs the thinned QuiverLayer
+######################################################
+import os
+import sys
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import rho_vectors
+from render import QuiverLayer
+from bench_gridindex import curvilinear_grid
+
+
+def figure(lon, lat):
+    fig = Figure(figsize=(10, 8))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_xlim(lon.min(), lon.max())
+    ax.set_ylim(lat.min(), lat.max())
+    return ax, canvas
+
+
+if __name__ == '__main__':
+    # grid size: L M, 2000 x 1500 by default
+    L, M = [int(arg) for arg in sys.argv[1:3]] if len(sys.argv) > 2 else (2000, 1500)
+    lon, lat = curvilinear_grid(L, M)
+    u = np.cos(lat[:, 1:] / 2.).astype(np.float32)
+    v = np.sin(lon[1:] / 3.).astype(np.float32)
+    angle = np.full(lon.shape, 0.3, dtype=np.float32)
+
+    t0 = time.time()
+    ue, vn = rho_vectors(u, v, (np.cos(angle), np.sin(angle)))
+    tavg = time.time() - t0
+
+    ax, canvas = figure(lon, lat)
+    t0 = time.time()
+    ax.quiver(lon, lat, ue, vn)
+    canvas.draw()
+    tall = time.time() - t0
+
+    ax, canvas = figure(lon, lat)
+    layer = QuiverLayer(ax)
+    layer.set_grid(lon, lat)
+    t0 = time.time()
+    layer.set_data(ue, vn)
+    canvas.draw()
+    tlayer = time.time() - t0
+    t0 = time.time()
+    layer.set_data(ue * 1.1, vn * 1.1) # next record: only the components change
+    canvas.draw()
+    tnext = time.time() - t0
+    t0 = time.time()
+    ax.set_xlim(lon.mean() - 1, lon.mean() + 1) # zoom in: new window and thinning
+    ax.set_ylim(lat.mean() - 1, lat.mean() + 1)
+    canvas.draw()
+    tzoom = time.time() - t0
+
+    print("grid %d x %d" % (M, L))
+    print("u/v to rho + rotation : %7.3f s" % tavg)
+    print("every vector          : %7.3f s  (%d arrows)" % (tall, ue.size))
+    print("QuiverLayer           : %7.3f s  (%d arrows), next record %.3f s, zoom %.3f s"
+          % (tlayer, layer.artist.N, tnext, tzoom))
+    print("speedup %.0fx" % (tall / tlayer))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: streamed time statistics, records/s
+## against the number of worker processes
+######################################################
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from stats import field_stats
+from synthetic import make_history
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench_his.nc')
+    ntimes = 96
+    make_history(filename, L=500, M=400, N=10, ntimes=ntimes)
+
+    print("%d records of a 400 x 500 grid, %d cores" % (ntimes, multiprocessing.cpu_count()))
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        for percentiles in [(), (10, 90)]:
+            report = {}
+            out = field_stats(filename, 'temp', workers=workers,
+                              percentiles=percentiles, max_bytes=8 * 2**20,
+                              report=report)
+            print("%2d workers%-18s: %7.2f s  %8.1f records/s"
+                  % (workers, ' + percentiles' if percentiles else '',
+                     report['seconds'], report['records_per_second']))
+        workers *= 2
+    shutil.rmtree(tmpdir)
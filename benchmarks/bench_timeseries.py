@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: point time series and Hovmoller reads,
+## one read per record vs bulk strided reads
+######################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import point_series, transect_series
+from ncio import RomsDataset
+from synthetic import make_history
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench_his.nc')
+    ntimes = 720
+    make_history(filename, L=200, M=150, N=10, ntimes=ntimes)
+    ncfile = RomsDataset(filename)
+    temp = ncfile.variables['temp']
+    j, i = 75, 100
+
+    t0 = time.time()
+    ref = np.array([temp[t, -1, j, i] for t in range(ntimes)])
+    tloop = time.time() - t0
+    t0 = time.time()
+    ts = point_series(temp, j, i, k=-1)
+    tbulk = time.time() - t0
+    assert np.allclose(ref, ts)
+    print("%d records, point series : per record %6.2f s   bulk %6.2f s"
+          % (ntimes, tloop, tbulk))
+
+    lines = np.arange(20, 130)
+    cols = np.linspace(10, 190, lines.size).astype(int)
+    t0 = time.time()
+    ref = np.array([[temp[t, -1, l, c] for l, c in zip(lines, cols)]
+                    for t in range(0, ntimes, 24)])
+    tloop = (time.time() - t0) * 24
+    t0 = time.time()
+    hov = transect_series(temp, lines, cols, k=-1)
+    tbulk = time.time() - t0
+    assert np.allclose(ref, hov[::24])
+    print("%d records, %d point Hovmoller : per point (estimated) %6.1f s   bulk %6.2f s"
+          % (ntimes, lines.size, tloop, tbulk))
+    ncfile.close()
+    shutil.rmtree(tmpdir)
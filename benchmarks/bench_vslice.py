@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: vertical section extraction, one netcdf
+## read per transect point vs lib.extract_points
+######################################################
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import GridIndex, extract_points
+from synthetic import make_history
+
+
+class CountingVariable(object):
+    """Wraps a netcdf variable and counts the reads issued on it"""
+    def __init__(self, var, counter):
+        self.var, self.counter = var, counter
+        self.shape, self.dtype = var.shape, var.dtype
+
+    def __getitem__(self, index):
+        self.counter[0] += 1
+        return self.var[index]
+
+
+def per_point(ncfile, lines, cols, tindex, counter):
+    var = CountingVariable(ncfile.variables['temp'], counter)
+    h = CountingVariable(ncfile.variables['h'], counter)
+    zeta = CountingVariable(ncfile.variables['zeta'], counter)
+    vsec, hsec, zsec = [], [], []
+    for line, col in zip(lines, cols):
+        vsec.append( var[tindex, :, line, col] )
+        hsec.append( h[line, col] )
+        zsec.append( zeta[tindex, line, col] )
+    return np.array(vsec).transpose()
+
+
+def bulk(ncfile, lines, cols, tindex, counter):
+    var = CountingVariable(ncfile.variables['temp'], counter)
+    h = CountingVariable(ncfile.variables['h'], counter)
+    zeta = CountingVariable(ncfile.variables['zeta'], counter)
+    vsec = extract_points(var, lines, cols, (tindex, slice(None)))
+    extract_points(h, lines, cols)
+    extract_points(zeta, lines, cols, (tindex,))
+    return vsec
+
+
+def run(ncfile, index, lon, lat, npoints, per_point_max=1000):
+    xs = np.linspace(lon.min() + 0.5, lon.max() - 0.5, npoints)
+    ys = np.linspace(lat.min() + 0.5, lat.max() - 0.5, npoints)
+    lines, cols = index.query(xs, ys)
+
+    counter = [0]
+    t0 = time.time()
+    vbulk = bulk(ncfile, lines, cols, 0, counter)
+    tbulk, rbulk = time.time() - t0, counter[0]
+
+    # the per point loop is timed on a subset and extrapolated
+    nsub = min(npoints, per_point_max)
+    counter = [0]
+    t0 = time.time()
+    vloop = per_point(ncfile, lines[:nsub], cols[:nsub], 0, counter)
+    tloop = (time.time() - t0) * npoints / float(nsub)
+    rloop = counter[0] * npoints // nsub
+
+    assert np.allclose(vloop, vbulk[:, :nsub])
+    print("points %6d | per point: %6d reads %9.3f s | "
+          "extract_points: %4d reads %7.3f s | speedup %7.1fx"
+          % (npoints, rloop, tloop, rbulk, tbulk, tloop / tbulk))
+
+
+if __name__ == '__main__':
+    filename = os.path.join(tempfile.mkdtemp(), 'bench_his.nc')
+    make_history(filename)
+    ncfile = nc.Dataset(filename)
+    lon = ncfile.variables['lon_rho'][:]
+    lat = ncfile.variables['lat_rho'][:]
+    index = GridIndex(lon, lat)
+    for npoints in [100, 1000, 10000]:
+        run(ncfile, index, lon, lat, npoints)
+    ncfile.close()
+    os.remove(filename)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark: horizontal slice at a fixed depth, whole
+## 3D field in memory vs row-block streaming lib.zslice
+######################################################
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import RomsGrid, zslice
+from ncio import RomsDataset
+from synthetic import make_history
+
+
+def whole_field(ncfile, grid, tindex, depth):
+    """Reference: full 3D field and z in memory, interpolated per column"""
+    var = np.ma.filled(ncfile.variables['temp'][tindex].astype(np.float32), np.nan)
+    z = grid.zlev(np.ma.getdata(grid.h), np.ma.filled(ncfile.variables['zeta'][tindex], 0))
+    k = (z <= depth).sum(axis=0) - 1
+    kb = np.clip(k, 0, var.shape[0] - 2)[None]
+    z0, z1 = np.take_along_axis(z, kb, 0)[0], np.take_along_axis(z, kb + 1, 0)[0]
+    v0, v1 = np.take_along_axis(var, kb, 0)[0], np.take_along_axis(var, kb + 1, 0)[0]
+    out = v0 + np.clip((depth - z0) / (z1 - z0), 0, 1) * (v1 - v0)
+    out[k < 0] = np.nan
+    return out
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+if __name__ == '__main__':
+    workdir = tempfile.mkdtemp()
+    L, M, N = 1000, 750, 30
+    # chunks of whole levels (ROMS default), and of a few levels by row
+    # blocks, each sliced with a budget smaller than one level block
+    cases = [('level chunks', None), ('row chunks', (1, 5, 125, 250))]
+    print("grid %d x %d x %d" % (N, M, L))
+    for label, chunks in cases:
+        filename = os.path.join(workdir, 'bench_his.nc')
+        make_history(filename, L=L, M=M, N=N, ntimes=1, chunks=chunks)
+        ncfile = RomsDataset(filename)
+        grid = RomsGrid(ncfile, ncfile)
+        grid.h  # read once, outside of the measurements
+
+        ref, tref, pref = measure(whole_field, ncfile, grid, 0, -100.)
+        report = {}
+        out, tout, pout = measure(zslice, ncfile.variables['temp'], grid, 0, -100.,
+                                  max_bytes=16 * 2**20, report=report)
+        assert np.allclose(ref, out, equal_nan=True, atol=1e-3)
+        assert report['blocks'] > 1
+        print("%s %s" % (label, ncfile.variables['temp'].chunks))
+        print("  whole field : %7.3f s  peak %8.1f MB" % (tref, pref / 2.**20))
+        print("  zslice      : %7.3f s  peak %8.1f MB  (%d blocks of %d rows, "
+              "estimated working set %.1f MB)" % (tout, pout / 2.**20, report['blocks'],
+                                                  report['rows_per_block'],
+                                                  report['peak_bytes'] / 2.**20))
+        ncfile.close()
+        os.remove(filename)
+    os.rmdir(workdir)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+######################################################
+## Benchmark suite: times the core paths of pyromsgui
+## on synthetic ROMS files of configurable size and
+## writes the results as JSON, to compare across runs
+## and machines.
+##
+##   python benchmarks/suite.py --size small -o before.json
+##   python benchmarks/suite.py --size small -o after.json --compare before.json
+######################################################
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import argparse
+import multiprocessing
+
+import numpy as np
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import (RomsGrid, TimeAxis, GridIndex, TransectInterpolator, near2d,
+                 get_zlev, hslice, extract_points, point_series)
+from ncio import RomsDataset
+from synthetic import make_grid, make_history
+
+
+SIZES = dict(small  = dict(L=200,  M=150,  N=10, ntimes=24),
+             medium = dict(L=600,  M=450,  N=20, ntimes=48),
+             large  = dict(L=1500, M=1000, N=30, ntimes=48))
+REGRESSION = 1.10  # ratios above this are flagged by --compare
+
+
+class FakeTime(object):
+    """An ocean_time-like variable held in memory"""
+    def __init__(self, values, units):
+        self.values, self.units = values, units
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+
+class Context(object):
+    """Synthetic files of one configuration and the objects opened on them"""
+    def __init__(self, workdir, L, M, N, ntimes, chunks, zlib):
+        self.grdname = make_grid(os.path.join(workdir, 'bench_grd.nc'), L, M)
+        self.hisname = make_history(os.path.join(workdir, 'bench_his.nc'), L, M, N,
+                                    ntimes, zlib=zlib, chunks=chunks, land=True)
+        self.grd = RomsDataset(self.grdname)
+        self.ncfile = RomsDataset(self.hisname)
+        self.grid = RomsGrid(self.grd, self.ncfile)
+        self.lon, self.lat = self.grid.lonr, self.grid.latr
+        self.h = np.ma.getdata(self.grid.h)
+        self.index = self.grid.index('rho')
+        self.ntimes = ntimes
+        self.record = 0
+
+        # diagonal transect, about one point per grid cell
+        npoints = int(np.hypot(L, M))
+        self.xs = np.linspace(self.lon[M // 10, L // 10], self.lon[-M // 10, -L // 10], npoints)
+        self.ys = np.linspace(self.lat[M // 10, L // 10], self.lat[-M // 10, -L // 10], npoints)
+
+    def next_record(self):
+        """Cycles over the records, so repeated runs are not served by the chunk cache"""
+        self.record = (self.record + 1) % self.ntimes
+        return self.record
+
+    def close(self):
+        self.ncfile.close()
+        self.grd.close()
+
+
+def bench_near2d(ctx):
+    xs, ys = ctx.xs[::max(1, ctx.xs.size // 10)][:10], ctx.ys[::max(1, ctx.ys.size // 10)][:10]
+    return lambda: [near2d(ctx.lon, ctx.lat, x, y) for x, y in zip(xs, ys)]
+
+def bench_gridindex_build(ctx):
+    return lambda: GridIndex(ctx.lon, ctx.lat)
+
+def bench_gridindex_query(ctx):
+    return lambda: ctx.index.query(ctx.xs, ctx.ys)
+
+def bench_get_zlev(ctx):
+    zeta = np.ma.filled(ctx.ncfile.variables['zeta'][0], 0)
+    g = ctx.grid
+    return lambda: get_zlev(ctx.h, g.Cs_r, g.hc, g.s_rho, ssh=zeta, Vtransform=g.Vtransform)
+
+def bench_time_axis(ctx):
+    nctime = FakeTime(np.arange(100000) * 3600., 'seconds since 2000-01-01 00:00:00')
+    return lambda: TimeAxis(nctime)
+
+def bench_time_lookup(ctx):
+    taxis = TimeAxis(FakeTime(np.arange(100000) * 3600., 'seconds since 2000-01-01 00:00:00'))
+    labels = taxis.labels[::100]
+    return lambda: [taxis.index(label) for label in labels]
+
+def bench_hslice_surface(ctx):
+    temp = ctx.ncfile.variables['temp']
+    return lambda: hslice(temp, ctx.grid, ctx.next_record(), 'surface')
+
+def bench_hslice_depth(ctx):
+    temp = ctx.ncfile.variables['temp']
+    return lambda: hslice(temp, ctx.grid, ctx.next_record(), -100.)
+
+def bench_vslice(ctx):
+    temp, zeta = ctx.ncfile.variables['temp'], ctx.ncfile.variables['zeta']
+    def run():
+        tindex = ctx.next_record()
+        tr = TransectInterpolator(ctx.lon, ctx.lat, ctx.xs, ctx.ys, index=ctx.index)
+        vsec = tr.interpolate( extract_points(temp, tr.lines, tr.cols, (tindex, slice(None))) )
+        hsec = tr.interpolate( ctx.h[tr.lines, tr.cols] )
+        zsec = tr.interpolate( extract_points(zeta, tr.lines, tr.cols, (tindex,)) )
+        return vsec, ctx.grid.zlev(hsec, zsec)
+    return run
+
+def bench_point_series(ctx):
+    temp = ctx.ncfile.variables['temp']
+    M, L = ctx.lon.shape
+    return lambda: point_series(temp, M // 2, L // 2, k=-1)
+
+
+BENCHMARKS = [('near2d_x10', bench_near2d),
+              ('gridindex_build', bench_gridindex_build),
+              ('gridindex_query', bench_gridindex_query),
+              ('get_zlev_3d', bench_get_zlev),
+              ('time_axis_100k', bench_time_axis),
+              ('time_lookup_x1000', bench_time_lookup),
+              ('hslice_surface', bench_hslice_surface),
+              ('hslice_depth', bench_hslice_depth),
+              ('vslice', bench_vslice),
+              ('point_series', bench_point_series)]
+
+
+def timeit(func, repeat):
+    func() # warm up (imports, lazy grid fields, caches of the OS)
+    runs = []
+    for ind in range(repeat):
+        t0 = time.time()
+        func()
+        runs.append(time.time() - t0)
+    return dict(best=min(runs), median=float(np.median(runs)),
+                mean=float(np.mean(runs)), runs=runs)
+
+
+def machine_info():
+    return dict(hostname=socket.gethostname(), platform=platform.platform(),
+                processor=platform.processor(), cpus=multiprocessing.cpu_count(),
+                python=platform.python_version(), numpy=np.__version__,
+                netCDF4=nc.__version__, date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def run_suite(config, repeat=5, only=None, workdir=None, verbose=True):
+    """Builds the synthetic files of config and times every benchmark"""
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='pyromsgui_bench_')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    t0 = time.time()
+    ctx = Context(workdir, **config)
+    if verbose:
+        print("synthetic files written in %.1f s (%s)" % (time.time() - t0, workdir))
+    results = {}
+    try:
+        for name, bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            results[name] = timeit(bench(ctx), repeat)
+            if verbose:
+                print("%-20s best %9.4f s   median %9.4f s" % (name, results[name]['best'],
+                                                             results[name]['median']))
+    finally:
+        ctx.close()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(old, new):
+    """Prints the median time ratios new/old of the benchmarks in both result files"""
+    if old['config'] != new['config']:
+        print("warning: configurations differ: %s vs %s" % (old['config'], new['config']))
+    print("%-20s %12s %12s %8s" % ('benchmark', 'old [s]', 'new [s]', 'ratio'))
+    regressions = 0
+    for name in sorted(set(old['results']) & set(new['results'])):
+        t_old = old['results'][name]['median']
+        t_new = new['results'][name]['median']
+        ratio = t_new / t_old if t_old > 0 else float('inf')
+        flag = '  <-- slower' if ratio > REGRESSION else ''
+        regressions += bool(flag)
+        print("%-20s %12.4f %12.4f %8.2f%s" % (name, t_old, t_new, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyromsgui benchmark suite")
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    for dim in ['L', 'M', 'N', 'ntimes']:
+        parser.add_argument('--%s' % dim, type=int, default=None,
+                            help="overrides the %s of --size" % dim)
+    parser.add_argument('--chunks', default=None,
+                        help="chunk shape of the 4D variables, e.g. 1,1,150,200, "
+                             "or contiguous [one level of one record]")
+    parser.add_argument('--no-zlib', action='store_true', help="uncompressed variables")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', default=None,
+                        help="benchmarks to run: %s" % ' '.join(n for n, b in BENCHMARKS))
+    parser.add_argument('--workdir', default=None,
+                        help="keep the synthetic files in this directory")
+    parser.add_argument('-o', '--output', default=None, help="JSON results file")
+    parser.add_argument('--compare', default=None,
+                        help="JSON results of a previous run to compare with")
+    opts = parser.parse_args(argv)
+
+    config = dict(SIZES[opts.size])
+    for dim in ['L', 'M', 'N', 'ntimes']:
+        if getattr(opts, dim) is not None:
+            config[dim] = getattr(opts, dim)
+    chunks = opts.chunks
+    if chunks and chunks != 'contiguous':
+        chunks = [int(c) for c in chunks.split(',')]
+    config.update(chunks=chunks, zlib=not opts.no_zlib)
+
+    print("config: %s" % config)
+    results = run_suite(config, opts.repeat, opts.only, opts.workdir)
+    report = dict(meta=machine_info(), config=config, repeat=opts.repeat,
+                  results=results)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print("results written to %s" % opts.output)
+    if opts.compare:
+        with open(opts.compare) as f:
+            old = json.load(f)
+        return 1 if compare(old, report) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
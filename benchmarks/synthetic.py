@@ -0,0 +1,130 @@
+######################################################
+## Synthetic ROMS-like netcdf files for the benchmarks
+######################################################
+import numpy as np
+import netCDF4 as nc
+
+from bench_gridindex import curvilinear_grid
+
+
+def synthetic_bathymetry(lon, lat, land=False):
+    """h deepening offshore, and a land mask with an island if land"""
+    h = 50 + 4000 * (lon - lon.min()) / (lon.max() - lon.min())
+    mask = np.ones(lon.shape)
+    if land:
+        M, L = lon.shape
+        jj, ii = np.ogrid[:M, :L]
+        mask[(jj - M // 3) ** 2 + (ii - L // 3) ** 2 < (min(M, L) // 8) ** 2] = 0
+        mask[:, :max(L // 20, 1)] = 0 # coast along the western boundary
+    return h, mask
+
+
+def make_grid(filename, L=400, M=300, land=True):
+    """
+    Writes a ROMS grid-like file: lon/lat/mask of the rho, u and v
+    points, h and angle. Returns the filename.
+    """
+    lon, lat = curvilinear_grid(L, M)
+    h, mask = synthetic_bathymetry(lon, lat, land)
+
+    ncfile = nc.Dataset(filename, 'w')
+    ncfile.type = 'ROMS grid file'
+    for name, size in [('eta_rho', M), ('xi_rho', L), ('eta_u', M), ('xi_u', L - 1),
+                       ('eta_v', M - 1), ('xi_v', L)]:
+        ncfile.createDimension(name, size)
+
+    u = lambda arr: 0.5 * (arr[:, :-1] + arr[:, 1:])
+    v = lambda arr: 0.5 * (arr[:-1] + arr[1:])
+    fields = [('rho', lon, lat, mask), ('u', u(lon), u(lat), mask[:, :-1] * mask[:, 1:]),
+              ('v', v(lon), v(lat), mask[:-1] * mask[1:])]
+    for grid, glon, glat, gmask in fields:
+        dims = ('eta_%s' % grid, 'xi_%s' % grid)
+        ncfile.createVariable('lon_%s' % grid, 'f8', dims)[:] = glon
+        ncfile.createVariable('lat_%s' % grid, 'f8', dims)[:] = glat
+        ncfile.createVariable('mask_%s' % grid, 'f8', dims)[:] = gmask
+    ncfile.createVariable('h', 'f8', ('eta_rho', 'xi_rho'))[:] = h
+    angle = np.arctan2(np.gradient(lat, axis=1), np.gradient(lon, axis=1))
+    ncfile.createVariable('angle', 'f8', ('eta_rho', 'xi_rho'))[:] = angle
+    ncfile.close()
+    return filename
+
+
+def make_history(filename, L=400, M=300, N=20, ntimes=2, zlib=True, chunks=None,
+                 land=False, velocities=False):
+    """
+    Writes a ROMS history-like file with grid variables, zeta and a
+    chunked (and optionally compressed) 4D temp. Returns the filename.
+    chunks is the chunk shape of the 4D variables, (1, 1, M, L) by
+    default, or 'contiguous'. With land, points of the land mask of
+    make_grid hold fill values (1e37); with velocities, u and v are written
+    on their staggered grids too.
+    """
+    lon, lat = curvilinear_grid(L, M)
+    h, mask = synthetic_bathymetry(lon, lat, land)
+    if chunks is None:
+        chunks = (1, 1, M, L)
+
+    ncfile = nc.Dataset(filename, 'w')
+    ncfile.type = 'ROMS/TOMS history file'
+    # contiguous variables need a fixed size record dimension
+    ncfile.createDimension('ocean_time', ntimes if chunks == 'contiguous' else None)
+    ncfile.createDimension('s_rho', N)
+    ncfile.createDimension('eta_rho', M)
+    ncfile.createDimension('xi_rho', L)
+    if velocities:
+        ncfile.createDimension('eta_u', M)
+        ncfile.createDimension('xi_u', L - 1)
+        ncfile.createDimension('eta_v', M - 1)
+        ncfile.createDimension('xi_v', L)
+
+    time = ncfile.createVariable('ocean_time', 'f8', ('ocean_time',))
+    time.units = 'seconds since 2000-01-01 00:00:00'
+    time[:] = np.arange(ntimes) * 3600.
+
+    for name, value in [('theta_s', 7.), ('theta_b', 0.1), ('hc', 50.)]:
+        ncfile.createVariable(name, 'f8', ())[:] = value
+    sc = ( np.arange(1, N + 1) - N - 0.5 ) / N
+    ncfile.createVariable('s_rho', 'f8', ('s_rho',))[:] = sc
+    ncfile.createVariable('Cs_r', 'f8', ('s_rho',))[:] = sc ** 3
+
+    for name, arr in [('lon_rho', lon), ('lat_rho', lat), ('h', h)]:
+        ncfile.createVariable(name, 'f8', ('eta_rho', 'xi_rho'))[:] = arr
+
+    # the ROMS fill value where land points need one, the netcdf default
+    # otherwise, as before land masks were added
+    fill_value = 1e37 if land else None
+    def create(name, dims, chunksizes):
+        if chunks == 'contiguous':
+            return ncfile.createVariable(name, 'f4', dims, contiguous=True,
+                                         fill_value=fill_value)
+        return ncfile.createVariable(name, 'f4', dims, zlib=zlib,
+                                     chunksizes=chunksizes, fill_value=fill_value)
+
+    def shrink(chunksizes, shape):
+        if chunks == 'contiguous':
+            return None
+        return tuple(min(c, n) for c, n in zip(chunksizes, shape))
+
+    land_points = mask == 0
+    zchunks = None if chunks == 'contiguous' else (1,) + tuple(chunks[-2:])
+    zeta = create('zeta', ('ocean_time', 'eta_rho', 'xi_rho'), shrink(zchunks, (1, M, L)))
+    temp = create('temp', ('ocean_time', 's_rho', 'eta_rho', 'xi_rho'),
+                  shrink(chunks, (1, N, M, L)))
+    if velocities:
+        u = create('u', ('ocean_time', 's_rho', 'eta_u', 'xi_u'),
+                   shrink(chunks, (1, N, M, L - 1)))
+        v = create('v', ('ocean_time', 's_rho', 'eta_v', 'xi_v'),
+                   shrink(chunks, (1, N, M - 1, L)))
+    for t in range(ntimes):
+        zeta[t] = np.ma.masked_where(land_points, 0.1 * np.sin(lon + t))
+        field = ( 25 * (1 + sc[:,None,None]) * np.cos(lat / 10.)[None,...]
+                  + t ).astype('f4')
+        temp[t] = np.ma.masked_where(land_points[None].repeat(N, 0), field)
+        if velocities:
+            speed = 0.5 * np.cos(lat + t / 10.)[None] * (1 + sc[:,None,None])
+            u[t] = np.ma.masked_where(land_points[None, :, 1:].repeat(N, 0),
+                                      speed[:, :, 1:])
+            v[t] = np.ma.masked_where(land_points[None, 1:].repeat(N, 0),
+                                      0.5 * speed[:, 1:])
+    ncfile.close()
+    return filename
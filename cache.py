@@ -0,0 +1,190 @@
+######################################################
+## In-memory caches of decoded ROMS fields
+######################################################
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+DEFAULT_CACHE_BYTES = 512 * 2**20
+
+
+class SliceCache(object):
+    """
+    Bounded LRU cache of decoded 2D/3D slices, keyed by
+    (file, variable, time index, level).
+    Entries are evicted by total size in bytes rather than by count,
+    so the RAM used by cached slices stays under max_bytes. Keys being
+    read are tracked, so a thread asking for a slice that another one
+    (e.g. the Prefetcher) is loading waits for that read instead of
+    issuing a second one.
+    Usage: cache = SliceCache(max_bytes=512*2**20)
+           arr = cache.get_or_load(key, lambda: var[tindex, -1, ...])
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.RLock()
+        self.pending = {}  # key -> PendingLoad of the slices being read
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                arr = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = arr # most recently used goes to the end
+            self.hits += 1
+            return arr
+
+    def put(self, key, arr):
+        size = array_nbytes(arr)
+        if size > self.max_bytes:
+            return arr # would evict everything else, not worth it
+        # cached arrays are shared, nobody should modify them in place
+        arr.flags.writeable = False
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= array_nbytes(self.data.pop(key))
+            self.data[key] = arr
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                oldkey, old = self.data.popitem(last=False)
+                self.nbytes -= array_nbytes(old)
+                self.evictions += 1
+        return arr
+
+    def get_or_load(self, key, loader):
+        """Returns the cached slice, calling loader() to read it on a miss"""
+        arr = self.get(key)
+        if arr is None:
+            arr = self.load(key, loader)
+        return arr
+
+    def load(self, key, loader):
+        """
+        Reads a slice with loader() and caches it, or waits for the read
+        of another thread when key is already being loaded
+        """
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                arr = self.data.get(key)
+                if arr is not None: # loaded meanwhile
+                    return arr
+                self.pending[key] = mine = PendingLoad()
+        if pending is not None:
+            pending.done.wait()
+            if pending.arr is not None:
+                return pending.arr
+            return self.load(key, loader) # that read failed
+        try:
+            mine.arr = self.put(key, loader())
+            return mine.arr
+        finally:
+            with self.lock:
+                del self.pending[key]
+            mine.done.set()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return dict(entries=len(self.data), nbytes=self.nbytes,
+                        max_bytes=self.max_bytes, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions,
+                        hit_rate=self.hits / float(total) if total else 0.)
+
+    def __repr__(self):
+        return ("SliceCache(%(entries)d entries, %(nbytes)d/%(max_bytes)d bytes, "
+                "%(hits)d hits, %(misses)d misses, %(evictions)d evictions)"
+                % self.stats())
+
+
+class Prefetcher(object):
+    """
+    Loads slices into a SliceCache on a background worker thread.
+    Jobs are (key, loader) pairs; a new request replaces the pending
+    ones, so only the neighbourhood of the latest selection is loaded.
+    on_loaded(key) is called from the worker thread after each slice is
+    cached: GUI code must hand it over to the main thread (wx.CallAfter).
+    Usage: prefetcher = Prefetcher(cache, on_loaded)
+           prefetcher.request([(key, loader), ...])
+    """
+    def __init__(self, cache, on_loaded=None):
+        self.cache = cache
+        self.on_loaded = on_loaded
+        self.jobs = deque()
+        self.prefetched, self.failed = 0, 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="Prefetcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, jobs):
+        with self.cond:
+            self.jobs.clear()
+            self.jobs.extend(job for job in jobs if job[0] not in self.cache)
+            self.cond.notify()
+
+    def cancel(self):
+        with self.cond:
+            self.jobs.clear()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.jobs.clear()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                key, loader = self.jobs.popleft()
+
+            if key in self.cache:
+                continue
+            try:
+                self.cache.load(key, loader)
+            except Exception: # prefetching is best effort only
+                self.failed += 1
+                continue
+            self.prefetched += 1
+            if self.on_loaded is not None:
+                self.on_loaded(key)
+
+
+class PendingLoad(object):
+    """A slice being read by one thread, that others can wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.arr = None
+
+
+def array_nbytes(arr):
+    """Memory used by an array, including the mask of masked arrays"""
+    size = np.ma.getdata(arr).nbytes
+    mask = np.ma.getmask(arr)
+    if mask is not np.ma.nomask:
+        size += mask.nbytes
+    return size
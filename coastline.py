@@ -0,0 +1,267 @@
+######################################################
+## Coastlines clipped to the grid, simplified at
+## several tolerances, cached on disk and drawn as a
+## single LineCollection
+######################################################
+import os
+import hashlib
+
+import numpy as np
+from matplotlib.collections import LineCollection
+
+from lib import CACHE_DIR
+
+
+# Douglas-Peucker tolerances of the levels, in degrees
+TOLERANCES = [0., 0.001, 0.004, 0.016, 0.064]
+CACHE_FORMAT = 1
+
+
+def read_seagrid(filename):
+    """lon, lat of a MATLAB Seagrid-like coastline file (polylines separated by NaN)"""
+    import scipy.io as sp
+    coast = sp.loadmat(filename)
+    return (np.asarray(coast['lon'], dtype=np.float64).ravel(),
+            np.asarray(coast['lat'], dtype=np.float64).ravel())
+
+
+def split_segments(lon, lat):
+    """(n, 2) vertex arrays of the NaN separated polylines in lon, lat"""
+    gaps = np.flatnonzero(np.isnan(lon) | np.isnan(lat))
+    starts = np.r_[0, gaps + 1]
+    stops = np.r_[gaps, lon.size]
+    xy = np.column_stack([lon, lat])
+    return [xy[a:b] for a, b in zip(starts, stops) if b - a >= 2]
+
+
+def clip_segments(segments, bbox):
+    """
+    Parts of the polylines inside bbox (x0, x1, y0, y1). Runs of inside
+    vertices keep one vertex on each side, so the lines reach the edge;
+    edges crossing bbox without a vertex inside are dropped.
+    """
+    x0, x1, y0, y1 = bbox
+    out = []
+    for seg in segments:
+        x, y = seg[:, 0], seg[:, 1]
+        if x.max() < x0 or x.min() > x1 or y.max() < y0 or y.min() > y1:
+            continue
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        if inside.all():
+            out.append(seg)
+            continue
+        keep = inside.copy()
+        keep[1:] |= inside[:-1]
+        keep[:-1] |= inside[1:]
+        edges = np.diff(np.r_[0, keep.astype(np.int8), 0])
+        for a, b in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if b - a >= 2:
+                out.append(seg[a:b])
+    return out
+
+
+def douglas_peucker(segments, tolerance):
+    """
+    Simplified polylines (list of (n, 2) arrays): a vertex is kept when
+    it is farther than tolerance from the chord between the vertices
+    kept around it. All the spans of all the polylines are split in the
+    same vectorized pass, one pass per level of the recursion.
+    """
+    if tolerance <= 0 or not segments:
+        return segments
+    offsets = np.cumsum([0] + [len(seg) for seg in segments])
+    xy = np.concatenate(segments).astype(np.float64)
+    n = len(xy)
+    index = np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[offsets[:-1]] = keep[offsets[1:] - 1] = True
+    active = ~keep
+    while active.any():
+        # kept vertices before and after every vertex: its current span
+        prev = np.maximum.accumulate(np.where(keep, index, 0))
+        after = np.minimum.accumulate(np.where(keep, index, n - 1)[::-1])[::-1]
+        points = np.flatnonzero(active)
+        a, b = prev[points], after[points]
+        dx, dy = (xy[b] - xy[a]).T
+        px, py = (xy[points] - xy[a]).T
+        norm = np.hypot(dx, dy)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist = np.where(norm > 0, np.abs(dx * py - dy * px) / norm,
+                            np.hypot(px, py)) # closed polygons: to the start
+
+        # farthest vertex of every span (points of a span are contiguous)
+        starts = np.flatnonzero(np.r_[True, a[1:] != a[:-1]])
+        span = np.repeat(np.arange(starts.size), np.diff(np.r_[starts, points.size]))
+        farthest = np.maximum.reduceat(dist, starts)
+        candidates = np.flatnonzero(dist == farthest[span])
+        first = candidates[np.r_[True, span[candidates][1:] != span[candidates][:-1]]]
+        split = first[farthest[span[first]] > tolerance]
+
+        keep[points[split]] = True
+        active[points[split]] = False
+        active[points[farthest[span] <= tolerance]] = False # spans done
+    return [xy[start:stop][keep[start:stop]] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+class Coastline(object):
+    """
+    A coastline clipped to a bounding box and simplified with
+    Douglas-Peucker at several tolerances (degrees). Each level is
+    stored as float32 vertices of all its polylines and their offsets,
+    which is compact on disk and split into LineCollection segments
+    without copies. Built once from the .mat file and cached in
+    CACHE_DIR/coastlines, keyed by path, size, mtime, bbox and
+    tolerances.
+    Usage: coast = Coastline.load('coast.mat', bbox=(lon0, lon1, lat0, lat1))
+           segments = coast.segments(coast.level_for(degrees_per_pixel))
+    """
+    def __init__(self, levels, tolerances, bbox=None):
+        self.levels = levels  # (vertices, offsets) per tolerance
+        self.tolerances = list(tolerances)
+        self.bbox = bbox
+
+    @classmethod
+    def from_segments(cls, segments, tolerances=TOLERANCES, bbox=None):
+        if bbox is not None:
+            segments = clip_segments(segments, bbox)
+        levels = []
+        for tolerance in tolerances:
+            simplified = douglas_peucker(segments, tolerance)
+            levels.append(pack(simplified))
+            segments = simplified # coarser levels start from the finer ones
+        return cls(levels, tolerances, bbox)
+
+    @classmethod
+    def load(cls, filename, bbox=None, tolerances=TOLERANCES, cachedir=None):
+        """Coastline of a Seagrid .mat file, from the cache when possible"""
+        cachefile = cache_filename(filename, bbox, tolerances, cachedir)
+        try:
+            return cls.from_cache(cachefile)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        coast = cls.from_segments(split_segments(*read_seagrid(filename)),
+                                  tolerances, bbox)
+        try:
+            coast.save(cachefile)
+        except (IOError, OSError): # read-only cache: rebuilt next time
+            pass
+        return coast
+
+    @classmethod
+    def from_cache(cls, cachefile):
+        with np.load(cachefile) as data:
+            tolerances = data['tolerances'].tolist()
+            bbox = tuple(data['bbox']) if data['bbox'].size else None
+            levels = [(data['vertices_%d' % k], data['offsets_%d' % k])
+                      for k in range(len(tolerances))]
+        return cls(levels, tolerances, bbox)
+
+    def save(self, cachefile):
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        arrays = dict(tolerances=np.array(self.tolerances),
+                      bbox=np.array(self.bbox if self.bbox is not None else []))
+        for k, (vertices, offsets) in enumerate(self.levels):
+            arrays['vertices_%d' % k], arrays['offsets_%d' % k] = vertices, offsets
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        with open(tmpfile, 'wb') as fobj:
+            np.savez(fobj, **arrays)
+        os.rename(tmpfile, cachefile)
+
+    def segments(self, level=0):
+        """List of (n, 2) vertex arrays of a level"""
+        vertices, offsets = self.levels[level]
+        return np.split(vertices, offsets[1:-1])
+
+    def level_for(self, pixel):
+        """Coarsest level whose tolerance is below pixel (degrees per screen pixel)"""
+        level = 0
+        for k, tolerance in enumerate(self.tolerances):
+            if tolerance <= pixel:
+                level = k
+        return level
+
+    @property
+    def extent(self):
+        """(x0, x1, y0, y1) of the vertices"""
+        vertices = self.levels[0][0]
+        if not len(vertices):
+            return self.bbox
+        return (vertices[:, 0].min(), vertices[:, 0].max(),
+                vertices[:, 1].min(), vertices[:, 1].max())
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes + o.nbytes for v, o in self.levels)
+
+    def __repr__(self):
+        return "Coastline(%s vertices per level)" % [len(v) for v, o in self.levels]
+
+
+def pack(segments):
+    """float32 vertices of a list of polylines and the offset of each one"""
+    offsets = np.cumsum([0] + [len(seg) for seg in segments])
+    if segments:
+        vertices = np.concatenate(segments).astype(np.float32)
+    else:
+        vertices = np.zeros((0, 2), dtype=np.float32)
+    return vertices, offsets
+
+
+def cache_filename(filename, bbox, tolerances, cachedir=None):
+    stat = os.stat(filename)
+    bbox = None if bbox is None else tuple(round(float(b), 4) for b in bbox)
+    tag = "%d|%s|%d|%r|%r|%r" % (CACHE_FORMAT, os.path.realpath(filename), stat.st_size,
+                                 stat.st_mtime, bbox, list(tolerances))
+    digest = hashlib.sha1(tag.encode('utf-8')).hexdigest()[:24]
+    return os.path.join(cachedir or os.path.join(CACHE_DIR, 'coastlines'),
+                        "%s.npz" % digest)
+
+
+class CoastlineLayer(object):
+    """
+    Draws a Coastline on an axes as one LineCollection, switching to
+    the simplification level matching the zoom (about one tolerance
+    per screen pixel) as the axes limits change.
+    Usage: layer = CoastlineLayer(ax, Coastline.load('coast.mat'), color='k')
+    """
+    def __init__(self, ax, coastline, **kwargs):
+        self.ax = ax
+        self.coastline = coastline
+        kwargs.setdefault('colors', kwargs.pop('color', 'k'))
+        kwargs.setdefault('linewidths', 1.)
+        self.level = None
+        self.artist = LineCollection([], **kwargs)
+        ax.add_collection(self.artist, autolim=False)
+        self.cids = [ax.callbacks.connect(event, self.OnLimitsChanged)
+                     for event in ('xlim_changed', 'ylim_changed')]
+        self.update()
+
+    def pixel_size(self):
+        """Degrees per screen pixel of the current view"""
+        bbox = self.ax.get_window_extent()
+        xlim, ylim = self.ax.get_xlim(), self.ax.get_ylim()
+        return max(abs(xlim[1] - xlim[0]) / max(bbox.width, 1),
+                   abs(ylim[1] - ylim[0]) / max(bbox.height, 1))
+
+    def update(self):
+        """Swaps in the level of the current zoom. True if it changed"""
+        level = self.coastline.level_for(self.pixel_size())
+        if level == self.level:
+            return False
+        self.artist.set_segments(self.coastline.segments(level))
+        self.level = level
+        return True
+
+    def OnLimitsChanged(self, ax):
+        if self.update():
+            ax.figure.canvas.draw_idle()
+
+    def remove(self):
+        for cid in self.cids:
+            self.ax.callbacks.disconnect(cid)
+        self.cids = []
+        try:
+            self.artist.remove()
+        except ValueError: # axes were already cleared
+            pass
@@ -0,0 +1,344 @@
+######################################################
+## Derived variables: expressions of the variables of
+## a ROMS file, evaluated lazily on the slice asked for
+######################################################
+import ast
+from collections import OrderedDict
+
+import numpy as np
+
+from ncio import normalize_index
+
+
+REGISTRY = OrderedDict()
+
+
+def register(name, expression, units='', long_name=None):
+    """
+    Adds (or replaces) a derived variable of the registry. The
+    expression is checked right away: a bad one is a ValueError.
+    Usage: register('ke', '0.5 * (u**2 + v**2)', 'm2/s2', 'kinetic energy')
+    """
+    Expression(expression)
+    REGISTRY[name] = dict(expression=expression, units=units,
+                          long_name=long_name or expression)
+
+
+def eos80_density(temp, salt):
+    """Sea water density (kg/m3) at surface pressure, UNESCO 1981 (EOS-80)"""
+    t, s = temp, salt
+    rho_w = ( 999.842594 + 6.793952e-2 * t - 9.095290e-3 * t**2 + 1.001685e-4 * t**3
+              - 1.120083e-6 * t**4 + 6.536332e-9 * t**5 )
+    a = 0.824493 - 4.0899e-3 * t + 7.6438e-5 * t**2 - 8.2467e-7 * t**3 + 5.3875e-9 * t**4
+    b = -5.72466e-3 + 1.0227e-4 * t - 1.6546e-6 * t**2
+    with np.errstate(invalid='ignore'):
+        return rho_w + a * s + b * s**1.5 + 4.8314e-4 * s**2
+
+
+def vorticity(u, v, pm, pn):
+    """Relative vorticity dv/dx - du/dy (1/s) of rho point velocities"""
+    return np.gradient(v, axis=-1) * pm - np.gradient(u, axis=-2) * pn
+
+
+FUNCTIONS = dict(hypot=np.hypot, sqrt=np.sqrt, abs=np.abs, exp=np.exp, log=np.log,
+                 log10=np.log10, sin=np.sin, cos=np.cos, tan=np.tan,
+                 arctan2=np.arctan2, minimum=np.minimum, maximum=np.maximum,
+                 density=eos80_density, vorticity=vorticity)
+# functions of the neighbours of each point: their arguments are evaluated
+# on the slice grown by this many points, and the grid metrics are appended
+HALO = dict(vorticity=1)
+
+OPERATORS = {ast.Add: ('+', np.add), ast.Sub: ('-', np.subtract),
+             ast.Mult: ('*', np.multiply), ast.Div: ('/', np.divide),
+             ast.Pow: ('**', np.power)}
+
+
+class Expression(object):
+    """
+    A parsed expression of variable names and numbers with + - * / **,
+    unary minus and calls of FUNCTIONS, e.g. 'hypot(u, v)'. Anything
+    else (attributes, subscripts, other calls...) is a ValueError, so
+    expressions typed in by users never run arbitrary code.
+    Nodes are tuples: ('const', value), ('name', name),
+    ('op', symbol, left, right), ('neg', operand), ('call', name, args).
+    """
+    def __init__(self, text):
+        self.text = text
+        try:
+            tree = ast.parse(text.strip(), mode='eval').body
+        except SyntaxError as err:
+            raise ValueError("Invalid expression %r: %s" % (text, err))
+        self.root = self.build(tree)
+        self.names = sorted(self.collect(self.root))
+
+    def build(self, node):
+        if isinstance(node, ast.Name):
+            return ('name', node.id)
+        if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+            if isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+                return ('const', float(node.value))
+        elif isinstance(node, getattr(ast, 'Num', ())): # python 2
+            return ('const', float(node.n))
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return ('op', OPERATORS[type(node.op)][0], self.build(node.left),
+                    self.build(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self.build(node.operand)
+            return ('neg', operand) if isinstance(node.op, ast.USub) else operand
+        if ( isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+             node.func.id in FUNCTIONS and not node.keywords ):
+            return ('call', node.func.id, tuple(self.build(arg) for arg in node.args))
+        raise ValueError("Unsupported expression in %r: %s" % (self.text,
+                                                                type(node).__name__))
+
+    def collect(self, node):
+        """Variable names used by node"""
+        if node[0] == 'name':
+            return set([node[1]])
+        if node[0] == 'op':
+            return self.collect(node[2]) | self.collect(node[3])
+        if node[0] == 'neg':
+            return self.collect(node[1])
+        if node[0] == 'call':
+            return set().union(*[self.collect(arg) for arg in node[2]])
+        return set()
+
+    def calls(self, node=None):
+        """Function names called by node (the whole expression by default)"""
+        node = self.root if node is None else node
+        if node[0] == 'call':
+            return set([node[1]]).union(*[self.calls(arg) for arg in node[2]])
+        if node[0] == 'op':
+            return self.calls(node[2]) | self.calls(node[3])
+        if node[0] == 'neg':
+            return self.calls(node[1])
+        return set()
+
+    @staticmethod
+    def source(node):
+        """Canonical text of a node, used in cache keys"""
+        if node[0] == 'const':
+            return repr(node[1])
+        if node[0] == 'name':
+            return node[1]
+        if node[0] == 'op':
+            return "(%s %s %s)" % (Expression.source(node[2]), node[1],
+                                   Expression.source(node[3]))
+        if node[0] == 'neg':
+            return "(-%s)" % Expression.source(node[1])
+        return "%s(%s)" % (node[1], ", ".join(Expression.source(arg) for arg in node[2]))
+
+
+register('speed', 'hypot(u, v)', 'm/s', 'current speed')
+register('speed_bar', 'hypot(ubar, vbar)', 'm/s', 'depth averaged current speed')
+register('speed_eastward', 'hypot(u_eastward, v_northward)', 'm/s', 'current speed')
+register('speed_bar_eastward', 'hypot(ubar_eastward, vbar_northward)', 'm/s',
+         'depth averaged current speed')
+register('density', 'density(temp, salt)', 'kg/m3', 'sea water density at surface pressure')
+register('sigma_t', 'density(temp, salt) - 1000', 'kg/m3', 'density anomaly')
+register('vorticity', 'vorticity(u, v)', '1/s', 'relative vorticity')
+register('vorticity_bar', 'vorticity(ubar, vbar)', '1/s', 'depth averaged relative vorticity')
+register('wind_stress', 'hypot(sustr, svstr)', 'N/m2', 'surface wind stress')
+
+
+class DerivedVariable(object):
+    """
+    A registry expression over the variables of a dataset, on the rho
+    points, that behaves like a (read-only) variable: indexing it
+    evaluates the expression on that hyperslab only, e.g. one level of
+    one record for a map or the bounding box of a transect, never on
+    whole variables. u/v operands are averaged to the rho points of the
+    slice as they are read. The operands and sub-expressions of whole
+    surface, bottom or 2D planes of one record are memoized in the
+    SliceCache, if one is given, so redrawing or reusing them (speed and
+    vorticity share u and v) reads nothing; other windows (the levels
+    and row blocks zslice reads, transects) are not, only the slice the
+    viewer makes of them.
+    Usage: speed = DerivedVariable('speed', 'hypot(u, v)', ncfile, grid, cache)
+           sst_speed = speed[0, -1, ...]
+    """
+    def __init__(self, name, expression, dataset, grid=None, cache=None, units='',
+                 long_name=None):
+        self.name = name
+        self.expression = Expression(expression)
+        self.dataset, self.grid, self.cache = dataset, grid, cache
+        self.units = units
+        self.long_name = long_name or expression
+        self.operands = [dataset.variables[n] for n in self.expression.names]
+        if not self.operands:
+            raise ValueError("%s: the expression uses no variable" % name)
+        lead = set(var.dimensions[:-2] for var in self.operands)
+        if len(lead) != 1 or len(self.operands[0].dimensions) < 3:
+            raise ValueError("%s: %s need the same time (and level) dimensions"
+                             % (name, ', '.join(self.expression.names)))
+        for var in self.operands:
+            if gridtype(var) not in ('rho', 'u', 'v'):
+                raise ValueError("%s: %s is not on rho, u or v points" % (name, var.name))
+        if self.expression.calls() & set(HALO) and grid is None:
+            raise ValueError("%s needs the grid metrics" % name)
+
+        first = self.operands[0]
+        self.dimensions = first.dimensions[:-2] + ('eta_rho', 'xi_rho')
+        self.shape = tuple(first.shape[:-2]) + rho_shape(dataset, self.operands)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+        self.chunks = None
+        # the results also depend on the grid metrics and masks
+        self.key = (getattr(dataset, 'key', id(dataset)), getattr(grid, 'key', None))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        normalized = normalize_index(index, self.shape)
+        if normalized is None:
+            raise IndexError("%s takes ints and slices only" % self.name)
+        # evaluated on unit step windows of the last two dimensions
+        window, picks = [], []
+        for n, ind in enumerate(normalized):
+            if isinstance(ind, int):
+                window.append( slice(ind, ind + 1, 1) )
+                picks.append(0)
+            elif n >= self.ndim - 2:
+                stop = max(ind.start, ind.stop - (ind.stop - ind.start - 1) % ind.step)
+                window.append( slice(ind.start, stop, 1) )
+                picks.append( slice(None, None, ind.step) )
+            else:
+                window.append(ind)
+                picks.append( slice(None) )
+        out = self.evaluate(self.expression.root, tuple(window))
+        # a fresh writable array: the evaluated one may be shared by the cache
+        return np.array(out[tuple(picks)], dtype=np.float32)
+
+    def evaluate(self, node, window):
+        if node[0] == 'const':
+            return np.float32(node[1])
+        if self.cache is None or not self.memoized(window):
+            return self.compute(node, window)
+        key = (self.key, 'derived', Expression.source(node), window_key(window))
+        return self.cache.get_or_load(key, lambda: self.compute(node, window))
+
+    def memoized(self, window):
+        """
+        Whether the nodes of a window go to the cache: whole planes of one
+        record, at the surface or bottom for 3D variables. A depth slice
+        would otherwise cache every level of every sub-expression.
+        """
+        lead = window[:-2]
+        if any(len(range(ind.start, ind.stop, ind.step)) != 1 for ind in lead):
+            return False
+        if any((ind.start, ind.stop) != (0, n) for ind, n in zip(window[-2:], self.shape[-2:])):
+            return False
+        return len(lead) < 2 or lead[1].start in (0, self.shape[1] - 1)
+
+    def compute(self, node, window):
+        kind = node[0]
+        if kind == 'name':
+            return read_rho(self.dataset.variables[node[1]], window)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            if kind == 'op':
+                func = [f for symbol, f in OPERATORS.values() if symbol == node[1]][0]
+                return np.asarray(func(self.evaluate(node[2], window),
+                                       self.evaluate(node[3], window)), dtype=np.float32)
+            if kind == 'neg':
+                return np.asarray(-self.evaluate(node[1], window), dtype=np.float32)
+            name, args = node[1], node[2]
+            if name not in HALO:
+                values = [self.evaluate(arg, window) for arg in args]
+                return np.asarray(FUNCTIONS[name](*values), dtype=np.float32)
+
+            # neighbourhood functions: grown window, then cropped back
+            halo = HALO[name]
+            grown, crop = [], []
+            for n, ind in enumerate(window):
+                if n < len(window) - 2:
+                    grown.append(ind)
+                    crop.append(slice(None))
+                    continue
+                start = max(ind.start - halo, 0)
+                stop = min(ind.stop + halo, self.shape[n])
+                grown.append( slice(start, stop, 1) )
+                crop.append( slice(ind.start - start, ind.stop - start) )
+            grown = tuple(grown)
+            values = [self.evaluate(arg, grown) for arg in args]
+            pm, pn = self.grid.metrics()
+            out = FUNCTIONS[name](*(values + [pm[grown[-2:]], pn[grown[-2:]]]))
+            return np.asarray(out[tuple(crop)], dtype=np.float32)
+
+    def __repr__(self):
+        return "DerivedVariable(%s = %s%s)" % (self.name, self.expression.text, self.shape)
+
+
+def gridtype(var):
+    """rho, u, v or psi, from the last dimension name"""
+    return var.dimensions[-1].split('_')[-1]
+
+
+def rho_shape(dataset, operands):
+    """(M, L) of the rho points"""
+    dims = getattr(dataset, 'dimensions', {})
+    if 'eta_rho' in dims and 'xi_rho' in dims:
+        return int(dims['eta_rho']), int(dims['xi_rho'])
+    for var in operands:
+        M, L = var.shape[-2:]
+        extra = {'u': (0, 1), 'v': (1, 0)}.get(gridtype(var), (0, 0))
+        return M + extra[0], L + extra[1]
+
+
+def window_key(window):
+    return tuple( (ind.start, ind.stop, ind.step) for ind in window )
+
+
+def read_rho(var, window):
+    """
+    float32 values of var on the rho points of window (unit step slices),
+    u/v points averaged to the rho points between them; rho points on
+    the boundary without two neighbours are NaN
+    """
+    grid = gridtype(var)
+    if grid == 'rho':
+        return np.asarray(var[window], dtype=np.float32)
+    axis = -1 if grid == 'u' else -2
+    ind = window[axis]
+    n = var.shape[axis]
+    lo, hi = max(ind.start - 1, 0), min(ind.stop, n)
+    source = list(window)
+    source[axis] = slice(lo, min(max(hi, lo + 1), n))
+    arr = np.asarray(var[tuple(source)], dtype=np.float32)
+
+    shape = list(arr.shape)
+    shape[axis] = ind.stop - ind.start
+    out = np.full(shape, np.nan, dtype=np.float32)
+    if hi - lo >= 2:
+        first, second = [slice(None)] * arr.ndim, [slice(None)] * arr.ndim
+        first[axis], second[axis] = slice(0, -1), slice(1, None)
+        dest = [slice(None)] * arr.ndim
+        # rho point r sits between u/v points r - 1 and r
+        dest[axis] = slice(lo + 1 - ind.start, hi - ind.start)
+        out[tuple(dest)] = 0.5 * (arr[tuple(first)] + arr[tuple(second)])
+    return out
+
+
+def add_derived(dataset, grid=None, cache=None, names=None):
+    """
+    Adds the registry variables (or the given names) that can be
+    computed from the variables of dataset to dataset.variables, and
+    returns their names. Variables of the file keep their name.
+    """
+    added = []
+    for name, entry in REGISTRY.items():
+        if names is not None and name not in names:
+            continue
+        if name in dataset.variables:
+            continue
+        expression = Expression(entry['expression'])
+        if not all(n in dataset.variables for n in expression.names):
+            continue
+        try:
+            var = DerivedVariable(name, entry['expression'], dataset, grid, cache,
+                                  entry['units'], entry['long_name'])
+        except ValueError: # operands that do not fit together
+            continue
+        dataset.variables[name] = var
+        added.append(name)
+    return added
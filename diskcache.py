@@ -0,0 +1,165 @@
+######################################################
+## On-disk cache of decompressed ROMS fields, read
+## back through np.memmap
+######################################################
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from lib import CACHE_DIR
+
+
+DEFAULT_DISK_CACHE_BYTES = int(float(os.environ.get('PYROMSGUI_DISK_CACHE_GB', 20)) * 2**30)
+
+
+class DiskCache(object):
+    """
+    Local cache of decompressed 2D planes (the last two dimensions of a
+    variable at fixed leading indexes, e.g. one level of one record)
+    of netcdf files, stored as uncompressed .npy files and served
+    through read-only np.memmap, so later reads, even of a few points,
+    run at local disk speed instead of decompressing over the network.
+    Entry names are derived from the source path, size and mtime: a
+    rewritten source file never hits its old entries, which age out.
+    The least recently used entries are deleted when the cache grows
+    beyond max_bytes. FORMAT is part of every entry name, and is bumped
+    when the planes stored by the readers change meaning.
+    Usage: disk = DiskCache()
+           ncfile = open_dataset('/ops/hindcast/roms/ocean_his_*.nc', disk_cache=disk)
+    """
+    FORMAT = 2  # float32 planes with NaN on fill values
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_DISK_CACHE_BYTES, max_open=64):
+        self.directory = directory or os.path.join(CACHE_DIR, 'arrays')
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.maps = OrderedDict()
+        self.sources = {}
+        self.nbytes = None
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.RLock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def source_prefix(self, source):
+        path = os.path.realpath(source)
+        return hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+
+    def forget(self, source):
+        """Makes the next access stat source again, e.g. when it is reopened"""
+        with self.lock:
+            self.sources.pop(source, None)
+
+    def filename(self, source, varname, plane):
+        """Entry of a plane of varname in source, as it is on disk right now"""
+        with self.lock: # shared by the prefetcher and the main thread
+            try:
+                prefix, stamp = self.sources[source]
+            except KeyError:
+                stat = os.stat(source)
+                prefix = self.source_prefix(source)
+                stamp = "%d-%r" % (stat.st_size, stat.st_mtime)
+                self.sources[source] = prefix, stamp
+        tag = "%d|%s|%s|%s" % (self.FORMAT, stamp, varname, ",".join(str(int(p)) for p in plane))
+        digest = hashlib.sha1(tag.encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.directory, "%s_%s.npy" % (prefix, digest))
+
+    def get(self, source, varname, plane):
+        """Read-only memmap of a cached plane, or None"""
+        filename = self.filename(source, varname, plane)
+        with self.lock:
+            try:
+                arr = self.maps.pop(filename)
+            except KeyError:
+                try:
+                    arr = np.load(filename, mmap_mode='r')
+                except (IOError, OSError, ValueError):
+                    self.misses += 1
+                    return None
+            try:
+                os.utime(filename, None) # recently used, for evict
+            except OSError: # evicted by another process, the map stays valid
+                pass
+            self.maps[filename] = arr
+            while len(self.maps) > self.max_open:
+                self.maps.popitem(last=False)
+            self.hits += 1
+            return arr
+
+    def put(self, source, varname, plane, arr):
+        """Stores a plane (a plain array) and returns its memmap"""
+        filename = self.filename(source, varname, plane)
+        tmpname = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+        with open(tmpname, 'wb') as fobj:
+            np.save(fobj, np.ascontiguousarray(arr))
+        os.rename(tmpname, filename) # readers never see partial files
+        with self.lock:
+            if self.nbytes is not None:
+                self.nbytes += os.path.getsize(filename)
+            if self.total_bytes() > self.max_bytes:
+                self.evict(self.max_bytes * 0.9)
+            arr = np.load(filename, mmap_mode='r')
+            self.maps[filename] = arr
+            return arr
+
+    def entries(self):
+        """(mtime, size, filename) of every entry"""
+        out = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError: # removed by another process
+                continue
+            out.append( (stat.st_mtime, stat.st_size, filename) )
+        return out
+
+    def total_bytes(self):
+        if self.nbytes is None:
+            self.nbytes = sum(size for mtime, size, filename in self.entries())
+        return self.nbytes
+
+    def evict(self, target):
+        """Deletes least recently used entries until the cache holds target bytes"""
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for mtime, size, filename in entries)
+            for mtime, size, filename in entries:
+                if total <= target:
+                    break
+                self.remove(filename)
+                total -= size
+                self.evictions += 1
+            self.nbytes = total
+
+    def remove(self, filename):
+        self.maps.pop(filename, None)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def invalidate(self, source=None):
+        """Drops the entries of a source file, or all of them"""
+        prefix = self.source_prefix(source) + '_' if source is not None else ''
+        with self.lock:
+            for mtime, size, filename in self.entries():
+                if os.path.basename(filename).startswith(prefix):
+                    self.remove(filename)
+            self.sources.clear()
+            self.nbytes = None
+
+    def stats(self):
+        with self.lock:
+            return dict(directory=self.directory, nbytes=self.total_bytes(),
+                        max_bytes=self.max_bytes, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
+
+    def __repr__(self):
+        return ("DiskCache(%(directory)s, %(nbytes)d/%(max_bytes)d bytes, "
+                "%(hits)d hits, %(misses)d misses)" % self.stats())
@@ -0,0 +1,231 @@
+######################################################
+## Persistent cache of the products derived from a
+## grid file (coordinates, metrics, spatial indexes,
+## z levels...), stored as .npy files and read back
+## through np.memmap across sessions
+######################################################
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+
+from lib import CACHE_DIR
+
+
+DEFAULT_GRID_CACHE_BYTES = int(float(os.environ.get('PYROMSGUI_GRID_CACHE_GB', 2)) * 2**30)
+SAMPLE_BYTES = 2**20  # read from each end of the grid file for its fingerprint
+
+
+class GridCache(object):
+    """
+    Products derived from grid files, kept on local disk between
+    sessions: one directory per grid, named after a fingerprint of the
+    file (size, mtime and a digest of its first and last megabyte, so
+    hashing does not read a whole grid), with one .npy file per product
+    served through read-only np.memmap. Reopening a domain then maps
+    its coordinates, metrics, KD-trees and z levels instead of reading
+    and rebuilding them. A changed grid file gets a new directory; the
+    least recently used grids are deleted when the cache grows beyond
+    max_bytes, and invalidate drops them explicitly.
+    Usage: cache = GridCache()
+           grid = RomsGrid(grd, ncfile, cache=cache)
+           key = cache.key('roms_grd.nc')
+           h = cache.get_or_build(key, 'h', lambda: grd.variables['h'][:])
+    """
+    FORMAT = 1
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_GRID_CACHE_BYTES):
+        self.directory = directory or os.path.join(CACHE_DIR, 'grids')
+        self.max_bytes = max_bytes
+        self.keys = {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.RLock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # kept up to date by put and evict, the directory is only listed here
+        self.nbytes = sum(size for mtime, size, key in self.grids())
+
+    def key(self, filename):
+        """Fingerprint of a grid file as it is on disk right now"""
+        stat = os.stat(filename)
+        memo = (os.path.realpath(filename), stat.st_size, stat.st_mtime)
+        try:
+            return self.keys[memo]
+        except KeyError:
+            pass
+        digest = hashlib.sha1(("%d|%d|%r|" % (self.FORMAT, stat.st_size,
+                                              stat.st_mtime)).encode('utf-8'))
+        with open(filename, 'rb') as fobj:
+            digest.update(fobj.read(SAMPLE_BYTES))
+            if stat.st_size > SAMPLE_BYTES:
+                fobj.seek(max(stat.st_size - SAMPLE_BYTES, SAMPLE_BYTES))
+                digest.update(fobj.read(SAMPLE_BYTES))
+        key = self.keys[memo] = digest.hexdigest()[:24]
+        self.touch(key)
+        return key
+
+    def touch(self, key):
+        """Marks the products of a grid as recently used"""
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        os.utime(path, None)
+
+    def filename(self, key, name):
+        return os.path.join(self.directory, key, "%s.npy" % name)
+
+    def get(self, key, name):
+        """Read-only memmap of a product, or None"""
+        try:
+            arr = np.load(self.filename(key, name), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arr
+
+    def put(self, key, name, arr):
+        """Stores a product (a plain array) and returns its memmap"""
+        filename = self.filename(key, name)
+        if not os.path.isdir(os.path.dirname(filename)): # evicted meanwhile
+            self.touch(key)
+        tmpname = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+        with open(tmpname, 'wb') as fobj:
+            np.save(fobj, np.ascontiguousarray(arr))
+        self.replace(tmpname, filename) # readers never see partial files
+        with self.lock:
+            if self.nbytes > self.max_bytes:
+                self.evict(self.max_bytes * 0.9, keep=key)
+        return np.load(filename, mmap_mode='r')
+
+    def replace(self, tmpname, filename):
+        """Renames a new product file over filename, counting its bytes"""
+        with self.lock:
+            try:
+                self.nbytes -= os.path.getsize(filename)
+            except OSError: # a new product
+                pass
+            os.rename(tmpname, filename)
+            self.nbytes += os.path.getsize(filename)
+
+    def get_or_build(self, key, name, builder):
+        """The cached product, calling builder() to compute it on a miss"""
+        arr = self.get(key, name)
+        if arr is None:
+            arr = self.put(key, name, builder())
+        return arr
+
+    def get_or_build_list(self, key, name, builder):
+        """Like get_or_build, for a product made of a list of arrays"""
+        count = self.get(key, name + '_count')
+        if count is not None:
+            arrays = [self.get(key, "%s_%d" % (name, n)) for n in range(int(count[0]))]
+            if all(arr is not None for arr in arrays):
+                return arrays
+        arrays = [self.put(key, "%s_%d" % (name, n), arr) for n, arr in enumerate(builder())]
+        self.put(key, name + '_count', np.array([len(arrays)]))
+        return arrays
+
+    def get_tree(self, key, name):
+        """
+        A cKDTree restored from its stored state, or None. The tree
+        arrays stay memmapped; the state layout belongs to scipy, so its
+        version is part of the product name.
+        """
+        name = self.tree_name(name)
+        try:
+            with open(os.path.join(self.directory, key, "%s.json" % name)) as fobj:
+                state = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        for n, item in enumerate(state):
+            if item == 'array':
+                state[n] = self.get(key, "%s_%d" % (name, n))
+                if state[n] is None:
+                    return None
+        tree = cKDTree.__new__(cKDTree)
+        try:
+            tree.__setstate__(tuple(state))
+        except (TypeError, ValueError):
+            return None
+        self.hits += 1
+        return tree
+
+    def put_tree(self, key, name, tree):
+        """Stores the state of a cKDTree, see get_tree"""
+        name = self.tree_name(name)
+        state = []
+        for n, item in enumerate(tree.__getstate__()):
+            if isinstance(item, np.ndarray):
+                self.put(key, "%s_%d" % (name, n), item)
+                state.append('array')
+            else:
+                state.append(item)
+        path = os.path.join(self.directory, key, "%s.json" % name)
+        tmpname = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpname, 'w') as fobj:
+            json.dump(state, fobj)
+        self.replace(tmpname, path)
+
+    @staticmethod
+    def tree_name(name):
+        return "%s_tree_scipy%s" % (name, scipy.__version__.replace('.', '_'))
+
+    def grids(self):
+        """(mtime, size, key) of every cached grid"""
+        out = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            try:
+                mtime = os.stat(path).st_mtime
+                size = sum(os.path.getsize(os.path.join(path, name))
+                           for name in os.listdir(path))
+            except OSError: # removed by another process
+                continue
+            out.append( (mtime, size, key) )
+        return out
+
+    def total_bytes(self):
+        return self.nbytes
+
+    def evict(self, target, keep=None):
+        """Deletes least recently used grids until the cache holds target bytes"""
+        with self.lock:
+            grids = sorted(self.grids())
+            total = sum(size for mtime, size, key in grids)
+            for mtime, size, key in grids:
+                if total <= target:
+                    break
+                if key == keep:
+                    continue
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                total -= size
+                self.evictions += 1
+            self.nbytes = total # also catches up with other processes
+
+    def invalidate(self, filename=None):
+        """Drops the products of a grid file, or of all grids"""
+        with self.lock:
+            if filename is None:
+                keys = [key for mtime, size, key in self.grids()]
+            else:
+                keys = [self.key(filename)]
+            for key in keys:
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            self.keys.clear()
+            self.nbytes = sum(size for mtime, size, key in self.grids())
+
+    def stats(self):
+        return dict(directory=self.directory, grids=len(self.grids()),
+                    nbytes=self.total_bytes(), max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __repr__(self):
+        return ("GridCache(%(directory)s, %(grids)d grids, %(nbytes)d/%(max_bytes)d bytes, "
+                "%(hits)d hits, %(misses)d misses)" % self.stats())
@@ -1,72 +1,516 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numpy as np
+import netCDF4 as nc
+from scipy.spatial import cKDTree
+import scipy.sparse as sparse
+
+
+# (u, v) pairs drawn as velocity vectors
+VECTORS = [('u_eastward', 'v_northward'), ('ubar_eastward', 'vbar_northward'),
+           ('u', 'v'), ('ubar', 'vbar'), ('sustr', 'svstr')]
+
+try:
+    string_types = basestring
+except NameError: # python 3
+    string_types = str
 
+# persistent caches (time indexes, metadata...) live here
+CACHE_DIR = os.environ.get('PYROMSGUI_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'pyromsgui'))
+
+# netCDF4/HDF5 reads are not thread-safe: reads that may run while a
+# worker thread is also reading must hold this lock
+NC_LOCK = threading.RLock()
+
+
+class TimeAxis(object):
+    """
+    Time axis of a ROMS file, converted once to numpy datetime64 with
+    vectorized operations. labels are the strings shown in the time
+    combobox, and index() maps a label back to its record in O(1).
+    Units whose origin the fast path cannot parse, and calendars other
+    than the standard ones (noleap, 360_day...), go through
+    netCDF4.num2date: the labels then follow the calendar of the file,
+    and dates (used for plotting) count the elapsed time from the
+    origin on the proleptic Gregorian calendar.
+    Usage: taxis = TimeAxis(ncfile.variables['ocean_time'])
+           tindex = taxis.index(taxis.labels[10])
+    """
+    SCALE = dict(seconds=1, second=1, minutes=60, minute=60,
+                 hours=3600, hour=3600, days=86400, day=86400)
+    CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+    def __init__(self, nctime):
+        self.units = nctime.units
+        self.calendar = str(getattr(nctime, 'calendar', 'standard')).lower()
+        units = self.units.split()
+        self.values = np.atleast_1d(np.ma.getdata(nctime[:])).astype(np.float64)
+        seconds = np.round(self.values * self.SCALE[units[0].lower()])
+        try:
+            if self.calendar not in self.CALENDARS:
+                raise ValueError(self.calendar)
+            self.origin = parse_origin(units[units.index('since') + 1:])
+            fields = None
+        except ValueError:
+            fields = nc.num2date(self.values, self.units, self.calendar)
+            origin = nc.num2date(0., self.units, self.calendar)
+            self.origin = np.datetime64(origin.strftime('%Y-%m-%dT%H:%M:%S'), 's')
+        self.dates = self.origin + seconds.astype('timedelta64[s]')
+
+        # minutes are only shown when there are sub-hourly records
+        if fields is not None:
+            subhourly = any(date.minute or date.second for date in fields)
+            fmt = '%Y-%m-%d  %H:%M' if subhourly else '%Y-%m-%d  %H h'
+            self.labels = [date.strftime(fmt) for date in fields]
+        elif np.any(self.dates.astype('datetime64[h]') != self.dates):
+            iso = np.datetime_as_string(self.dates, unit='m')
+            self.labels = [s[:10] + '  ' + s[11:] for s in iso]
+        else:
+            iso = np.datetime_as_string(self.dates, unit='h')
+            self.labels = [s[:10] + '  ' + s[11:] + ' h' for s in iso]
+        self.lookup = dict( (label, ind) for ind, label in enumerate(self.labels) )
+
+    def __len__(self):
+        return self.values.size
+
+    def index(self, label):
+        """Record index of a time label"""
+        return self.lookup[label]
+
+
+def parse_origin(tokens):
+    """
+    datetime64 of the origin of CF time units, given as the tokens
+    after 'since' ('2000-01-01', '00:00:00' or '2000-01-01T00:00:00Z'),
+    a ValueError when they are not zero padded ISO dates
+    """
+    origin = " ".join(tokens[:2]).rstrip('Z').replace('T', ' ').split()
+    if len(origin) == 1:
+        origin.append('00:00:00')
+    return np.datetime64("%sT%s" % tuple(origin[:2]), 's')
 
-ROMSVARS = dict(his = dict( axes      = ['ocean_time',
-                                         's_rho', 
-                                         'eta_rho', 
-                                         'xi_rho'] ,
-
-                            variables = ['zeta',
-                                         'ubar_eastward',
-                                         'vbar_northward',
-                                         'u_eastward',
-                                         'v_northward',
-                                         'temp',
-                                         'salt']           ), 
-
-                 rst = dict( axes     = ['ocean_time', 
-                                         's_rho', 
-                                         'eta_rho', 
-                                         'xi_rho', 
-                                         'eta_u', 
-                                         'xi_u', 
-                                         'eta_v', 
-                                         'xi_v'] ,
-
-                             variables = ['zeta',
-                                          'ubar',
-                                          'vbar',
-                                          'u',
-                                          'v',
-                                          'temp',
-                                          'salt']          ),
-
-                 clim= dict( axes     = ['ocean_time', 
-                                         's_rho', 
-                                         'eta_rho', 
-                                         'xi_rho', 
-                                         'eta_u', 
-                                         'xi_u', 
-                                         'eta_v', 
-                                         'xi_v'] ,
-
-                             variables = ['zeta',
-                                          'ubar',
-                                          'vbar',
-                                          'u',
-                                          'v',
-                                          'temp',
-                                          'salt']          )
-
-               )
 
 class RomsGrid(object):
     """ 
-    Stores and manipulates netcdf ROMS grid file information
-    """
-    def __init__(self,filename):
-        self.filename = filename    
-        self.ncfile = nc.Dataset(filename, mode='r+')
-        self.lonr  = self.ncfile.variables['lon_rho'][:]
-        self.latr  = self.ncfile.variables['lat_rho'][:]
-        self.lonu  = self.ncfile.variables['lon_u'][:]
-        self.latu  = self.ncfile.variables['lat_u'][:]
-        self.lonv  = self.ncfile.variables['lon_v'][:]
-        self.latv  = self.ncfile.variables['lat_v'][:]
-        self.h     = self.ncfile.variables['h'][:]
-        self.maskr = self.ncfile.variables['mask_rho'][:]
-        self.masku = self.ncfile.variables['mask_u'][:]
-        self.maskv = self.ncfile.variables['mask_v'][:]     
+    Stores and manipulates netcdf ROMS grid file information.
+    Coordinates, masks and h are read from the grid file on first use
+    only, the vertical stretching parameters once from the history
+    file (ncfile). Grid indexes and the float32 z_rho/z_w fields of each
+    time step are computed lazily and memoized, so every section and
+    profile shares the same geometry. The boolean land points of each
+    point type are derived from the masks once (see land/mask_land).
+    With a cache (gridcache.GridCache), the fields read from the grid
+    file and the products derived from them (KD-trees, metrics, z at
+    rest...) are kept on disk across sessions, see cached.
+    Usage: grid = RomsGrid(grd, ncfile)
+           grid.lonr, grid.maskr, grid.index('u')
+           z = grid.z_rho(tindex)  -> shape (N, M, L)
+    """
+    FIELDS = dict(lonr='lon_rho', latr='lat_rho', lonu='lon_u', latu='lat_u',
+                  lonv='lon_v', latv='lat_v', h='h', maskr='mask_rho',
+                  masku='mask_u', maskv='mask_v', angle='angle', pm='pm', pn='pn')
+    SHORT = dict(rho='r', u='u', v='v')
+
+    def __init__(self, grd, ncfile=None, max_zfields=4, cache=None):
+        if isinstance(grd, string_types):
+            from ncio import RomsDataset
+            grd = RomsDataset(grd)
+        self.grd = grd
+        self.ncfile = ncfile if ncfile is not None else grd
+        self.filename = getattr(grd, 'filename', None)
+        self.key = getattr(grd, 'key', self.filename)
+        self.indexes = {}
+        self.lands = {}
+        self.zfields = OrderedDict()
+        self.max_zfields = max_zfields
+        self.cache = cache
+        self.cache_key = None
+        if cache is not None and self.filename is not None:
+            self.cache_key = cache.key(self.filename)
+        self.read_vertical()
+
+    def __getattr__(self, name):
+        # lon/lat/mask/h are read the first time they are needed
+        if name not in self.FIELDS:
+            raise AttributeError(name)
+        def read():
+            with NC_LOCK:
+                return self.grd.variables[self.FIELDS[name]][:]
+        value = self.cached(self.FIELDS[name], read)
+        setattr(self, name, value)
+        return value
+
+    def cached(self, name, builder, many=False):
+        """
+        Product name of the grid from the persistent cache, calling
+        builder() on a miss (or every time without a cache). With many,
+        the product is a list of arrays.
+        """
+        if self.cache_key is None:
+            return builder()
+        if many:
+            return self.cache.get_or_build_list(self.cache_key, name, builder)
+        return self.cache.get_or_build(self.cache_key, name, builder)
+
+    def set_fields(self, **fields):
+        """Sets fields read elsewhere (e.g. lonr=lon), keeping them in the cache"""
+        for name, value in fields.items():
+            if self.cache_key is not None:
+                cached = self.cache.get(self.cache_key, self.FIELDS[name])
+                if cached is None:
+                    cached = self.cache.put(self.cache_key, self.FIELDS[name], value)
+                value = cached
+            setattr(self, name, value)
+
+    def read_vertical(self):
+        """Vertical coordinate parameters (s-levels, stretching, hc)"""
+        variables = self.ncfile.variables
+        def read(name, default=None):
+            try:
+                with NC_LOCK:
+                    return np.ma.getdata(variables[name][:])
+            except KeyError:
+                return default
+
+        self.Vtransform = int(read('Vtransform', 1))
+        self.theta_s, self.theta_b = read('theta_s'), read('theta_b')
+        self.hc = read('hc')
+        self.Cs_r, self.Cs_w = read('Cs_r'), read('Cs_w')
+        self.N = self.Cs_r.size if self.Cs_r is not None else 0
+        self.s_rho = read('s_rho')
+        if self.s_rho is None and self.N:
+            self.s_rho = ( np.arange(1, self.N + 1) - self.N - 0.5 ) / self.N
+        self.s_w = read('s_w')
+        if self.s_w is None and self.N:
+            self.s_w = ( np.arange(self.N + 1) - self.N ) / float(self.N)
+        if self.Cs_w is None and self.N: # interpolated between the rho levels
+            self.Cs_w = np.interp(self.s_w, np.r_[-1, self.s_rho, 0],
+                                  np.r_[-1, self.Cs_r, 0])
+
+    def lon(self, grid='rho'):
+        return getattr(self, 'lon' + self.SHORT[grid])
+
+    def lat(self, grid='rho'):
+        return getattr(self, 'lat' + self.SHORT[grid])
+
+    def mask(self, grid='rho'):
+        return getattr(self, 'mask' + self.SHORT[grid])
+
+    def land(self, grid='rho'):
+        """Boolean land points of a point type (rho, u, v), None without a mask"""
+        try:
+            return self.lands[grid]
+        except KeyError:
+            pass
+        try:
+            mask = self.mask(grid)
+        except (KeyError, AttributeError): # grid file without this mask
+            mask = None
+        self.lands[grid] = None if mask is None else np.asarray(mask) == 0
+        return self.lands[grid]
+
+    def index(self, grid='rho'):
+        """GridIndex of a point type (rho, u, v), built on first use"""
+        try:
+            return self.indexes[grid]
+        except KeyError:
+            pass
+        tree = None
+        if self.cache_key is not None:
+            tree = self.cache.get_tree(self.cache_key, 'index_' + grid)
+        index = GridIndex(self.lon(grid), self.lat(grid), tree=tree)
+        if tree is None and self.cache_key is not None:
+            self.cache.put_tree(self.cache_key, 'index_' + grid, index.tree)
+        self.indexes[grid] = index
+        return index
+
+    def rotation(self):
+        """float32 cos and sin of the grid angle at rho points, None without angle"""
+        try:
+            return self.cos_sin
+        except AttributeError:
+            pass
+        try:
+            angle = np.asarray(self.angle, dtype=np.float32)
+            self.cos_sin = np.cos(angle), np.sin(angle)
+        except (KeyError, AttributeError): # grid file without angle
+            self.cos_sin = None
+        return self.cos_sin
+
+    def metrics(self):
+        """
+        pm, pn (1/dx, 1/dy in 1/m) at rho points, from the grid file or
+        estimated from lon/lat when it has none
+        """
+        try:
+            return self.pmpn
+        except AttributeError:
+            pass
+        try:
+            pm, pn = self.pm, self.pn
+        except (KeyError, AttributeError):
+            pm, pn = self.cached('metrics', lambda: np.array(grid_metrics(self.lonr, self.latr),
+                                                             dtype=np.float32))
+        self.pmpn = np.asarray(pm, dtype=np.float32), np.asarray(pn, dtype=np.float32)
+        return self.pmpn
+
+    def spacing(self, grid='rho'):
+        """Mean grid spacing of a point type, in degrees"""
+        def mean_spacing():
+            lon, lat = self.lon(grid), self.lat(grid)
+            return np.array([ ( np.gradient(lon, axis=1).mean() +
+                                np.gradient(lat, axis=0).mean() ) / 2 ])
+        return float(self.cached('spacing_' + grid, mean_spacing)[0])
+
+    def h_at(self, grid='rho'):
+        """Bathymetry on the points of a grid type (rho, u, v)"""
+        try:
+            return self.hgrid[grid]
+        except AttributeError:
+            self.hgrid = {}
+        except KeyError:
+            pass
+        self.hgrid[grid] = rho2grid(np.asarray(self.h), grid)
+        return self.hgrid[grid]
+
+    def zlev(self, h, zeta=0., w=False, k=None):
+        """
+        Depths of the rho (or w) levels for h and zeta of any shape,
+        or of level k only
+        """
+        Cs, s = (self.Cs_w, self.s_w) if w else (self.Cs_r, self.s_rho)
+        if k is not None:
+            return get_zlev(h, Cs[k:k+1], self.hc, s[k:k+1], ssh=zeta,
+                            Vtransform=self.Vtransform)[0]
+        return get_zlev(h, Cs, self.hc, s, ssh=zeta, Vtransform=self.Vtransform)
+
+    def z_rest(self, w=False):
+        """
+        float32 depths (N, M, L) of the rho (or w) levels for zeta = 0.
+        With zeta, both vertical transforms give
+        z = z_rest + zeta * (1 + z_rest / h).
+        """
+        Cs, s = (self.Cs_w, self.s_w) if w else (self.Cs_r, self.s_rho)
+        params = "%r|%r|%s|%s" % (self.Vtransform, float(self.hc), np.asarray(Cs).tolist(),
+                                  np.asarray(s).tolist())
+        name = "z_rest_%s_%s" % ('w' if w else 'rho',
+                                 hashlib.sha1(params.encode('utf-8')).hexdigest()[:12])
+        return self.cached(name, lambda: self.zlev(np.asarray(self.h, dtype=np.float32),
+                                                   w=w).astype(np.float32))
+
+    def z_rho(self, tindex=None):
+        """float32 depths of the rho points at time record tindex"""
+        return self.zfield(tindex, w=False)
+
+    def z_w(self, tindex=None):
+        """float32 depths of the w points at time record tindex"""
+        return self.zfield(tindex, w=True)
+
+    def zfield(self, tindex, w):
+        key = (tindex, w)
+        try:
+            z = self.zfields.pop(key)
+        except KeyError:
+            z = self.z_rest(w)
+            if tindex is not None and 'zeta' in self.ncfile.variables:
+                with NC_LOCK: # diagnostics files have no free surface
+                    zeta = np.asarray(self.ncfile.variables['zeta'][tindex],
+                                      dtype=np.float32)
+                zeta[np.isnan(zeta)] = 0
+                h = np.asarray(self.h, dtype=np.float32)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    z = z + zeta * (1 + z / h)
+            while len(self.zfields) >= self.max_zfields:
+                self.zfields.popitem(last=False)
+        self.zfields[key] = z
+        return z
+
+
+def uv2rho(u, v):
+    """
+    Averages u (..., M, L-1) and v (..., M-1, L) to the rho points
+    (..., M, L). Boundary points without two neighbours are NaN.
+    """
+    shape = v.shape[:-2] + (u.shape[-2], v.shape[-1])
+    ur = np.full(shape, np.nan, dtype=np.float32)
+    vr = np.full(shape, np.nan, dtype=np.float32)
+    ur[..., 1:-1] = 0.5 * (u[..., :-1] + u[..., 1:])
+    vr[..., 1:-1, :] = 0.5 * (v[..., :-1, :] + v[..., 1:, :])
+    return ur, vr
+
+
+def rho_vectors(u, v, rotation=None):
+    """
+    Eastward and northward components on the rho points of a vector
+    field: staggered u/v (ROMS u, v, ubar, vbar...) are averaged to rho
+    and rotated by the grid angle, given as (cos, sin) (see
+    RomsGrid.rotation); u_eastward/v_northward-like pairs, already on
+    the rho points, are returned as float32.
+    Usage: ue, vn = rho_vectors(ncfile.variables['u'][0, -1],
+                                ncfile.variables['v'][0, -1], grid.rotation())
+    """
+    if u.shape == v.shape:
+        return np.asarray(u, dtype=np.float32), np.asarray(v, dtype=np.float32)
+    u, v = uv2rho(u, v)
+    if rotation is None:
+        return u, v
+    cos, sin = rotation
+    return u * cos - v * sin, u * sin + v * cos
+
+
+def vector_pairs(variables):
+    """(u, v) names of the vector fields among variables, eastward ones first"""
+    return [pair for pair in VECTORS if pair[0] in variables and pair[1] in variables]
+
+
+def grid_metrics(lon, lat, radius=6371e3):
+    """pm, pn (1/dx, 1/dy in 1/m) of a lon/lat grid, from centred differences"""
+    lon, lat = np.radians(lon), np.radians(lat)
+    coslat = np.cos(lat)
+    dx = radius * np.hypot(np.gradient(lon, axis=1) * coslat, np.gradient(lat, axis=1))
+    dy = radius * np.hypot(np.gradient(lon, axis=0) * coslat, np.gradient(lat, axis=0))
+    return 1. / dx, 1. / dy
+
+
+def rho2grid(arr, grid):
+    """Averages a field on rho points to u or v points (last two axes)"""
+    if grid == 'u':
+        return 0.5 * (arr[..., :-1] + arr[..., 1:])
+    if grid == 'v':
+        return 0.5 * (arr[..., :-1, :] + arr[..., 1:, :])
+    return arr
+
+
+def zslice(var, grid, tindex, depth, max_bytes=64*2**20, report=None):
+    """
+    Horizontal slice of a 3D ROMS variable at a fixed depth (m, negative
+    downwards) and time record tindex, linearly interpolated between the
+    s-levels. The grid is streamed in blocks of rows sized to max_bytes
+    (whole on-disk chunks when the budget holds at least one chunk row,
+    parts of them otherwise) and each block is swept from the bottom
+    up, reading the levels that share a chunk at once, so neither the
+    3D field nor its z ever sit in memory at once. Every chunk is then
+    decompressed once per block it overlaps: exactly once when the
+    budget holds a chunk row.
+    Points deeper than the bottom level are NaN, shallower than the top
+    level take the top value. Variables on w levels (s_w) are
+    interpolated between the w depths; without zeta in the file (e.g.
+    diagnostics files) the free surface is taken as flat. Rho point
+    variables of a grid with a cache take their depths from the cached
+    z at rest (see RomsGrid.z_rest) instead of recomputing them.
+    If a dict is given as report, it gets the elapsed time, number of
+    blocks and the largest working set of a block, in bytes.
+    Usage: sst = zslice(ncfile.variables['temp'], RomsGrid(grd, ncfile),
+                        tindex, -100.)
+    """
+    start = time.time()
+    gridtype = var.dimensions[-1].split('_')[-1]
+    nlev, M, L = var.shape[1:]
+    h = grid.h_at(gridtype)
+    w = var.dimensions[1] == 's_w'
+    variables = grid.ncfile.variables
+    zeta = variables['zeta'] if 'zeta' in variables else None
+    zrest = None
+    if gridtype == 'rho' and getattr(grid, 'cache_key', None) is not None:
+        zrest = grid.z_rest(w)
+
+    chunks = getattr(var, 'chunks', None)
+    nk = min(chunks[1], nlev) if chunks else 1  # levels read together
+    # ~10 float32 2D work arrays and the nk levels of var
+    rows = min(M, max(1, max_bytes // ((10 + nk) * L * 4)))
+    if chunks and chunks[-2] <= rows < M:
+        rows = rows // chunks[-2] * chunks[-2]
+    out = np.empty((M, L), dtype=np.float32)
+    peak, nblocks = 0, 0
+
+    for j0 in range(0, M, rows):
+        j1 = min(j0 + rows, M)
+        # v points sit between two rho rows
+        extra = 1 if gridtype == 'v' else 0
+        hblock = h[j0:j1].astype(np.float32)
+        if zeta is None:
+            zblock = np.zeros(hblock.shape, dtype=np.float32)
+        else:
+            zblock = np.asarray(zeta[tindex, j0:j1 + extra, :], dtype=np.float32)
+            zblock[np.isnan(zblock)] = 0
+            zblock = rho2grid(zblock, gridtype)
+
+        field = np.full(hblock.shape, np.nan, dtype=np.float32)
+        if zrest is not None:
+            with np.errstate(divide='ignore'):
+                stretch = zblock / hblock
+        zprev = vprev = None
+        for k in range(nlev):
+            if zrest is None:
+                zk = grid.zlev(hblock, zblock, w=w, k=k).astype(np.float32)
+            else:
+                zk = zrest[k, j0:j1] * (1 + stretch) + zblock
+            if k % nk == 0:
+                levels = np.asarray(var[tindex, k:k + nk, j0:j1, :], dtype=np.float32)
+            vk = levels[k % nk]
+            if zprev is not None:
+                crossing = (zprev <= depth) & (depth < zk)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    weight = (depth - zprev[crossing]) / (zk[crossing] - zprev[crossing])
+                field[crossing] = vprev[crossing] + weight * (vk[crossing] - vprev[crossing])
+            zprev, vprev = zk, vk
+        above = depth >= zprev
+        field[above] = vprev[above]
+        out[j0:j1] = field
+
+        peak = max(peak, (10 + nk) * field.nbytes)
+        nblocks += 1
+
+    if report is not None:
+        report.update(seconds=time.time() - start, blocks=nblocks,
+                      peak_bytes=peak + out.nbytes, rows_per_block=rows)
+    return out
+
+
+def hslice(var, grid, tindex, level='surface'):
+    """
+    Horizontal slice of varname at time record tindex: 2D fields as they
+    are, 3D ones at the 'surface', 'bottom' or interpolated at a depth
+    (m, negative downwards), with NaN on land and fill values. Shared
+    by the GUI and the batch renderer.
+    Usage: arr = hslice(ncfile.variables['temp'], grid, tindex, -100.)
+    """
+    if len(var.dimensions) != 4:
+        arr = var[tindex, ...]
+    elif level == 'surface':
+        arr = var[tindex, -1, ...]
+    elif level == 'bottom':
+        arr = var[tindex, 0, ...]
+    else:
+        arr = zslice(var, grid, tindex, level)
+    return mask_land(arr, grid, var.dimensions[-1].split('_')[-1])
+
+
+def mask_land(arr, grid, gridtype='rho'):
+    """
+    Sets the land points of grid (see RomsGrid.land) to NaN in a float
+    field shaped (..., M, L), in place, and returns it. Fields that do
+    not match the grid are returned as they are.
+    """
+    land = grid.land(gridtype) if grid is not None else None
+    if land is None or np.ndim(arr) < 2 or arr.shape[-2:] != land.shape or \
+       arr.dtype.kind != 'f':
+        return arr
+    arr[..., land] = np.nan
+    return arr
+
+
+def parse_level(level):
+    """'surface', 'bottom' or a depth (m, negative downwards) from a string"""
+    level = str(level).strip().lower()
+    if level in ('surface', 'bottom'):
+        return level
+    return -abs(float(level))
 
 
 def near2d(x, y, x0, y0):
@@ -79,11 +523,280 @@ def near2d(x, y, x0, y0):
     dy = np.abs(y - y0); dy = dy / dy.max()
     dn = dx + dy    
     fn = np.where(dn == dn.min())
-    line = int(fn[0])
-    col  = int(fn[1])
+    line = int(fn[0][0])
+    col  = int(fn[1][0])
     return line, col
 
 
+class GridIndex(object):
+    """
+    KD-tree spatial index over the points of a (curvilinear) grid.
+    Build it once per grid and point type (rho/u/v) and use it to
+    answer batched nearest-point queries in one vectorized call.
+    The (line, col) pairs returned are the ones near2d would pick.
+    Usage: index = GridIndex(lon, lat)
+           lines, cols = index.query(xs, ys)
+    """
+    def __init__(self, x, y, candidates=8, tree=None):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.shape = x.shape
+        self.x, self.y = x.ravel(), y.ravel()
+        self.xmin, self.xmax = self.x.min(), self.x.max()
+        self.ymin, self.ymax = self.y.min(), self.y.max()
+        # the tree works on coordinates scaled by the grid extent, which is
+        # close to the normalization near2d does for each query point
+        self.xscale = (self.xmax - self.xmin) or 1.
+        self.yscale = (self.ymax - self.ymin) or 1.
+        self.candidates = min(candidates, self.x.size)
+        if tree is not None: # e.g. from a GridCache
+            self.tree = tree
+            return
+        self.tree = cKDTree(np.column_stack((self.x / self.xscale,
+                                             self.y / self.yscale)))
+
+    def query(self, x0, y0):
+        """
+        Returns the (lines, cols) index arrays of the grid points
+        nearest to each (x0, y0) pair
+        """
+        x0 = np.atleast_1d(np.asarray(x0, dtype=np.float64)).ravel()
+        y0 = np.atleast_1d(np.asarray(y0, dtype=np.float64)).ravel()
+        pts = np.column_stack((x0 / self.xscale, y0 / self.yscale))
+        dist, cand = self.tree.query(pts, k=self.candidates, p=1)
+        cand = cand.reshape(x0.size, -1)
+        dist = dist.reshape(x0.size, -1)
+
+        # re-rank the candidates with the exact near2d metric: dx and dy
+        # are normalized by their maximum over the whole grid
+        dxmax = np.maximum(np.abs(x0 - self.xmin), np.abs(self.xmax - x0))
+        dymax = np.maximum(np.abs(y0 - self.ymin), np.abs(self.ymax - y0))
+        dxmax[dxmax == 0] = 1.
+        dymax[dymax == 0] = 1.
+        best, dnbest = self.rank(cand, x0[:,None], y0[:,None], dxmax[:,None], dymax[:,None])
+
+        # both metrics agree within a factor ratio, so any point nearer
+        # than the best candidate for near2d lies within reach of the
+        # query in the tree. Off the grid, where the normalizations differ
+        # most, the candidates may not cover that ball: all its points
+        # are then ranked.
+        ratio = np.minimum(self.xscale / dxmax, self.yscale / dymax)
+        reach = dnbest / ratio * (1 + 1e-9) + 1e-15
+        if self.candidates < self.x.size:
+            for n in np.nonzero(dist[:,-1] <= reach)[0]:
+                ball = np.array(self.tree.query_ball_point(pts[n], reach[n], p=1))
+                best[n] = self.rank(ball[None], x0[n], y0[n], dxmax[n], dymax[n])[0][0]
+        lines, cols = np.unravel_index(best, self.shape)
+        return lines, cols
+
+    def rank(self, cand, x0, y0, dxmax, dymax):
+        """Best of each row of candidate flat indexes, and its near2d distance"""
+        dn = ( np.abs(self.x[cand] - x0) / dxmax +
+               np.abs(self.y[cand] - y0) / dymax )
+        # ties go to the lowest flat index, as in near2d
+        order = np.lexsort((cand, dn), axis=-1)[:,0]
+        rows = np.arange(cand.shape[0])
+        return cand[rows, order], dn[rows, order]
+
+
+class TransectInterpolator(object):
+    """
+    Bilinear interpolation from a curvilinear grid to a set of transect
+    points. The containing cell and the bilinear weights of every point
+    are computed once and stored as a sparse (npoints x ncells) matrix,
+    so the same transect can be interpolated for any variable and time
+    record of that grid with one sparse product per level.
+    Only the grid cells touched by the transect (lines, cols) have to be
+    read from the files.
+    Usage: tr = TransectInterpolator(lon, lat, xs, ys, index=GridIndex(lon, lat))
+           values = extract_points(var, tr.lines, tr.cols, (tindex, slice(None)))
+           vsec = tr.interpolate(values)  -> shape (nlev, npoints)
+    """
+    def __init__(self, lon, lat, xs, ys, index=None):
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        xs = np.atleast_1d(np.asarray(xs, dtype=np.float64)).ravel()
+        ys = np.atleast_1d(np.asarray(ys, dtype=np.float64)).ravel()
+        M, L = lon.shape
+        if index is None:
+            index = GridIndex(lon, lat)
+
+        # the nearest grid point is a corner of the 4 candidate cells,
+        # identified here by their lower-left corner (j0, i0)
+        near_j, near_i = index.query(xs, ys)
+        dj = np.array([-1, -1, 0, 0])
+        di = np.array([-1, 0, -1, 0])
+        j0 = np.clip(near_j[:,None] + dj, 0, max(M - 2, 0))
+        i0 = np.clip(near_i[:,None] + di, 0, max(L - 2, 0))
+        j1, i1 = np.minimum(j0 + 1, M - 1), np.minimum(i0 + 1, L - 1)
+
+        s, t = inverse_bilinear(lon[j0, i0], lon[j0, i1], lon[j1, i0], lon[j1, i1],
+                                lat[j0, i0], lat[j0, i1], lat[j1, i0], lat[j1, i1],
+                                xs[:,None], ys[:,None])
+
+        # keep the candidate cell that contains the point, or the one
+        # it is the closest to when it falls outside the grid
+        outside = ( np.maximum(-s, 0) + np.maximum(s - 1, 0) +
+                    np.maximum(-t, 0) + np.maximum(t - 1, 0) )
+        outside[~np.isfinite(outside)] = np.inf
+        best = np.argmin(outside, axis=1)
+        rows = np.arange(xs.size)
+        j0, i0, j1, i1 = j0[rows, best], i0[rows, best], j1[rows, best], i1[rows, best]
+        s = np.clip(s[rows, best], 0, 1)
+        t = np.clip(t[rows, best], 0, 1)
+        s[~np.isfinite(s)] = 0.
+        t[~np.isfinite(t)] = 0.
+
+        corners_j = np.column_stack((j0, j0, j1, j1)).ravel()
+        corners_i = np.column_stack((i0, i1, i0, i1)).ravel()
+        weights = np.column_stack(( (1-s)*(1-t), s*(1-t), (1-s)*t, s*t )).ravel()
+
+        # compact the columns of the matrix to the cells actually used
+        cells, inverse = np.unique(corners_j * L + corners_i, return_inverse=True)
+        self.lines, self.cols = np.unravel_index(cells, (M, L))
+        self.weights = sparse.csr_matrix(
+            (weights, (rows.repeat(4), inverse.ravel())),
+            shape=(xs.size, cells.size))
+        self.xs, self.ys = xs, ys
+
+    def interpolate(self, values, fill_value=1e37):
+        """
+        Interpolates values at the transect cells (lines, cols), shaped
+        (..., ncells), to the transect points -> (..., npoints).
+        Weights of dry/missing corners (NaN or > 1e20) are dropped and the
+        remaining ones renormalized; points with no wet corner get
+        fill_value.
+        """
+        values = np.ma.getdata(values)
+        shape = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1]).T
+        wet = np.isfinite(values) & (np.abs(values) < 1e20)
+        num = self.weights.dot( np.where(wet, values, 0.) )
+        den = self.weights.dot( wet.astype(np.float64) )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(den > 1e-12, num / den, fill_value)
+        return out.T.reshape(shape + (self.xs.size,))
+
+
+def inverse_bilinear(x00, x01, x10, x11, y00, y01, y10, y11, x, y, niter=8):
+    """
+    Local coordinates (s, t) of the points (x, y) inside the quadrilateral
+    cells with corners (x00, y00) ... (x11, y11), where s runs along the
+    columns (xi) and t along the lines (eta). Solved with vectorized Newton
+    iterations; s and t are in [0, 1] for points inside the cell.
+    """
+    s = np.full(np.broadcast(x00, x).shape, 0.5)
+    t = s.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for it in range(niter):
+            fx = (1-s)*(1-t)*x00 + s*(1-t)*x01 + (1-s)*t*x10 + s*t*x11 - x
+            fy = (1-s)*(1-t)*y00 + s*(1-t)*y01 + (1-s)*t*y10 + s*t*y11 - y
+            dxds = (1-t)*(x01 - x00) + t*(x11 - x10)
+            dxdt = (1-s)*(x10 - x00) + s*(x11 - x01)
+            dyds = (1-t)*(y01 - y00) + t*(y11 - y10)
+            dydt = (1-s)*(y10 - y00) + s*(y11 - y01)
+            det = dxds * dydt - dxdt * dyds
+            s = s - ( fx * dydt - fy * dxdt) / det
+            t = t - (-fx * dyds + fy * dxds) / det
+    return s, t
+
+
+def extract_points(var, lines, cols, prefix=(), max_bytes=64*2**20):
+    """
+    Extract the values of a netcdf variable at a list of (line, col)
+    points of its last two dimensions, e.g. the columns of a vertical
+    section. Instead of one read per point, the points are grouped into
+    consecutive runs whose bounding hyperslab fits in max_bytes, each run
+    is read once and the points are picked out with numpy indexing.
+    prefix holds the indexes of the leading dimensions.
+    Usage: vsec = extract_points(var, lines, cols, (tindex, slice(None)))
+           -> shape (nlev, npoints)
+    """
+    lines = np.atleast_1d(lines).astype(int)
+    cols = np.atleast_1d(cols).astype(int)
+    prefix = tuple(prefix)
+
+    # number of values read for every (line, col) cell of a hyperslab
+    ncells = 1
+    for ind, n in zip(prefix, var.shape[:len(prefix)]):
+        if isinstance(ind, slice):
+            ncells *= len(range(*ind.indices(n)))
+    itemsize = np.dtype(var.dtype).itemsize
+    max_cells = max(max_bytes // (itemsize * ncells), 1)
+
+    blocks = []
+    for start, stop in point_runs(lines, cols, max_cells):
+        l, c = lines[start:stop], cols[start:stop]
+        j0, i0 = l.min(), c.min()
+        hslab = var[prefix + (slice(j0, l.max() + 1), slice(i0, c.max() + 1))]
+        blocks.append( np.ma.getdata(hslab)[..., l - j0, c - i0] )
+
+    return np.concatenate(blocks, axis=-1)
+
+
+def point_series(var, line, col, k=None, records=None):
+    """
+    Time series of a variable at grid point (line, col) as a single
+    strided read (split along the on-disk chunks by LazyVariable), not
+    one read per record. For 4D variables k selects a level, or the
+    whole column when None. records is a (start, stop) pair, all by
+    default.
+    Usage: ts = point_series(ncfile.variables['zeta'], j, i)  -> (ntimes,)
+           col = point_series(ncfile.variables['temp'], j, i) -> (ntimes, N)
+    """
+    times = slice(*records) if records is not None else slice(None)
+    if len(var.dimensions) == 4:
+        level = slice(None) if k is None else k
+        return var[times, level, line, col]
+    return var[times, line, col]
+
+
+def transect_series(var, lines, cols, k=-1, records=None, max_bytes=64*2**20):
+    """
+    Hovmoller array (ntimes, npoints) of a variable along a list of grid
+    points, at level k for 4D variables. The records are read in blocks
+    whose bounding hyperslab of the whole transect fits in max_bytes, so
+    each chunk is decompressed once per block instead of once per point.
+    Usage: hov = transect_series(ncfile.variables['temp'], tr.lines, tr.cols)
+    """
+    lines = np.atleast_1d(lines).astype(int)
+    cols = np.atleast_1d(cols).astype(int)
+    t0, t1 = records if records is not None else (0, var.shape[0])
+    cells = (lines.max() - lines.min() + 1) * (cols.max() - cols.min() + 1)
+    step = max(1, max_bytes // (cells * np.dtype(var.dtype).itemsize))
+    level = (k,) if len(var.dimensions) == 4 else ()
+
+    blocks = []
+    for start in range(t0, t1, step):
+        prefix = (slice(start, min(start + step, t1)),) + level
+        blocks.append( extract_points(var, lines, cols, prefix, max_bytes) )
+    return np.concatenate(blocks, axis=0)
+
+
+def point_runs(lines, cols, max_cells):
+    """
+    Split a sequence of (line, col) points into consecutive runs whose
+    bounding box has at most max_cells cells (or a single point).
+    Returns a list of (start, stop) pairs.
+    """
+    runs, start = [], 0
+    jmin = jmax = lines[0]
+    imin = imax = cols[0]
+    for ind in range(1, lines.size):
+        j, i = lines[ind], cols[ind]
+        nj0, nj1 = min(jmin, j), max(jmax, j)
+        ni0, ni1 = min(imin, i), max(imax, i)
+        if (nj1 - nj0 + 1) * (ni1 - ni0 + 1) > max_cells:
+            runs.append( (start, ind) )
+            start = ind
+            jmin = jmax = j
+            imin = imax = i
+        else:
+            jmin, jmax, imin, imax = nj0, nj1, ni0, ni1
+    runs.append( (start, lines.size) )
+    return runs
+
+
 def get_zlev(h, sigma, hc, sc, ssh=0., Vtransform=2):
     if Vtransform == 1: # ROMS 1999
         hinv = 1./h
@@ -0,0 +1,208 @@
+######################################################
+## Metadata of ROMS files: dimensions, staggering,
+## chunking, compression and attributes of every
+## variable, scanned once per file and cached on disk
+######################################################
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import netCDF4 as nc
+
+from lib import NC_LOCK, CACHE_DIR
+
+
+METADATA_FORMAT = 1
+TIME_NAMES = ('ocean_time', 'time')
+VERTICAL = dict(s_rho='rho', s_w='w')
+COMPRESSORS = ('zlib', 'szip', 'zstd', 'bzip2', 'blosc')
+# ROMS output types, from the 'type' global attribute
+FILETYPES = [('history', 'his'), ('averages', 'avg'), ('diagnostics', 'dia'),
+             ('restart', 'rst'), ('quicksave', 'qck'), ('station', 'sta'),
+             ('float', 'flt'), ('grid', 'grd'), ('initial', 'ini'),
+             ('climatology', 'clm'), ('forcing', 'frc'), ('boundary', 'bry')]
+
+
+class FileMetadata(object):
+    """
+    Everything the viewer needs to know about a netcdf file before
+    reading any data: global attributes, dimensions and, for every
+    variable, its dimensions, shape, dtype, point type (rho, u, v, psi),
+    vertical levels (rho or w), chunking, compression, attributes and
+    the read strategy of LazyVariable (see read_strategy). Scanned once
+    per file and cached as JSON in CACHE_DIR/metadata, keyed by path,
+    size and mtime, so reopening a run does not crawl its files again.
+    Usage: meta = FileMetadata.load('ocean_avg.nc')
+           meta.filetype, meta.fields(), meta.variables['temp']['strategy']
+    """
+    def __init__(self, info):
+        self.info = info
+        self.attributes = info['attributes']
+        self.dimensions = info['dimensions']
+        self.variables = info['variables']
+
+    @classmethod
+    def load(cls, filename, dataset=None, cachedir=None):
+        """
+        Metadata of filename, from the cache when it is up to date, or
+        scanned from dataset (an open netCDF4.Dataset of filename, opened
+        here when not given) and cached
+        """
+        cachefile = cache_filename(filename, cachedir)
+        stamp = file_stamp(filename)
+        try:
+            with open(cachefile) as fobj:
+                info = json.load(fobj, object_pairs_hook=OrderedDict)
+            if info['stamp'] == stamp:
+                return cls(info)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        if dataset is None:
+            with NC_LOCK:
+                dataset = nc.Dataset(filename)
+                try:
+                    info = scan_dataset(dataset)
+                finally:
+                    dataset.close()
+        else:
+            info = scan_dataset(dataset)
+        info['stamp'] = stamp
+        save_json(cachefile, info)
+        return cls(info)
+
+    @property
+    def filetype(self):
+        """his, avg, dia, rst... from the type attribute, or None"""
+        text = str(self.attributes.get('type', '')).lower()
+        for word, short in FILETYPES:
+            if word in text:
+                return short
+        return None
+
+    @property
+    def time_name(self):
+        """Name of the time variable, or None"""
+        for name in TIME_NAMES:
+            if name in self.variables:
+                return name
+        return None
+
+    def fields(self):
+        """
+        Names of the variables that can be shown as maps: time dependent
+        fields on rho, u or v points, 2D or on s-levels, in file order
+        """
+        out = []
+        for name, var in self.variables.items():
+            dims = var['dimensions']
+            if not var['time'] or var['grid'] not in ('rho', 'u', 'v'):
+                continue
+            if len(dims) == 3 or (len(dims) == 4 and var['vertical'] is not None):
+                out.append(name)
+        return out
+
+    def __repr__(self):
+        return "FileMetadata(%s, %d variables, %d fields)" % (self.filetype,
+                                                            len(self.variables),
+                                                            len(self.fields()))
+
+
+def scan_dataset(dataset):
+    """Metadata (a JSON-able dict) of an open netCDF4.Dataset"""
+    attributes = OrderedDict( (name, json_value(dataset.getncattr(name)))
+                              for name in dataset.ncattrs() )
+    dimensions = OrderedDict( (name, [len(dim), dim.isunlimited()])
+                              for name, dim in dataset.dimensions.items() )
+    variables = OrderedDict( (name, scan_variable(var))
+                             for name, var in dataset.variables.items() )
+    return OrderedDict(format=METADATA_FORMAT, attributes=attributes,
+                       dimensions=dimensions, variables=variables)
+
+
+def scan_variable(var):
+    """Metadata (a JSON-able dict) of a netCDF4.Variable"""
+    dtype = np.dtype(var.dtype)
+    attrs = OrderedDict( (name, json_value(var.getncattr(name))) for name in var.ncattrs() )
+    try:
+        chunking = var.chunking()
+    except (AttributeError, RuntimeError): # netcdf3 files
+        chunking = 'contiguous'
+    chunks = None if chunking in ('contiguous', None) else [int(c) for c in chunking]
+    try:
+        filters = var.filters() or {}
+    except (AttributeError, RuntimeError):
+        filters = {}
+    compression = OrderedDict( (key, json_value(value)) for key, value
+                               in sorted(filters.items()) if value )
+
+    fill_value = attrs.get('_FillValue')
+    if fill_value is None and dtype.kind in 'fiu':
+        fill_value = json_value(nc.default_fillvals.get(dtype.str[1:]))
+    dims = var.dimensions
+    return OrderedDict(dimensions=list(dims), shape=[int(n) for n in var.shape],
+                       dtype=dtype.str, grid=staggering(dims),
+                       vertical=VERTICAL.get(dims[1]) if len(dims) == 4 else None,
+                       time=dims[:1] in [(name,) for name in TIME_NAMES],
+                       chunks=chunks, compression=compression, fill_value=fill_value,
+                       packed='scale_factor' in attrs or 'add_offset' in attrs,
+                       strategy=read_strategy(chunks, compression), attributes=attrs)
+
+
+def staggering(dimensions):
+    """Point type (rho, u, v, psi) of the last two dimensions, or None"""
+    if len(dimensions) < 2:
+        return None
+    eta, xi = dimensions[-2:]
+    if eta.startswith('eta_') and xi.startswith('xi_') and eta[4:] == xi[3:]:
+        return eta[4:]
+    return None
+
+
+def read_strategy(chunks, compression):
+    """
+    How LazyVariable reads a variable:
+    'contiguous': no chunks, read_plan aligns its blocks to records;
+    'chunked': uncompressed chunks, read_plan aligns its blocks to them;
+    'compressed': like chunked, and also the only variables kept
+    decompressed in the disk cache, where there is one.
+    """
+    if chunks is None:
+        return 'contiguous'
+    if any(compression.get(name) for name in COMPRESSORS):
+        return 'compressed'
+    return 'chunked'
+
+
+def json_value(value):
+    """An attribute value as plain python (str, number or list of them)"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (np.ndarray, np.generic)):
+        return np.asarray(value).tolist()
+    return value
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return "%d|%d|%r" % (METADATA_FORMAT, stat.st_size, stat.st_mtime)
+
+
+def cache_filename(filename, cachedir=None):
+    path = os.path.realpath(filename)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:24]
+    return os.path.join(cachedir or os.path.join(CACHE_DIR, 'metadata'),
+                        "%s.json" % digest)
+
+
+def save_json(cachefile, info):
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        with open(tmpfile, 'w') as fobj:
+            json.dump(info, fobj)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError): # scanned again next time
+        pass
@@ -0,0 +1,642 @@
+######################################################
+## Lazy, chunk-aware access to ROMS netcdf files
+######################################################
+import os
+import glob
+import json
+import bisect
+import itertools
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+import netCDF4 as nc
+
+from lib import NC_LOCK, CACHE_DIR, string_types
+from metadata import FileMetadata, scan_variable
+
+
+DEFAULT_READ_BYTES = 64 * 2**20
+MAX_TIMEINDEX_FILES = 20000  # entries kept in CACHE_DIR/timeindex.json
+
+
+class RomsDataset(object):
+    """
+    Thin lazy wrapper over a netCDF4.Dataset. Opening it only reads the
+    metadata; its variables are LazyVariables that read nothing until
+    they are indexed, and then only the requested hyperslab, in blocks
+    aligned to the on-disk chunks. Global attributes (e.g. ncfile.type)
+    are available as attributes, like on the netCDF4.Dataset.
+    The metadata of the file (metadata.FileMetadata) is scanned once
+    and cached, and tells every variable how to read itself.
+    With a disk_cache (diskcache.DiskCache), the records of compressed
+    variables are also kept decompressed on local disk and served from
+    there later on. Its key (see file_key) names what is read from it
+    in the caches, so a rewritten file does not serve stale slices.
+    Usage: ncfile = RomsDataset('ocean_his.nc')
+           temp = ncfile.variables['temp']      # nothing read yet
+           sst = temp[0, -1, ...]
+    """
+    def __init__(self, filename, max_bytes=DEFAULT_READ_BYTES, disk_cache=None):
+        self.filename = filename
+        self.key = file_key(filename)
+        if disk_cache is not None:
+            disk_cache.forget(filename)
+        with NC_LOCK:
+            self.nc = nc.Dataset(filename)
+            self.metadata = FileMetadata.load(filename, self.nc)
+            self.dimensions = OrderedDict( (name, size) for name, (size, unlimited)
+                                           in self.metadata.dimensions.items() )
+            info = self.metadata.variables
+            self.variables = OrderedDict( (name, LazyVariable(var, max_bytes, disk_cache,
+                                                              filename, info[name]))
+                                          for name, var in self.nc.variables.items() )
+
+    def __getattr__(self, name):
+        if name == 'nc': # not opened yet
+            raise AttributeError(name)
+        with NC_LOCK:
+            return getattr(self.nc, name)
+
+    def close(self):
+        with NC_LOCK:
+            self.nc.close()
+
+    def __repr__(self):
+        return "RomsDataset(%r)" % self.filename
+
+
+class MultiFileDataset(object):
+    """
+    Virtual dataset stitching ROMS history files along ocean_time, e.g.
+    one ocean_his_*.nc per day. A (file, local record) index of the
+    whole time axis is built once and kept on disk, keyed by path, size
+    and mtime of every file, so reopening a run only scans new files.
+    Files are put in the order of their first time, and overlapping
+    records (restarts, daily files repeating the boundary record) are
+    taken from the later file, see TimeIndex.
+    Files are opened lazily through a bounded pool of handles; variables
+    without the time dimension come from the first file.
+    Usage: ncfile = MultiFileDataset('/ops/hindcast/roms/ocean_his_*.nc')
+           sst = ncfile.variables['temp'][300, -1, ...]
+    """
+    def __init__(self, paths, max_open=8, max_bytes=DEFAULT_READ_BYTES, disk_cache=None):
+        self.paths = expand_paths(paths)
+        if not self.paths:
+            raise IOError("No netcdf files found in %s" % paths)
+        self.filename = self.paths[0]
+        self.pool = HandlePool(max_open, max_bytes, disk_cache)
+
+        # the first file also serves the variables without time dimension
+        template = self.pool.get(self.paths[0], pin=True)
+        self.metadata = template.metadata
+        self.timename = time_dimension(template)
+        self.units = template.variables[self.timename].units
+        self.time_index = TimeIndex(self.paths, self.timename, self.units)
+        self.paths = self.time_index.paths
+        self.key = tuple(file_key(path) for path in self.paths)
+
+        self.dimensions = OrderedDict(template.dimensions)
+        self.dimensions[self.timename] = self.time_index.size
+        self.variables = OrderedDict()
+        for name, var in template.variables.items():
+            if var.dimensions[:1] == (self.timename,):
+                self.variables[name] = AggregatedVariable(self, var)
+            else:
+                self.variables[name] = var
+
+    def __getattr__(self, name):
+        if name in ('pool', 'paths'): # not opened yet
+            raise AttributeError(name)
+        return getattr(self.pool.get(self.paths[0]), name)
+
+    def close(self):
+        self.pool.close()
+
+    def __repr__(self):
+        return "MultiFileDataset(%s ... %s, %d files)" % (self.paths[0],
+                                                        self.paths[-1],
+                                                        len(self.paths))
+
+
+class AggregatedVariable(object):
+    """
+    A variable with ocean_time as first dimension, spanning all the files
+    of a MultiFileDataset. Indexing maps the time records to
+    (file, local record) and reads each file's run of records at once.
+    """
+    def __init__(self, dataset, template):
+        self.dataset = dataset
+        self.template = template
+        self.name = template.name
+        self.dimensions = template.dimensions
+        self.dtype = template.dtype
+        self.chunks = template.chunks
+        self.shape = (dataset.time_index.size,) + template.shape[1:]
+        self.ndim = len(self.shape)
+
+    def __getattr__(self, name):
+        if name == 'template':
+            raise AttributeError(name)
+        return getattr(self.template, name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.name == self.dataset.timename:
+            # times were converted to the units of the first file
+            return self.dataset.time_index.times[index]
+
+        if not isinstance(index, tuple):
+            index = (index,)
+        normalized = normalize_index(index, self.shape)
+        if normalized is None:
+            records = np.arange(self.shape[0])[index[0]]
+            rest = index[1:]
+            squeeze = np.ndim(records) == 0
+        else:
+            tind, rest = normalized[0], tuple(normalized[1:])
+            squeeze = isinstance(tind, int)
+            if squeeze:
+                records = np.array([tind])
+            else:
+                records = np.arange(tind.start, tind.stop, tind.step)
+
+        blocks = []
+        for path, local in self.dataset.time_index.runs(np.atleast_1d(records)):
+            step = local[1] - local[0] if local.size > 1 else 1
+            if step > 0 and np.all(np.diff(local) == step):
+                tsel = slice(local[0], local[-1] + 1, step)
+            else:
+                tsel = local
+            # other threads may need more handles than the pool keeps
+            # open while this one reads
+            with self.dataset.pool.borrow(path) as handle:
+                blocks.append( handle.variables[self.name][(tsel,) + tuple(rest)] )
+        out = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        return out[0] if squeeze else out
+
+    def __repr__(self):
+        return "AggregatedVariable(%s%s, %d files)" % (self.name, self.shape,
+                                                     len(self.dataset.paths))
+
+
+class TimeIndex(object):
+    """
+    Global time axis of a set of files: times (in the given units),
+    and the file and local record of every global record. paths are
+    sorted by their first time, and the global times only increase: a
+    file starting before the end of the previous ones (a restart, or
+    daily files repeating the boundary record) replaces their records
+    from its first time on, and records out of order within a file are
+    skipped. dropped counts the records left out. The times of each
+    file are cached in CACHE_DIR/timeindex.json, keyed by path, size and
+    mtime.
+    """
+    def __init__(self, paths, timename, units, cachefile=None):
+        self.cachefile = cachefile or os.path.join(CACHE_DIR, 'timeindex.json')
+        cached = self.load()
+        filetimes = []
+        changed = False
+        for path in paths:
+            stat = os.stat(path)
+            entry = cached.pop(path, None)
+            if ( entry is None or entry['size'] != stat.st_size or
+                 entry['mtime'] != stat.st_mtime or entry['units'] != units ):
+                entry = dict(size=stat.st_size, mtime=stat.st_mtime, units=units,
+                             times=read_times(path, timename, units))
+                changed = True
+            cached[path] = entry # most recently used go to the end
+            filetimes.append(entry['times'])
+        if changed:
+            self.save(cached)
+
+        order = sorted(range(len(paths)), key=lambda n: (filetimes[n][:1] or [np.inf], n))
+        self.paths = [paths[n] for n in order]
+        times, files, local = [], [], []
+        for ifile, n in enumerate(order):
+            ftimes = filetimes[n]
+            if not ftimes:
+                continue
+            cut = bisect.bisect_left(times, ftimes[0])
+            del times[cut:], files[cut:], local[cut:]
+            for record, t in enumerate(ftimes):
+                if times and t <= times[-1]:
+                    continue
+                times.append(t)
+                files.append(ifile)
+                local.append(record)
+        self.dropped = sum(len(ftimes) for ftimes in filetimes) - len(times)
+        self.times = np.array(times, dtype=np.float64)
+        self.files = np.array(files, dtype=int)
+        self.local = np.array(local, dtype=int)
+        self.size = self.times.size
+
+    def runs(self, records):
+        """
+        Splits global record numbers into (path, local records) runs of
+        consecutive records that belong to the same file
+        """
+        files = self.files[records]
+        cuts = np.where(np.diff(files) != 0)[0] + 1
+        out = []
+        for chunk in np.split(np.arange(records.size), cuts):
+            if chunk.size:
+                out.append( (self.paths[files[chunk[0]]], self.local[records[chunk]]) )
+        return out
+
+    def load(self):
+        try:
+            with open(self.cachefile) as fobj:
+                return json.load(fobj, object_pairs_hook=OrderedDict)
+        except (IOError, OSError, ValueError):
+            return OrderedDict()
+
+    def save(self, cached):
+        """Writes the cache, without deleted files and the least recently used"""
+        for path in list(cached)[:-MAX_TIMEINDEX_FILES]:
+            del cached[path]
+        for path in [path for path in cached if not os.path.exists(path)]:
+            del cached[path]
+        try:
+            if not os.path.isdir(os.path.dirname(self.cachefile)):
+                os.makedirs(os.path.dirname(self.cachefile))
+            tmpfile = "%s.%d.tmp" % (self.cachefile, os.getpid())
+            with open(tmpfile, 'w') as fobj:
+                json.dump(cached, fobj)
+            os.rename(tmpfile, self.cachefile)
+        except (IOError, OSError): # the index just gets rebuilt next time
+            pass
+
+
+class HandlePool(object):
+    """
+    Bounded pool of open RomsDatasets: files are opened on first use and
+    the least recently used ones are closed when more than max_open are
+    needed. Pinned files, and borrowed ones while they are being read,
+    are never closed.
+    Usage: with pool.borrow(path) as handle:
+               arr = handle.variables['temp'][0]
+    """
+    def __init__(self, max_open=8, max_bytes=DEFAULT_READ_BYTES, disk_cache=None):
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self.handles = OrderedDict()
+        self.pinned = set()
+        self.users = {}  # path -> number of reads in progress
+
+    def get(self, path, pin=False):
+        with NC_LOCK:
+            try:
+                handle = self.handles.pop(path)
+            except KeyError:
+                handle = RomsDataset(path, self.max_bytes, self.disk_cache)
+                self.evict(self.max_open - 1)
+            self.handles[path] = handle
+            if pin:
+                self.pinned.add(path)
+            return handle
+
+    @contextmanager
+    def borrow(self, path):
+        """The handle of path, kept open until the with block is done"""
+        with NC_LOCK:
+            handle = self.get(path)
+            self.users[path] = self.users.get(path, 0) + 1
+        try:
+            yield handle
+        finally:
+            with NC_LOCK:
+                self.users[path] -= 1
+                if not self.users[path]:
+                    del self.users[path]
+
+    def evict(self, size):
+        """Closes least recently used handles until at most size are open"""
+        for path in list(self.handles):
+            if len(self.handles) <= size:
+                break
+            if path not in self.pinned and path not in self.users:
+                self.handles.pop(path).close()
+
+    def close(self):
+        with NC_LOCK:
+            for handle in self.handles.values():
+                handle.close()
+            self.handles.clear()
+
+
+def open_dataset(paths, **kwargs):
+    """
+    Opens a single ROMS file as a RomsDataset, or a list of files, a glob
+    pattern or a directory of history files as a MultiFileDataset
+    """
+    if isinstance(paths, string_types) and os.path.isfile(paths):
+        return RomsDataset(paths, **kwargs)
+    expanded = expand_paths(paths)
+    if len(expanded) == 1:
+        return RomsDataset(expanded[0], **kwargs)
+    return MultiFileDataset(expanded, **kwargs)
+
+
+def expand_paths(paths):
+    """Sorted list of files from a list, a glob pattern or a directory"""
+    if isinstance(paths, string_types):
+        if os.path.isdir(paths):
+            paths = os.path.join(paths, '*.nc')
+        return sorted(glob.glob(paths))
+    return sorted(paths)
+
+
+def file_key(filename):
+    """
+    Identity of a file as it is on disk right now (path, size, mtime),
+    for caches of what was read from it: a rewritten file gets a new key
+    """
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime)
+
+
+def time_dimension(dataset):
+    """Name of the record (time) dimension of a ROMS file"""
+    for name in ('ocean_time', 'time'):
+        if name in dataset.variables:
+            return name
+    raise KeyError("No time variable in %s" % dataset.filename)
+
+
+def read_times(path, timename, units):
+    """Time values of a file, converted to units if it uses others"""
+    with NC_LOCK:
+        ncfile = nc.Dataset(path)
+        try:
+            var = ncfile.variables[timename]
+            times = np.ma.getdata(var[:]).astype(np.float64)
+            if getattr(var, 'units', units) != units:
+                times = nc.date2num(nc.num2date(times, var.units), units)
+        finally:
+            ncfile.close()
+    return [float(t) for t in np.atleast_1d(times)]
+
+
+class LazyVariable(object):
+    """
+    A netcdf variable that knows its on-disk chunking and reads
+    hyperslabs through a read plan: the request is split along chunk
+    boundaries into blocks of at most max_bytes, so big requests never
+    need temporary copies of the whole slab, and iter_blocks lets
+    consumers stream over a request without materializing it.
+    Floating point variables come back as plain arrays with NaN on fill
+    values, and time dependent fields as float32 (see clean).
+    Compressed time dependent fields can be served from a disk cache:
+    see read_cached. Chunking, fill value and read strategy (see
+    metadata.read_strategy) come from info, the variable's entry of the
+    file metadata (scanned here when not given), like its dimensions and
+    shape. Other attributes (units, _FillValue...) are taken from the
+    netCDF4.Variable.
+    """
+    def __init__(self, var, max_bytes=DEFAULT_READ_BYTES, disk_cache=None, source=None,
+                 info=None):
+        if info is None:
+            info = scan_variable(var)
+        self.var = var
+        self.name = var.name
+        # netCDF4 asks HDF5 for the shape on every access: slow on files
+        # of hundreds of variables
+        self.dimensions = tuple(info['dimensions'])
+        self.shape = tuple(info['shape'])
+        self.ndim = len(self.shape)
+        self.max_bytes = max_bytes
+        self.chunks = tuple(info['chunks']) if info['chunks'] else None
+        self.strategy = info['strategy']
+
+        # floats are read without netCDF4's masked arrays: fill values
+        # become NaN once per block, and time dependent fields are float32.
+        # Packed variables (scale_factor) are left to netCDF4 to unpack.
+        kind = np.dtype(var.dtype).kind
+        self.fill_value = info['fill_value']
+        packed = info['packed']
+        self.nan_fill = kind == 'f' or packed
+        timedep = info['time']
+        if self.nan_fill and timedep and self.ndim >= 2:
+            self.dtype = np.dtype(np.float32)
+        elif packed:
+            self.dtype = np.dtype(np.float64)
+        else:
+            self.dtype = var.dtype
+        if not packed:
+            var.set_auto_mask(False)
+
+        # only the planes of compressed time dependent 2D/3D fields go to
+        # disk: uncompressed ones read as fast from the file itself
+        if disk_cache is not None and self.ndim >= 3 and source is not None and \
+           timedep and kind in 'fiu' and self.strategy == 'compressed':
+            self.disk_cache, self.source = disk_cache, source
+        else:
+            self.disk_cache = None
+
+    def __getattr__(self, name):
+        if name == 'var':
+            raise AttributeError(name)
+        with NC_LOCK:
+            return getattr(self.var, name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def chunk_shape(self):
+        """Chunk shape, or a one-record slab for contiguous variables"""
+        if self.strategy == 'contiguous':
+            return (1,) * min(self.ndim, 1) + self.shape[1:]
+        return self.chunks
+
+    def __getitem__(self, index):
+        normalized = normalize_index(index, self.shape)
+        if normalized is None: # fancy indexing, handled by netCDF4 directly
+            with NC_LOCK:
+                return self.clean(self.var[index])
+        if self.disk_cache is not None:
+            out = self.read_cached(normalized)
+            if out is not None:
+                return out
+
+        # netCDF4 holds a transient copy of every block it reads: blocks of
+        # about 1/8 of the result keep the peak close to the result itself
+        nbytes = int(np.prod(result_shape(normalized))) * self.dtype.itemsize
+        plan = self.read_plan(normalized, min(self.max_bytes, max(nbytes // 8, 1)))
+        if len(plan) == 1:
+            with NC_LOCK:
+                block = self.var[plan[0][0]]
+            return self.clean(block)
+
+        out = np.empty(result_shape(normalized), dtype=self.dtype)
+        for source, dest in plan:
+            with NC_LOCK:
+                block = self.var[source]
+            out[dest] = self.clean(block)
+        return out
+
+    def clean(self, block):
+        """
+        A block as read from the file, as a plain array of self.dtype
+        with fill values, masked values and the > 1e20 values ROMS
+        writes on land (1e37) as NaN. Converted in place when the dtype
+        allows.
+        """
+        if not self.nan_fill:
+            return block
+        if np.ma.isMaskedArray(block): # packed variables
+            block = block.astype(self.dtype).filled(np.nan)
+        else:
+            block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == 0:
+            value = block[()]
+            return np.nan if value > 1e20 or value == self.fill_value else value
+        block[block > 1e20] = np.nan
+        if self.fill_value is not None and self.fill_value <= 1e20: # e.g. -9999
+            block[block == self.fill_value] = np.nan
+        return block
+
+    def read_cached(self, index):
+        """
+        Serves a normalized index from the disk cache, one memmapped 2D
+        plane (last two dimensions) per combination of the leading
+        indexes. Missing planes are read and stored when the request
+        falls in a single record, the one being looked at; requests
+        across records (time series) are only served when all their
+        planes are cached already, otherwise None is returned and they
+        are read from the file.
+        """
+        lead, rest = index[:-2], tuple(index[-2:])
+        ranges = [ [ind] if isinstance(ind, int) else range(ind.start, ind.stop, ind.step)
+                   for ind in lead ]
+        planes = list(itertools.product(*ranges))
+        if not planes: # an empty leading slice, e.g. temp[2:2, ...]
+            return np.empty(result_shape(index), dtype=self.dtype)
+        populate = len(ranges[0]) == 1
+
+        maps = []
+        for plane in planes:
+            arr = self.disk_cache.get(self.source, self.name, plane)
+            if arr is None:
+                if not populate:
+                    return None
+                with NC_LOCK:
+                    block = self.var[plane]
+                arr = self.disk_cache.put(self.source, self.name, plane, self.clean(block))
+            maps.append(arr)
+
+        shape = result_shape(index)
+        data = np.empty(shape, dtype=maps[0].dtype)
+        flat = data.reshape((len(maps),) + result_shape(rest))
+        for n, arr in enumerate(maps):
+            flat[n] = arr[rest]
+        return data
+
+    def iter_blocks(self, index=Ellipsis, max_bytes=None):
+        """
+        Yields (dest, block) pairs covering var[index], where dest is the
+        index of block in the result array, reading one chunk-aligned
+        block at a time.
+        """
+        index = normalize_index(index, self.shape)
+        for source, dest in self.read_plan(index, max_bytes):
+            with NC_LOCK:
+                block = self.var[source]
+            yield dest, self.clean(block)
+
+    def read_plan(self, index, max_bytes=None):
+        """
+        Splits a normalized index (list of int/slice) into chunk-aligned
+        blocks of at most max_bytes. Returns a list of (source, dest)
+        index tuples: var[source] goes to result[dest].
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        chunks = self.chunk_shape
+
+        # block extent along each dimension, a whole number of chunks,
+        # growing the fastest varying dimensions first
+        block = [1] * self.ndim
+        budget = max(max_bytes // np.dtype(self.dtype).itemsize, 1)
+        for dim in reversed(range(self.ndim)):
+            ind = index[dim]
+            if isinstance(ind, int):
+                continue
+            span = ind.stop - ind.start
+            touched = -(-span // chunks[dim]) + 1 # chunks a span can touch
+            nchunks = max(min(touched, budget // chunks[dim]), 1)
+            block[dim] = nchunks * chunks[dim]
+            budget = max(budget // max(min(block[dim], span), 1), 1)
+
+        # source/destination ranges along each dimension, cut at the
+        # block boundaries
+        ranges = []
+        for dim, ind in enumerate(index):
+            if isinstance(ind, int):
+                ranges.append( [(ind, None)] )
+                continue
+            pieces, done, lo = [], 0, ind.start
+            while lo < ind.stop:
+                hi = min((lo // block[dim] + 1) * block[dim], ind.stop)
+                count = len(range(lo, hi, ind.step))
+                pieces.append( (slice(lo, hi, ind.step), slice(done, done + count)) )
+                done += count
+                lo += count * ind.step
+            ranges.append(pieces)
+
+        plan = [((), ())]
+        for dim, pieces in enumerate(ranges):
+            plan = [ (src + (piece[0],), dst + ((piece[1],) if piece[1] is not None else ()))
+                     for src, dst in plan for piece in pieces ]
+        return plan
+
+    def __repr__(self):
+        return "LazyVariable(%s%s, chunks=%s)" % (self.name, self.shape, self.chunks)
+
+
+def normalize_index(index, shape):
+    """
+    Turns a basic numpy index (ints, slices, Ellipsis) into a list with
+    one positive int or slice(start, stop, step) per dimension, or None
+    for anything else (arrays, lists, scalar variables), left to netCDF4.
+    """
+    if not shape: # scalar variables
+        return None
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any(ind is Ellipsis for ind in index):
+        pos = [ind is Ellipsis for ind in index].index(True)
+        fill = (slice(None),) * (len(shape) - len(index) + 1)
+        index = index[:pos] + fill + index[pos + 1:]
+    index = index + (slice(None),) * (len(shape) - len(index))
+    if len(index) > len(shape):
+        raise IndexError("too many indices for variable")
+
+    out = []
+    for ind, n in zip(index, shape):
+        if isinstance(ind, (int, np.integer)):
+            ind = int(ind)
+            if ind < 0:
+                ind += n
+            if not 0 <= ind < n:
+                raise IndexError("index %d out of range" % ind)
+            out.append(ind)
+        elif isinstance(ind, slice):
+            start, stop, step = ind.indices(n)
+            if step < 0:
+                return None
+            stop = max(stop, start)
+            out.append( slice(start, stop, step) )
+        else:
+            return None
+    return out
+
+
+def result_shape(index):
+    """Shape of the array a normalized index selects"""
+    return tuple(len(range(ind.start, ind.stop, ind.step))
+                 for ind in index if isinstance(ind, slice))
@@ -0,0 +1,150 @@
+######################################################
+## Timing instrumentation of the GUI event handlers
+######################################################
+import json
+import time
+import cProfile
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+
+PHASES = ['open', 'read', 'compute', 'draw']
+
+
+class Profiler(object):
+    """
+    Times GUI events and their phases (open, read, compute, draw) and
+    keeps the last maxlen events in a ring buffer. Events nest per
+    thread: a phase is charged to the innermost open event of its
+    thread, so helpers can time their phases without knowing which
+    handler called them. Phases outside of any event are ignored.
+    The events can be dumped as a JSON trace (chrome://tracing format),
+    and a cProfile of the main thread recorded on demand.
+    Usage: with PROFILER.event('OnUpdateHslice', var='temp'):
+               with PROFILER.phase('read'):
+                   arr = var[0, -1]
+           PROFILER.summary()
+    """
+    def __init__(self, maxlen=500):
+        self.events = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.enabled = True
+        self.cprofile = None
+
+    def stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    @contextmanager
+    def event(self, name, **info):
+        if not self.enabled:
+            yield None
+            return
+        record = dict(name=name, start=time.time(), phases=OrderedDict(),
+                      spans=[], thread=threading.current_thread().name, info=info)
+        stack = self.stack()
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            record['total'] = time.time() - record['start']
+            with self.lock:
+                self.events.append(record)
+
+    @contextmanager
+    def phase(self, name):
+        stack = self.stack() if self.enabled else None
+        if not stack:
+            yield
+            return
+        record = stack[-1]
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            record['phases'][name] = record['phases'].get(name, 0.) + elapsed
+            record['spans'].append( (name, start, elapsed) )
+
+    def recent(self, count=None):
+        """Latest events, oldest first"""
+        with self.lock:
+            events = list(self.events)
+        return events[-count:] if count else events
+
+    def summary(self):
+        """
+        Per event name: count, mean and max total seconds and the mean
+        seconds of each phase, as a list of dicts sorted by total time
+        """
+        stats = OrderedDict()
+        for record in self.recent():
+            entry = stats.setdefault(record['name'], dict(name=record['name'], count=0,
+                                                          total=0., max=0., phases={}))
+            entry['count'] += 1
+            entry['total'] += record['total']
+            entry['max'] = max(entry['max'], record['total'])
+            for phase, seconds in record['phases'].items():
+                entry['phases'][phase] = entry['phases'].get(phase, 0.) + seconds
+        out = []
+        for entry in stats.values():
+            count = float(entry['count'])
+            entry['mean'] = entry['total'] / count
+            entry['phases'] = dict( (phase, seconds / count)
+                                    for phase, seconds in entry['phases'].items() )
+            out.append(entry)
+        return sorted(out, key=lambda entry: -entry['total'])
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def trace(self):
+        """
+        The events as a chrome://tracing (Trace Event Format) dict, with
+        an integer tid per thread and its name as metadata
+        """
+        trace, tids = [], {}
+        for record in self.recent():
+            if record['thread'] not in tids:
+                tids[record['thread']] = len(tids)
+                trace.append(dict(pid=0, tid=tids[record['thread']], ph='M',
+                                  name='thread_name', args=dict(name=record['thread'])))
+            common = dict(pid=0, tid=tids[record['thread']], ph='X')
+            trace.append(dict(common, name=record['name'], cat='event',
+                              ts=record['start'] * 1e6, dur=record['total'] * 1e6,
+                              args=dict((k, str(v)) for k, v in record['info'].items())))
+            for phase, start, elapsed in record['spans']:
+                trace.append(dict(common, name=phase, cat='phase',
+                                  ts=start * 1e6, dur=elapsed * 1e6))
+        return dict(traceEvents=trace, displayTimeUnit='ms')
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.trace(), f)
+        return filename
+
+    def start_cprofile(self):
+        """Starts a cProfile of the calling (main) thread"""
+        if self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop_cprofile(self, filename):
+        """Stops the cProfile and writes its stats (pstats format) to filename"""
+        if self.cprofile is None:
+            return None
+        self.cprofile.disable()
+        self.cprofile.dump_stats(filename)
+        self.cprofile = None
+        return filename
+
+
+# shared by the whole application
+PROFILER = Profiler()
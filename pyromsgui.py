@@ -5,8 +5,9 @@
 ## rsoutelino@gmail.com
 ######################################################
 import os
+import re
 import wx
-import datetime as dt
+import threading
 
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as Navbar
@@ -15,15 +16,23 @@ from matplotlib.figure import Figure
 
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
 from matplotlib.path import Path
-import scipy.io as sp
 import netCDF4 as nc
 
 from lib import *
+from cache import SliceCache, Prefetcher
+from diskcache import DiskCache
+from gridcache import GridCache
+from render import LodMesh, QuiverLayer, BlitManager, pyramid_coords
+from coastline import Coastline, CoastlineLayer
+import derived
+from derived import add_derived
+from ncio import RomsDataset, open_dataset
+from stats import field_stats
+from profiling import PROFILER, PHASES
 
 # TO-DO LIST: ====================================================
-#   - correct bug with date selection: somehow the times re-start
-#       every 00z
 #   - need to decide which x-axis to use, lon or lat
 # ================================================================
 
@@ -43,6 +52,9 @@ DEFAULT_VMIN = 0
 DEFAULT_VMAX = 1.5 
 DEFAULT_CMAP = plt.cm.BrBG
 DEFAULT_DEPTH_FOR_LAND = -50
+PREFETCH_RECORDS = 2  # time records prefetched on each side of the selected one
+LEVELS = ['surface', 'bottom', '-10', '-50', '-100', '-200', '-500', '-1000']
+STATISTICS = ['mean', 'std', 'min', 'max', 'p10', 'p50', 'p90']
 
 
 class App(wx.App):
@@ -94,6 +106,15 @@ class Interface(wx.Frame):
         box2.Add(self.time_select, proportion=0, flag=wx.CENTER)
         self.time_select.Bind(wx.EVT_COMBOBOX, self.toolbar.OnUpdateHslice)
 
+        level = wx.StaticText(panel1, label="Level [surface, bottom or depth in m]")
+        box2.Add(level, proportion=0, flag=wx.CENTER)
+        self.level_select = wx.ComboBox(panel1, value='surface', 
+                                        style=wx.TE_PROCESS_ENTER)
+        self.level_select.SetItems(LEVELS)
+        box2.Add(self.level_select, proportion=0, flag=wx.CENTER)
+        self.level_select.Bind(wx.EVT_COMBOBOX, self.toolbar.OnUpdateHslice)
+        self.level_select.Bind(wx.EVT_TEXT_ENTER, self.toolbar.OnUpdateHslice)
+
         # mplpanel content ========================================
         self.mplpanel = SimpleMPLCanvas(mplpanel)
         box3.Add(self.mplpanel.canvas, 1, flag=wx.CENTER) 
@@ -105,6 +126,7 @@ class Interface(wx.Frame):
 
         self.SetSizer(box1)
 
+        self.CreateStatusBar()
         self.InitMenu()
         self.Layout()
         self.Centre()
@@ -131,11 +153,26 @@ class Interface(wx.Frame):
         self.Bind(wx.EVT_MENU, self.toolbar.OnPlotVslice, svf)
 
         menubar.Append(fileMenu, u'&PyRomsGUI')
+
+        toolsMenu = wx.Menu()
+        sts = wx.MenuItem(toolsMenu, wx.ID_ANY, '&Time statistics...\tCtrl+T')
+        toolsMenu.AppendItem(sts)
+        self.Bind(wx.EVT_MENU, self.toolbar.OnStatistics, sts)
+        self.vectors_item = wx.MenuItem(toolsMenu, wx.ID_ANY, '&Velocity vectors\tCtrl+V',
+                                        kind=wx.ITEM_CHECK)
+        toolsMenu.AppendItem(self.vectors_item)
+        self.Bind(wx.EVT_MENU, self.toolbar.OnVectors, self.vectors_item)
+        drv = wx.MenuItem(toolsMenu, wx.ID_ANY, '&Derived variable...\tCtrl+D')
+        toolsMenu.AppendItem(drv)
+        self.Bind(wx.EVT_MENU, self.toolbar.OnDerived, drv)
+        menubar.Append(toolsMenu, u'&Tools')
         self.SetMenuBar(menubar)
 
 
     def OnQuit(self, e):
         """Fecha o programa"""
+        self.toolbar.prefetcher.stop()
+        self.toolbar.close_datasets()
         self.Close()
         self.Destroy()
 
@@ -171,6 +208,20 @@ class MainToolBar(object):
     def __init__(self, parent):
         self.currentDirectory = os.getcwd()
         self.parent = parent
+        self.cache = SliceCache()
+        self.disk_cache = None  # optional local copy of decompressed records
+        try: # grid products kept across sessions
+            self.grid_cache = GridCache()
+        except (IOError, OSError): # no writable cache directory
+            self.grid_cache = None
+        self.prefetcher = Prefetcher(self.cache, on_loaded=lambda key:
+                                     wx.CallAfter(self.OnPrefetched, key))
+        self.loader, self.progress_dialog = None, None
+        self.domain = None  # history and grid files in the cache keys
+        self.meshes, self.current_mesh = {}, None  # one LodMesh per grid type
+        self.blit = None
+        self.coastline, self.coastline_file = None, None  # CoastlineLayer and its file
+        self.vectors, self.quiver = None, None  # (u, v) names and their QuiverLayer
         self.toolbar = parent.CreateToolBar(style=1, id=1,
                                             name="Toolbar")
         self.tools_params ={ 
@@ -180,6 +231,9 @@ class MainToolBar(object):
                         "Load *.mat coastline file [lon / lat poligons]"),
             'plot_vslice': (load_bitmap('save.png'), u"Plot vertical slice",
                         "Plot vertical slice of some variable"),
+            'time_series': (load_bitmap('water.png'), u"Time series / Hovmoller",
+                        "Left click: time series at a point, "
+                        "2 right clicks: Hovmoller along a transect"),
             'settings': (load_bitmap('settings.png'), u"PyRomsGUI settings",
                         "PyRomsGUI configurations"),
             'quit': (load_bitmap('exit.png'), u"Quit",
@@ -196,6 +250,8 @@ class MainToolBar(object):
         self.plot_vslice = self.createTool(self.toolbar, 
                                            self.tools_params['plot_vslice'], 
                                            self.OnPlotVslice)
+        self.createTool(self.toolbar, self.tools_params['time_series'], 
+                        self.OnPlotTimeSeries)
 
         self.toolbar.AddSeparator()
 
@@ -214,24 +270,17 @@ class MainToolBar(object):
 
 
     def OnLoadFile(self, evt):
-        openFileDialog = wx.FileDialog(self.parent, "Open roms netcdf file [*.nc]",
+        # several history files are stitched along ocean_time
+        openFileDialog = wx.FileDialog(self.parent, "Open roms netcdf file(s) [*.nc]",
                                        "/ops/hindcast/roms/", " ",
                                        "netcdf files (*.nc)|*.nc",
-                                       wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+                                       wx.FD_OPEN | wx.FD_FILE_MUST_EXIST | 
+                                       wx.FD_MULTIPLE)
 
         if openFileDialog.ShowModal() == wx.ID_CANCEL:
             return     # the user changed idea...
 
-        filename = openFileDialog.GetPath()
-        self.ncfile = nc.Dataset(filename)
-
-        # this function is intended to return relevant information on the file
-        varlist, axeslist, time = taste_ncfile(self.ncfile)
-
-        timelist = romsTime2string(time)
-        app.frame.var_select.SetItems(varlist)
-        app.frame.time_select.SetItems(timelist)
-        app.frame.time_select.SetValue(timelist[0])
+        filenames = openFileDialog.GetPaths()
 
         # opening ROMS grid
         openFileDialog = wx.FileDialog(self.parent, "Open roms GRID netcdf file [*_grd.nc]",
@@ -243,53 +292,428 @@ class MainToolBar(object):
             return     # the user changed idea...
 
         grdname = openFileDialog.GetPath()
-        self.grd = nc.Dataset(grdname)
-
-        lon = self.grd.variables['lon_rho'][:]
-        lat = self.grd.variables['lat_rho'][:]
-        h   = self.grd.variables['h'][:]
 
+        # the files are read on a worker thread, which reports back
+        # through the On* handlers below
+        if self.loader is not None:
+            self.loader.cancel()
+        self.close_progress()
+        self.progress_dialog = wx.ProgressDialog("Loading ROMS file", 
+                                                 os.path.basename(filenames[0]),
+                                                 maximum=100, parent=self.parent,
+                                                 style=wx.PD_CAN_ABORT | 
+                                                       wx.PD_ELAPSED_TIME)
+        self.loader = FileLoader(self, filenames, grdname)
+        self.loader.start()
+
+
+    def OnLoadProgress(self, loader, value, message):
+        if loader is not self.loader or not self.progress_dialog:
+            return
+        keepgoing = self.progress_dialog.Update(value, message)[0]
+        if not keepgoing:
+            loader.cancel()
+            self.close_progress()
+            app.frame.SetStatusText("Loading cancelled")
+
+
+    def OnFileOpened(self, loader, ncfile, grd, grid, varlist, time_axis):
+        if loader is not self.loader: # superseded by a later load
+            ncfile.close()
+            grd.close()
+            return
+        self.prefetcher.cancel()
+        self.close_datasets()
+        self.filename = ncfile.filename
+        self.ncfile = ncfile
+        self.grd = grd
+        self.grid = grid
+        # slices are masked with the grid, and a rewritten file has a new key
+        self.domain = (ncfile.key, self.grid.key)
+        self.transects = {}
+        for mesh in self.meshes.values():
+            mesh.remove()
+        self.meshes, self.current_mesh = {}, None
+        if self.quiver is not None:
+            self.quiver.remove()
+            self.quiver = None
+        if self.vectors is not None and self.vectors not in vector_pairs(ncfile.variables):
+            self.vectors = None
+            app.frame.vectors_item.Check(False)
+
+        varlist = list(varlist) + add_derived(ncfile, self.grid, self.cache)
+        app.frame.var_select.SetItems(varlist)
+        self.time_axis = time_axis
+        app.frame.time_select.SetItems(time_axis.labels)
+        app.frame.time_select.SetSelection(0)
+
+
+    def close_datasets(self):
+        """
+        Closes the files of the current domain. A read the prefetcher
+        may still be doing on them holds NC_LOCK, so close waits for it
+        and later reads fail (prefetching ignores errors).
+        """
+        for name in ('ncfile', 'grd'):
+            dataset = getattr(self, name, None)
+            if dataset is not None:
+                dataset.close()
+                setattr(self, name, None)
+        self.grid = None
+
+
+    def OnGridLoaded(self, loader, lon, lat, h, preview):
+        if loader is not self.loader:
+            return
+        if not preview:
+            # the grid geometry does not need to read them again
+            self.grid.set_fields(lonr=lon, latr=lat, h=h)
+            lon, lat, h = self.grid.lonr, self.grid.latr, self.grid.h
+            # the coastline was clipped to the box of the previous grid
+            if self.coastline_file is not None and \
+               self.coastline.coastline.bbox != self.grid_bbox():
+                self.load_coastline(self.coastline_file)
+        with PROFILER.event('OnGridLoaded', preview=preview), PROFILER.phase('draw'):
+            self.show_field('preview' if preview else 'rho', h, lon=lon, lat=lat,
+                            cmap=plt.cm.terrain_r)
+        if not preview:
+            preview_mesh = self.meshes.pop('preview', None)
+            if preview_mesh is not None:
+                preview_mesh.remove()
+            self.close_progress()
+            app.frame.SetStatusText("Loaded %s" % self.filename)
+
+
+    def show_field(self, grid, field, lon=None, lat=None, title=None, **kwargs):
+        """
+        Draws field on the map with the LodMesh of its grid type (rho, u, v).
+        The mesh of each grid type is kept between calls: a new field of
+        the same grid only replaces the data and colour limits of the
+        existing artist and is blitted over the static background.
+        lon/lat (re)set the mesh geometry, otherwise it is read from the grid
+        file the first time the grid type is shown.
+        """
         mplpanel = app.frame.mplpanel
         ax = mplpanel.ax
-        self.pcolor = ax.pcolormesh(lon, lat, h, cmap=plt.cm.terrain_r)
-        ax.set_xlim([lon.min(), lon.max()])
-        ax.set_ylim([lat.min(), lat.max()])
+        if self.blit is None:
+            self.blit = BlitManager(mplpanel.canvas, self.dynamic_artists)
+
+        mesh = self.meshes.get(grid)
+        full_draw = mesh is not self.current_mesh
+        if mesh is None or lon is not None:
+            if lon is None:
+                lon, lat = self.grid.lon(grid), self.grid.lat(grid)
+            if mesh is None:
+                mesh = self.meshes[grid] = LodMesh(ax)
+            if self.current_mesh is None:
+                ax.set_xlim([lon.min(), lon.max()])
+                ax.set_ylim([lat.min(), lat.max()])
+            mesh.set_grid(lon, lat, self.lod_coords(grid, lon, lat))
+            full_draw = True
+
+        for other in self.meshes.values():
+            if other is not mesh:
+                other.set_visible(False)
+        mesh.set_visible(True)
+        self.current_mesh = mesh
+
+        full_draw = mesh.set_data(field, **kwargs) or full_draw
+        if title is not None:
+            ax.set_title(title)
         ax.set_aspect('equal')
 
-        mplpanel.canvas.draw()
+        if full_draw:
+            mplpanel.canvas.draw()
+        else:
+            self.blit.update()
+
+
+    def lod_coords(self, grid, lon, lat):
+        """Coordinates of the LodMesh levels of a grid type, from the grid cache"""
+        if grid == 'preview':
+            return None
+        return self.grid.cached('lod_%s' % grid, lambda: pyramid_coords(lon, lat), many=True)
+
+
+    def dynamic_artists(self):
+        """Artists redrawn by the blit manager, in drawing order"""
+        ax = app.frame.mplpanel.ax
+        artists = [self.current_mesh.artist, ax.title] + list(ax.lines)
+        if self.coastline is not None:
+            artists.append(self.coastline.artist)
+        if self.quiver is not None and self.quiver.artist is not None:
+            artists.append(self.quiver.artist)
+        return artists
+
+
+    def OnLoadFailed(self, loader, err):
+        if loader is not self.loader:
+            return
+        self.close_progress()
+        wx.MessageBox("Could not load file:\n%s" % err, "PyRomsGUI",
+                      wx.OK | wx.ICON_ERROR, self.parent)
+
+
+    def close_progress(self):
+        try:
+            self.progress_dialog.Destroy()
+        except (AttributeError, RuntimeError): # none open, or already gone
+            pass
+        self.progress_dialog = None
 
 
     def OnUpdateHslice(self, evt):
         # from IPython import embed; embed()
         varname = app.frame.var_select.GetValue()
         var = self.ncfile.variables[varname]
-        dimensions = var.dimensions
-        grid = dimensions[-1].split('_')[-1]
-        lon = self.grd.variables['lon_'+grid][:]
-        lat = self.grd.variables['lat_'+grid][:]
-
-        # time index
-        varlist, axeslist, time = taste_ncfile(self.ncfile)
+        grid = var.dimensions[-1].split('_')[-1]
+        tindex, timestr = self.selected_time()
+        level = self.selected_level()
+
+        with PROFILER.event('OnUpdateHslice', var=varname, tindex=tindex, level=level):
+            with PROFILER.phase('read'):
+                arr = self.read_hslice(varname, tindex, level)
+            redraw = self.update_vectors(tindex, level)
+
+            title = "%s   %s" %(varname, timestr)
+            if len(var.dimensions) == 4 and level != 'surface':
+                title = "%s @ %s   %s" %(varname, level, timestr)
+            with PROFILER.phase('draw'):
+                self.show_field(grid, arr, title=title, cmap=plt.cm.jet)
+                if redraw:
+                    app.frame.mplpanel.canvas.draw_idle()
+            self.show_cache_stats()
+            self.update_vslice(varname, tindex)
+            self.prefetch_neighbours(varname, tindex, level)
+
+
+    def selected_time(self):
+        """Returns the record index and label of the selected time"""
+        tindex = app.frame.time_select.GetSelection()
         timestr = app.frame.time_select.GetValue()
-        selected_time = string2romsTime(timestr, self.ncfile)
-        # from IPython import embed; embed()
-        tindex = np.where( time[:] == selected_time )[0][0]
+        if tindex == wx.NOT_FOUND: # typed in instead of picked
+            try:
+                tindex = self.time_axis.index(timestr)
+            except KeyError: # not a time of the file
+                tindex = 0
+                app.frame.time_select.SetSelection(tindex)
+                timestr = self.time_axis.labels[tindex]
+        return tindex, timestr
 
-        if len(dimensions) == 3:
-            arr = var[tindex,...]
-        if len(dimensions) == 4:
-            arr = var[tindex,-1,...]
 
-        mplpanel = app.frame.mplpanel
-        ax = mplpanel.ax
-        ax.clear()
-        ax.pcolormesh(lon, lat, arr, cmap=plt.cm.jet)
-        ax.set_xlim([lon.min(), lon.max()])
-        ax.set_ylim([lat.min(), lat.max()])
-        ax.set_title("%s   %s" %(varname, timestr))
-        ax.set_aspect('equal')
+    def selected_level(self):
+        """Returns 'surface', 'bottom' or a depth (m, negative downwards)"""
+        try:
+            return parse_level(app.frame.level_select.GetValue())
+        except ValueError:
+            app.frame.level_select.SetValue('surface')
+            return 'surface'
+
+
+    def hslice_job(self, varname, tindex, level='surface'):
+        """
+        Returns the (cache key, loader) pair of the horizontal slice of
+        varname at time record tindex: 2D fields as they are, 3D ones at
+        the surface, bottom or interpolated at a depth
+        """
+        var = self.ncfile.variables[varname]
+        if len(var.dimensions) != 4:
+            level = None
+        grid = self.grid
+
+        def loader():
+            return hslice(var, grid, tindex, level)
+
+        return (self.domain, varname, tindex, level), loader
 
-        mplpanel.canvas.draw()
+
+    def read_hslice(self, varname, tindex, level='surface'):
+        """
+        Returns the horizontal slice of varname at time record tindex,
+        served from the slice cache when it was read recently
+        """
+        key, loader = self.hslice_job(varname, tindex, level)
+        return self.cache.get_or_load(key, loader)
+
+
+    def prefetch_neighbours(self, varname, tindex, level='surface'):
+        """Queues the records around tindex for background loading"""
+        ntimes = self.ncfile.variables[varname].shape[0]
+        jobs = []
+        for step in range(1, PREFETCH_RECORDS + 1):
+            for neighbour in (tindex + step, tindex - step):
+                if 0 <= neighbour < ntimes:
+                    jobs.append( self.hslice_job(varname, neighbour, level) )
+        self.prefetcher.request(jobs)
+
+
+    def OnPrefetched(self, key):
+        self.show_cache_stats()
+
+
+    def show_cache_stats(self):
+        app.frame.SetStatusText("cache: %(entries)d slices, %(nbytes)d bytes, "
+                                "%(hits)d hits / %(misses)d misses"
+                                % self.cache.stats())
+
+
+    def OnStatistics(self, evt):
+        """
+        Time mean, std, extremes or a percentile of the selected
+        variable and level over a range of records, computed by a pool of
+        processes on a worker thread and shown like any other field
+        """
+        try:
+            varname = app.frame.var_select.GetValue()
+            var = self.ncfile.variables[varname]
+        except (AttributeError, KeyError): # no file or variable yet
+            wx.MessageBox("Load a file and choose a variable first", "PyRomsGUI")
+            return
+        dlg = wx.SingleChoiceDialog(self.parent, "Statistic of %s" % varname,
+                                    "Time statistics", STATISTICS)
+        if dlg.ShowModal() != wx.ID_OK:
+            return
+        stat = dlg.GetStringSelection()
+        ntimes = var.shape[0]
+        dlg = wx.TextEntryDialog(self.parent, "Records [start:stop] out of %d" % ntimes,
+                                 "Time statistics", "0:%d" % ntimes)
+        if dlg.ShowModal() != wx.ID_OK:
+            return
+        try:
+            t0, t1 = [int(r) for r in dlg.GetValue().split(':')]
+            t0, t1 = max(t0, 0), min(t1, ntimes)
+            if t1 <= t0:
+                raise ValueError
+        except ValueError:
+            wx.MessageBox("Records must be given as start:stop", "PyRomsGUI")
+            return
+        level = self.selected_level()
+
+        key = (self.domain, varname, stat, t0, t1, level)
+        if key in self.cache:
+            self.OnStatsDone(key, self.cache.get(key), None)
+            return
+        app.frame.SetStatusText("Computing %s of %s over %d records..." 
+                                % (stat, varname, t1 - t0))
+        files = getattr(self.ncfile, 'paths', self.ncfile.filename)
+        StatsWorker(self, key, files, self.grid.filename).start()
+
+
+    def OnStatsDone(self, key, arr, report):
+        self.cache.put(key, arr)
+        domain, varname, stat, t0, t1, level = key
+        if domain != self.domain:
+            return
+        grid = self.ncfile.variables[varname].dimensions[-1].split('_')[-1]
+        labels = self.time_axis.labels
+        title = "%s %s   %s - %s" % (varname, stat, labels[t0], labels[t1 - 1])
+        if len(self.ncfile.variables[varname].dimensions) == 4 and level != 'surface':
+            title = "%s %s @ %s   %s - %s" % (varname, stat, level, labels[t0], labels[t1 - 1])
+        self.show_field(grid, arr, title=title, cmap=plt.cm.jet)
+        if report is not None:
+            app.frame.SetStatusText("%s of %s: %d records in %.1f s (%.1f records/s)"
+                                    % (stat, varname, report['records'], report['seconds'],
+                                       report['records_per_second']))
+
+
+    def OnStatsFailed(self, err):
+        app.frame.SetStatusText("")
+        wx.MessageBox("Could not compute statistics:\n%s" % err, "PyRomsGUI",
+                      wx.OK | wx.ICON_ERROR, self.parent)
+
+
+    def OnVectors(self, evt):
+        """Toggles the velocity vector overlay of the selected time and level"""
+        if not evt.IsChecked():
+            self.vectors = None
+            if self.quiver is not None:
+                self.quiver.remove()
+                self.quiver = None
+            app.frame.mplpanel.canvas.draw()
+            return
+        try:
+            pairs = vector_pairs(self.ncfile.variables)
+        except AttributeError: # no file yet
+            pairs = []
+        if not pairs:
+            wx.MessageBox("No velocity components (u/v pairs) to draw", "PyRomsGUI")
+            app.frame.vectors_item.Check(False)
+            return
+        pair = pairs[0]
+        if len(pairs) > 1:
+            choices = ["%s / %s" % p for p in pairs]
+            dlg = wx.SingleChoiceDialog(self.parent, "Velocity components",
+                                        "Velocity vectors", choices)
+            if dlg.ShowModal() != wx.ID_OK:
+                app.frame.vectors_item.Check(False)
+                return
+            pair = pairs[dlg.GetSelection()]
+        self.vectors = pair
+        tindex, timestr = self.selected_time()
+        with PROFILER.event('OnVectors', u=pair[0], v=pair[1]):
+            self.update_vectors(tindex, self.selected_level())
+            with PROFILER.phase('draw'):
+                app.frame.mplpanel.canvas.draw()
+
+
+    def OnDerived(self, evt):
+        """
+        Defines a variable as an expression of the variables of the file,
+        e.g. ke = 0.5 * (u**2 + v**2), evaluated on the shown slices only
+        """
+        try:
+            variables = self.ncfile.variables
+        except AttributeError: # no file yet
+            wx.MessageBox("Load a file first", "PyRomsGUI")
+            return
+        dlg = wx.TextEntryDialog(self.parent, "name = expression, with + - * / ** and\n%s"
+                                 % ", ".join(sorted(derived.FUNCTIONS)),
+                                 "Derived variable", "ke = 0.5 * (u**2 + v**2)")
+        if dlg.ShowModal() != wx.ID_OK:
+            return
+        try:
+            name, expression = [part.strip() for part in dlg.GetValue().split('=', 1)]
+            if not re.match(r'^[A-Za-z_]\w*$', name):
+                raise ValueError("%r is not a valid name" % name)
+            if name in variables and not isinstance(variables[name], derived.DerivedVariable):
+                raise ValueError("%s is a variable of the file" % name)
+            derived.register(name, expression)
+            variables.pop(name, None) # redefined
+            if not add_derived(self.ncfile, self.grid, self.cache, names=[name]):
+                raise ValueError("%s cannot be computed from the variables of this file"
+                                 % expression)
+        except ValueError as err:
+            wx.MessageBox("Could not define the variable:\n%s" % err, "PyRomsGUI",
+                          wx.OK | wx.ICON_ERROR, self.parent)
+            return
+        self.cache.clear() # slices of a previous definition
+        items = app.frame.var_select.GetItems()
+        if name not in items:
+            app.frame.var_select.SetItems(items + [name])
+        app.frame.var_select.SetValue(name)
+        self.OnUpdateHslice(None)
+
+
+    def update_vectors(self, tindex, level='surface'):
+        """
+        Updates the velocity vector overlay, if on, to time record tindex
+        and level: u/v are read through the slice cache, averaged to the
+        rho points and rotated by the grid angle. Returns True when the
+        arrows were rebuilt and the canvas needs a full draw.
+        """
+        if self.vectors is None:
+            return False
+        uname, vname = self.vectors
+        with PROFILER.phase('read'):
+            u = self.read_hslice(uname, tindex, level)
+            v = self.read_hslice(vname, tindex, level)
+        with PROFILER.phase('compute'):
+            ue, vn = rho_vectors(u, v, self.grid.rotation())
+        if self.quiver is None:
+            self.quiver = QuiverLayer(app.frame.mplpanel.ax, color='k')
+            self.quiver.set_grid(self.grid.lonr, self.grid.latr,
+                                 self.lod_coords('rho', self.grid.lonr, self.grid.latr))
+        return self.quiver.set_data(ue, vn)
 
 
     def OnLoadCoastline(self, evt):
@@ -302,31 +726,73 @@ class MainToolBar(object):
             return     # the user changed idea...
 
         filename = openFileDialog.GetPath()
-        coast = sp.loadmat(filename)
-        lon, lat = coast['lon'], coast['lat']
-
         mplpanel = app.frame.mplpanel
         ax = mplpanel.ax
-        ax.plot(lon, lat, 'k')
+        with PROFILER.event('OnLoadCoastline'):
+            coast, bbox = self.load_coastline(filename)
 
-        try:
-            ax.set_xlim([self.grd.lonr.min(), self.grd.lonr.max()])
-            ax.set_ylim([self.grd.latr.min(), self.grd.latr.max()])
-        except AttributeError: # just in case a grid was not loaded before
-            ax.set_xlim([np.nanmin(lon), np.nanmax(lon)])
-            ax.set_ylim([np.nanmin(lat), np.nanmax(lat)])
-        
+        x0, x1, y0, y1 = bbox if bbox is not None else coast.extent
+        ax.set_xlim([x0, x1])
+        ax.set_ylim([y0, y1])
         ax.set_aspect('equal')
         mplpanel.canvas.draw()
 
 
+    def load_coastline(self, filename):
+        """
+        Shows the coastline of filename clipped to the box of the current
+        grid (see grid_bbox). Returns the Coastline and the box.
+        """
+        bbox = self.grid_bbox()
+        with PROFILER.phase('read'):
+            # clipped and simplified once, then served from the cache
+            coast = Coastline.load(filename, bbox)
+        if self.coastline is not None:
+            self.coastline.remove()
+        self.coastline = CoastlineLayer(app.frame.mplpanel.ax, coast, color='k')
+        self.coastline_file = filename
+        return coast, bbox
+
+
+    def grid_bbox(self, margin=0.05):
+        """lon/lat box of the grid plus a margin, None before a grid is loaded"""
+        try:
+            lon, lat = self.grid.lonr, self.grid.latr
+        except AttributeError:
+            return None
+        x0, x1, y0, y1 = np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat)
+        dx, dy = margin * (x1 - x0), margin * (y1 - y0)
+        return (x0 - dx, x1 + dx, y0 - dy, y1 + dy)
+
+
     def OnPlotVslice(self, evt):
         mplpanel = app.frame.mplpanel
+        self.disconnect_click()
         self.cid = mplpanel.canvas.mpl_connect('button_press_event', self.vslice)
 
 
+    def OnPlotTimeSeries(self, evt):
+        mplpanel = app.frame.mplpanel
+        self.disconnect_click()
+        self.cid = mplpanel.canvas.mpl_connect('button_press_event', self.timeseries)
+        app.frame.SetStatusText("Left click: time series at a point, "
+                                "2 right clicks: Hovmoller along a transect")
+
+
+    def disconnect_click(self):
+        """Drops the click handler of the previous tool, if any"""
+        try:
+            app.frame.mplpanel.canvas.mpl_disconnect(self.cid)
+        except AttributeError:
+            pass
+
+
     def OnSettings(self, evt):
-        pass
+        try:
+            self.diagnostics.Raise()
+            self.diagnostics.refresh()
+        except (AttributeError, RuntimeError): # not open, or already closed
+            self.diagnostics = DiagnosticsDialog(app.frame, self)
 
 
     def vslice(self, evt):
@@ -356,54 +822,441 @@ class MainToolBar(object):
             # assigning relevant variables
             varname = app.frame.var_select.GetValue()
             var = self.ncfile.variables[varname]
-            dimensions = var.dimensions
-            grid = dimensions[-1].split('_')[-1]
-            lon = self.grd.variables['lon_'+grid][:]
-            lat = self.grd.variables['lat_'+grid][:]
-
-            ts = self.ncfile.variables['theta_s'][:]
-            tb = self.ncfile.variables['theta_b'][:]
-            hc = self.ncfile.variables['hc'][:]
-            nlev = var.shape[1]
-            sc = ( np.arange(1, nlev + 1) - nlev - 0.5 ) / nlev
-            sigma = self.ncfile.variables['Cs_r'][:]
-
-            dl = ( np.gradient(lon)[1].mean() + np.gradient(lat)[0].mean() ) / 2
-            siz = int(np.sqrt( (p1[0] - p2[0])**2 + (p1[1] - p2[1])**2 ) / dl)
-            xs = np.linspace(p1[0], p2[0], siz)
-            ys = np.linspace(p1[1], p2[1], siz)
-
-            # time index
-            varlist, axeslist, time = taste_ncfile(self.ncfile)
-            timestr = app.frame.time_select.GetValue()
-            selected_time = string2romsTime(timestr, self.ncfile)
-            tindex = np.where( time[:] == selected_time )[0][0]
-
-            # getting nearest values
-            hsec, zeta, vsec = [], [], []
-            for ind in range(xs.size):
-                line, col = near2d(lon, lat, xs[ind], ys[ind])
-                vsec.append( var[tindex, :, line, col] )
-                hsec.append( self.grd.variables['h'][line, col] )
-                zeta.append( self.ncfile.variables['zeta'][tindex, line, col] )
-
-            vsec = np.array(vsec).transpose()
-            hsec, zeta = np.array(hsec), np.array(zeta)
-            xs = xs.reshape(1, xs.size).repeat(nlev, axis=0)
-            ys = ys.reshape(1, ys.size).repeat(nlev, axis=0)
-            zsec = get_zlev(hsec, sigma,  5, sc, ssh=zeta, Vtransform=2)
-
-            xs = np.ma.masked_where(vsec > 1e20, xs)
-            ys = np.ma.masked_where(vsec > 1e20, ys)
-            zsec = np.ma.masked_where(vsec > 1e20, zsec)
-            vsec = np.ma.masked_where(vsec > 1e20, vsec)
-            
-            self.vslice_dialog = VsliceDialog(app.frame, xs, ys, zsec, vsec)
+            grid = var.dimensions[-1].split('_')[-1]
+            self.section = self.section_points(p1, p2, grid)
+            # interpolation weights are kept for this transect only
+            self.transects = {}
+
+            tindex, timestr = self.selected_time()
+            with PROFILER.event('vslice', var=varname, tindex=tindex):
+                xs, ys, zsec, vsec = self.compute_vslice(varname, tindex)
+                with PROFILER.phase('draw'):
+                    self.vslice_dialog = VsliceDialog(app.frame, xs, ys, zsec, vsec)
             del self.points, self.area
 
         mplpanel.canvas.draw()
 
 
+    def section_points(self, p1, p2, grid):
+        """Points from p1 to p2, about one grid spacing apart"""
+        dl = self.grid.spacing(grid)
+        siz = max(2, int(np.sqrt( (p1[0] - p2[0])**2 + (p1[1] - p2[1])**2 ) / dl))
+        return ( np.linspace(p1[0], p2[0], siz),
+                 np.linspace(p1[1], p2[1], siz) )
+
+
+    def timeseries(self, evt):
+        """
+        Left click: time series of the selected variable at the nearest
+        grid point (the whole water column vs depth for 3D variables
+        when the level is a depth). Two right clicks: Hovmoller diagram
+        along the transect between them, at the selected level.
+        Each is read with a few bulk reads over all records.
+        """
+        mplpanel = app.frame.mplpanel
+        ax = mplpanel.ax
+        if evt.inaxes != ax: return
+        try:
+            varname = app.frame.var_select.GetValue()
+            var = self.ncfile.variables[varname]
+        except (AttributeError, KeyError): # no file or variable yet
+            return
+        grid = var.dimensions[-1].split('_')[-1]
+        level = self.selected_level()
+        k = {'surface': -1, 'bottom': 0}.get(level)
+        dates = self.time_axis.dates.astype('O')
+        x, y = evt.xdata, evt.ydata
+
+        if evt.button == 1:
+            lines, cols = self.grid.index(grid).query(x, y)
+            j, i = int(lines[0]), int(cols[0])
+            ax.plot(x, y, 'w*', markeredgecolor='k', markersize=12)
+            mplpanel.canvas.draw()
+            title = "%s at %.3f, %.3f" % (varname, self.grid.lon(grid)[j, i], 
+                                          self.grid.lat(grid)[j, i])
+            with PROFILER.event('timeseries', var=varname), PROFILER.phase('read'):
+                values = point_series(var, j, i, k)
+            dialog = TimeSeriesDialog(app.frame, title)
+            if values.ndim == 1:
+                dialog.plot_series(dates, values, varname)
+            else: # water column vs time
+                h = self.grid.h_at(grid)[j, i]
+                # zeta of the rho point at (j, i) is close enough on u/v points
+                if 'zeta' in self.ncfile.variables:
+                    zeta = point_series(self.ncfile.variables['zeta'], j, i)
+                else: # diagnostics files: flat free surface
+                    zeta = np.zeros(values.shape[0])
+                z = self.grid.zlev(np.full(zeta.shape, h), np.nan_to_num(zeta),
+                                   w=var.dimensions[1] == 's_w').T
+                dialog.plot_hovmoller(dates, z, values, 'depth [m]')
+            return
+
+        if evt.button != 3:
+            return
+        if k is None and len(var.dimensions) == 4:
+            app.frame.SetStatusText("Hovmoller diagrams are drawn at the surface "
+                                    "or bottom level only")
+            return
+        p = ax.plot(x, y, 'wo', markeredgecolor='k')
+        try:
+            self.hov_points.append( (x, y) )
+        except AttributeError:
+            self.hov_points = [ (x, y) ]
+        if len(self.hov_points) == 2:
+            p1, p2 = self.hov_points
+            del self.hov_points
+            ax.plot([p1[0], p2[0]], [p1[1], p2[1]], 'k')
+            xs, ys = self.section_points(p1, p2, grid)
+            lines, cols = self.grid.index(grid).query(xs, ys)
+            # consecutive points falling on the same grid point are read once
+            keep = np.r_[True, (np.diff(lines) != 0) | (np.diff(cols) != 0)]
+            lines, cols = lines[keep], cols[keep]
+            with PROFILER.event('hovmoller', var=varname), PROFILER.phase('read'):
+                values = transect_series(var, lines, cols, k)
+            title = "%s Hovmoller, %s" % (varname, level if k is not None else '')
+            dialog = TimeSeriesDialog(app.frame, title)
+            lon = self.grid.lon(grid)[lines, cols]
+            lat = self.grid.lat(grid)[lines, cols]
+            dist = np.r_[0, np.cumsum(111.2 * np.hypot(np.diff(lon) * np.cos(np.radians(lat[1:])),
+                                                       np.diff(lat)))]
+            dialog.plot_hovmoller(dates, dist, values, 'distance along transect [km]',
+                                  along_x=True)
+        mplpanel.canvas.draw()
+
+
+    def transect_interpolator(self, grid):
+        """
+        Returns the TransectInterpolator of the current section for a
+        point type (rho, u, v), reused for every variable and time record
+        """
+        try:
+            return self.transects[grid]
+        except KeyError:
+            xs, ys = self.section
+            self.transects[grid] = TransectInterpolator(self.grid.lon(grid),
+                                                        self.grid.lat(grid),
+                                                        xs, ys,
+                                                        index=self.grid.index(grid))
+            return self.transects[grid]
+
+
+    def compute_vslice(self, varname, tindex):
+        """
+        Interpolates varname at time record tindex onto the current section.
+        Returns xs, ys, zsec, vsec arrays shaped (nlev, npoints), vsec
+        NaN below the bottom and on land
+        """
+        var = self.ncfile.variables[varname]
+        grid = var.dimensions[-1].split('_')[-1]
+
+        nlev = var.shape[1]
+
+        with PROFILER.phase('compute'):
+            tr = self.transect_interpolator(grid)
+            rho = self.transect_interpolator('rho')
+        # only the cells touched by the section are read from the files
+        with PROFILER.phase('read'):
+            vcells = extract_points(var, tr.lines, tr.cols, (tindex, slice(None)))
+            if 'zeta' in self.ncfile.variables:
+                zcells = extract_points(self.ncfile.variables['zeta'],
+                                        rho.lines, rho.cols, (tindex,))
+            else: # diagnostics files: flat free surface
+                zcells = np.zeros(rho.lines.size, dtype=np.float32)
+
+        with PROFILER.phase('compute'):
+            land = self.grid.land(grid)
+            if land is not None:
+                vcells[..., land[tr.lines, tr.cols]] = np.nan
+            vsec = tr.interpolate(vcells, fill_value=np.nan)
+            hsec = rho.interpolate(self.grid.h[rho.lines, rho.cols])
+            zeta = rho.interpolate(zcells, fill_value=0.)
+
+            xs, ys = self.section
+            xs = xs.reshape(1, xs.size).repeat(nlev, axis=0)
+            ys = ys.reshape(1, ys.size).repeat(nlev, axis=0)
+            zsec = self.grid.zlev(hsec, zeta, w=var.dimensions[1] == 's_w')
+        return xs, ys, zsec, vsec
+
+
+    def update_vslice(self, varname, tindex):
+        """Redraws an open vertical slice dialog for a new variable/time"""
+        try:
+            if not self.vslice_dialog.IsShown():
+                return
+        except (AttributeError, RuntimeError): # no dialog, or already closed
+            return
+        if len(self.ncfile.variables[varname].dimensions) != 4:
+            return
+        xs, ys, zsec, vsec = self.compute_vslice(varname, tindex)
+        with PROFILER.phase('draw'):
+            self.vslice_dialog.set_section(xs, ys, zsec, vsec)
+
+
+class FileLoader(threading.Thread):
+    """
+    Opens ROMS file(s) and their grid, and builds the RomsGrid (whose
+    grid cache key reads the grid file), on a worker thread, so the GUI
+    does not freeze on big grids or slow file systems. A coarse preview of the
+    bathymetry is handed over as soon as the metadata is read and the
+    full resolution fields follow, read in row blocks so that cancelling
+    takes effect quickly; a grid already in the grid cache is mapped
+    from it at once instead. Everything is delivered to the toolbar's
+    handlers on the main thread through wx.CallAfter.
+    """
+    PREVIEW_SIZE = 200  # points along the largest preview dimension
+    BLOCK_ROWS = 128
+
+    def __init__(self, toolbar, filenames, grdname):
+        threading.Thread.__init__(self, name="FileLoader")
+        self.daemon = True
+        self.toolbar = toolbar
+        self.filenames, self.grdname = filenames, grdname
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, value, message):
+        wx.CallAfter(self.toolbar.OnLoadProgress, self, value, message)
+
+    def run(self):
+        try:
+            with PROFILER.event('OnLoadFile', files=len(self.filenames)):
+                self.load()
+        except Exception as err:
+            wx.CallAfter(self.toolbar.OnLoadFailed, self, err)
+
+    def load(self):
+        names = ['lon_rho', 'lat_rho', 'h']
+
+        self.progress(0, "Reading metadata")
+        with NC_LOCK, PROFILER.phase('open'):
+            ncfile = open_dataset(self.filenames, disk_cache=self.toolbar.disk_cache)
+            varlist, time = taste_ncfile(ncfile)
+            time_axis = TimeAxis(time)
+            grd = RomsDataset(self.grdname)
+        # the grid cache key reads both ends of the grid file
+        cache = self.toolbar.grid_cache
+        with PROFILER.phase('open'):
+            grid = RomsGrid(grd, ncfile, cache=cache)
+        if self.cancelled.is_set():
+            ncfile.close()
+            grd.close()
+            return
+        wx.CallAfter(self.toolbar.OnFileOpened, self, ncfile, grd, grid,
+                     varlist, time_axis)
+
+        # a grid seen before is mapped from the grid cache at once
+        if grid.cache_key is not None:
+            with PROFILER.phase('read'):
+                fields = [cache.get(grid.cache_key, name) for name in names]
+            if all(field is not None for field in fields):
+                wx.CallAfter(self.toolbar.OnGridLoaded, self, *fields, preview=False)
+                return
+
+        self.progress(10, "Reading grid preview")
+        with NC_LOCK, PROFILER.phase('read'):
+            nrows, ncols = grd.variables['h'].shape
+            step = max(1, max(nrows, ncols) // self.PREVIEW_SIZE)
+            preview = [grd.variables[name][::step, ::step] for name in names]
+        wx.CallAfter(self.toolbar.OnGridLoaded, self, *preview, preview=True)
+
+        blocks = dict( (name, []) for name in names )
+        for j0 in range(0, nrows, self.BLOCK_ROWS):
+            if self.cancelled.is_set():
+                return
+            with NC_LOCK, PROFILER.phase('read'):
+                for name in names:
+                    blocks[name].append( grd.variables[name][j0:j0 + self.BLOCK_ROWS] )
+            done = min(j0 + self.BLOCK_ROWS, nrows)
+            self.progress(10 + 89 * done // nrows, "Reading grid %d/%d rows" % (done, nrows))
+        fields = [np.concatenate(blocks[name]) for name in names]
+        wx.CallAfter(self.toolbar.OnGridLoaded, self, *fields, preview=False)
+
+
+class StatsWorker(threading.Thread):
+    """
+    Runs stats.field_stats on a worker thread (which spreads the records
+    over a process pool) and hands the field over to the toolbar on the
+    main thread
+    """
+    def __init__(self, toolbar, key, files, grdname):
+        threading.Thread.__init__(self, name="StatsWorker")
+        self.daemon = True
+        self.toolbar, self.key = toolbar, key
+        self.files = files
+        self.grdname = grdname
+
+    def run(self):
+        domain, varname, stat, t0, t1, level = self.key
+        report = {}
+        try:
+            if stat.startswith('p'):
+                out = field_stats(self.files, varname, (t0, t1), level, self.grdname,
+                                  stats=(), percentiles=(float(stat[1:]),), report=report)
+            else:
+                out = field_stats(self.files, varname, (t0, t1), level, self.grdname,
+                                  stats=(stat,), report=report)
+        except Exception as err:
+            wx.CallAfter(self.toolbar.OnStatsFailed, err)
+            return
+        wx.CallAfter(self.toolbar.OnStatsDone, self.key, list(out.values())[0], report)
+
+
+class DiagnosticsDialog(wx.Dialog):
+    """
+    Timings of the latest GUI events, split in open/read/compute/draw
+    phases, with a per event summary, the slice cache statistics and
+    buttons to save a JSON trace or record a cProfile
+    """
+    COLUMNS = ['event', 'thread', 'total [ms]'] + ['%s [ms]' % p for p in PHASES]
+
+    def __init__(self, parent, toolbar):
+        wx.Dialog.__init__(self, parent, -1, "PyRomsGUI diagnostics", size=(900,600),
+                           style=wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        self.toolbar = toolbar
+        box = wx.BoxSizer(wx.VERTICAL)
+
+        self.events = wx.ListCtrl(self, style=wx.LC_REPORT)
+        for col, name in enumerate(self.COLUMNS):
+            self.events.InsertColumn(col, name)
+        box.Add(self.events, 3, wx.EXPAND)
+        self.summary = wx.TextCtrl(self, style=wx.TE_MULTILINE | wx.TE_READONLY)
+        box.Add(self.summary, 2, wx.EXPAND)
+
+        buttons = wx.BoxSizer(wx.HORIZONTAL)
+        for label, handler in [("Refresh", self.OnRefresh), ("Clear", self.OnClear),
+                               ("Save JSON trace", self.OnSaveTrace),
+                               ("Start cProfile", self.OnProfile),
+                               ("Clear grid cache", self.OnClearGridCache)]:
+            button = wx.Button(self, label=label)
+            button.Bind(wx.EVT_BUTTON, handler)
+            buttons.Add(button, 0, wx.ALL, 4)
+            if handler == self.OnProfile:
+                self.profile_button = button
+        box.Add(buttons, 0, wx.CENTER)
+
+        self.use_disk_cache = wx.CheckBox(self, label="Keep decompressed records on "
+                                          "local disk (files opened from now on)")
+        self.use_disk_cache.SetValue(toolbar.disk_cache is not None)
+        self.use_disk_cache.Bind(wx.EVT_CHECKBOX, self.OnDiskCache)
+        box.Add(self.use_disk_cache, 0, wx.ALL, 4)
+
+        self.SetSizer(box)
+        self.refresh()
+        self.Show()
+
+    def refresh(self):
+        self.events.DeleteAllItems()
+        for row, record in enumerate(reversed(PROFILER.recent(200))):
+            values = [record['name'], record['thread'], "%.1f" % (1e3 * record['total'])]
+            values += ["%.1f" % (1e3 * record['phases'][p]) if p in record['phases'] else ""
+                       for p in PHASES]
+            self.events.InsertItem(row, values[0])
+            for col, value in enumerate(values[1:], 1):
+                self.events.SetItem(row, col, value)
+
+        lines = []
+        for entry in PROFILER.summary():
+            phases = "  ".join("%s %.1f" % (p, 1e3 * entry['phases'][p])
+                               for p in PHASES if p in entry['phases'])
+            lines.append("%-16s n=%-4d mean %8.1f ms  max %8.1f ms   %s"
+                         % (entry['name'], entry['count'], 1e3 * entry['mean'],
+                            1e3 * entry['max'], phases))
+        stats = self.toolbar.cache.stats()
+        lines.append("")
+        lines.append("slice cache: %(entries)d slices, %(nbytes)d bytes, "
+                     "%(hits)d hits / %(misses)d misses" % stats)
+        if self.toolbar.disk_cache is not None:
+            lines.append("disk cache: %(directory)s, %(nbytes)d of %(max_bytes)d bytes, "
+                         "%(hits)d hits / %(misses)d misses" % self.toolbar.disk_cache.stats())
+        if self.toolbar.grid_cache is not None:
+            lines.append("grid cache: %(directory)s, %(grids)d grids, %(nbytes)d of "
+                         "%(max_bytes)d bytes, %(hits)d hits / %(misses)d misses"
+                         % self.toolbar.grid_cache.stats())
+        self.summary.SetValue("\n".join(lines))
+
+    def OnDiskCache(self, evt):
+        if self.use_disk_cache.GetValue():
+            self.toolbar.disk_cache = DiskCache()
+        else:
+            self.toolbar.disk_cache = None
+        self.refresh()
+
+    def OnClearGridCache(self, evt):
+        """Drops the cached products of every grid: they are rebuilt when needed"""
+        if self.toolbar.grid_cache is not None:
+            self.toolbar.grid_cache.invalidate()
+        self.refresh()
+
+    def OnRefresh(self, evt):
+        self.refresh()
+
+    def OnClear(self, evt):
+        PROFILER.clear()
+        self.refresh()
+
+    def OnSaveTrace(self, evt):
+        dlg = wx.FileDialog(self, "Save JSON trace", os.getcwd(), "pyromsgui_trace.json",
+                            "JSON files (*.json)|*.json", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            PROFILER.dump_json(dlg.GetPath())
+
+    def OnProfile(self, evt):
+        if PROFILER.cprofile is None:
+            PROFILER.start_cprofile()
+            self.profile_button.SetLabel("Stop cProfile")
+            return
+        dlg = wx.FileDialog(self, "Save cProfile stats", os.getcwd(), "pyromsgui.prof",
+                            "pstats files (*.prof)|*.prof", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        filename = dlg.GetPath() if dlg.ShowModal() == wx.ID_OK else os.devnull
+        PROFILER.stop_cprofile(filename)
+        self.profile_button.SetLabel("Start cProfile")
+
+
+class TimeSeriesDialog(wx.Dialog):
+    """Time series or Hovmoller diagram in its own window"""
+    def __init__(self, parent, title, *args, **kwargs):
+        wx.Dialog.__init__(self, parent, -1, title, size=(1000,500),
+                           style=wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        mplpanel = wx.Panel(self, wx.ID_ANY, style=wx.SUNKEN_BORDER)
+        mplpanel.SetBackgroundColour("WHITE")
+        box = wx.BoxSizer(wx.VERTICAL)
+        box.Add(mplpanel, 1, wx.EXPAND)
+        self.mplpanel = SimpleMPLCanvas(mplpanel)
+        box2 = wx.BoxSizer(wx.VERTICAL)
+        box2.Add(self.mplpanel.canvas, 1, flag=wx.EXPAND)
+        mplpanel.SetSizer(box2)
+        self.SetSizer(box)
+        self.mplpanel.ax.set_title(title)
+        self.Show()
+
+    def plot_series(self, dates, values, ylabel):
+        ax = self.mplpanel.ax
+        ax.plot(dates, values, 'k')
+        ax.set_ylabel(ylabel)
+        ax.grid(True)
+        self.mplpanel.fig.autofmt_xdate()
+        self.mplpanel.canvas.draw()
+
+    def plot_hovmoller(self, dates, coord, values, label, along_x=False):
+        """values (ntimes, n) against dates and coord, (n,) or (ntimes, n)"""
+        ax = self.mplpanel.ax
+        tt = mdates.date2num(dates)
+        if along_x: # time upwards, transect coordinate along x
+            pl = ax.pcolormesh(coord, tt, values, cmap=plt.cm.jet)
+            ax.yaxis_date()
+            ax.set_xlabel(label)
+        else: # time along x, e.g. depth of the water column upwards
+            tt = tt[:,None].repeat(values.shape[1], axis=1)
+            pl = ax.pcolormesh(tt, coord, values, cmap=plt.cm.jet)
+            ax.xaxis_date()
+            ax.set_ylabel(label)
+            self.mplpanel.fig.autofmt_xdate()
+        self.mplpanel.fig.colorbar(pl, ax=ax)
+        self.mplpanel.canvas.draw()
+
+
 class VsliceDialog(wx.Dialog):
     def __init__(self, parent, xs, ys, zsec, vsec, *args, **kwargs):
         wx.Dialog.__init__(self, parent, -1, "VARIABLE Vertical Slice, TIMERECORD", pos=(0,0), 
@@ -437,8 +1290,8 @@ class VsliceDialog(wx.Dialog):
 
         minmax = wx.StaticText(panel1, label="Range")
         box2.Add(minmax, proportion=0, flag=wx.CENTER)
-        self.max = wx.TextCtrl(panel1, value=str(vsec.max()))
-        self.min = wx.TextCtrl(panel1, value=str(vsec.min()))
+        self.max = wx.TextCtrl(panel1, value=str(np.nanmax(vsec)))
+        self.min = wx.TextCtrl(panel1, value=str(np.nanmin(vsec)))
         box2.Add(self.max, proportion=0, flag=wx.CENTER)
         box2.Add(self.min, proportion=0, flag=wx.CENTER)
 
@@ -473,6 +1326,13 @@ class VsliceDialog(wx.Dialog):
         self.Show()
 
 
+    def set_section(self, xs, ys, zsec, vsec):
+        self.xs, self.ys, self.zsec, self.vsec = xs, ys, zsec, vsec
+        self.max.SetValue(str(np.nanmax(vsec)))
+        self.min.SetValue(str(np.nanmin(vsec)))
+        self.OnUpdatePlot(None)
+
+
     def OnUpdatePlot(self, evt):
         xs, ys, zsec, vsec = self.xs, self.ys, self.zsec, self.vsec 
         ax, ax2 = self.mplpanel.ax, self.mplpanel.ax2
@@ -511,74 +1371,18 @@ class VsliceDialog(wx.Dialog):
 
 
 def taste_ncfile(ncfile):
-    try:
-        if "history" in ncfile.type:
-            filetype = 'his'
-        elif 'restart' in ncfile.type:
-            filetype = 'rst'
-    except AttributeError: 
-        print "Not a standard ROMS file !"
-        filetype = 'clim' # old wrapper
-
-
-    varlist  = ROMSVARS[filetype]['variables']
-    axeslist = ROMSVARS[filetype]['axes']
-
-    for axes in axeslist:
-        if 'time' in axes:
-            try:
-                time = ncfile.variables[axes]
-            except KeyError:
-                time = ncfile.variables['time'] # for non-default axes name
-        else:
-            pass
-
-    return varlist, axeslist, time
-
-
-def romsTime2string(nctime):
     """
-    nctime  :  netCDF4 variable
+    Fields that can be shown as maps and the time variable of a ROMS
+    file of any type (history, averages, diagnostics...), from its
+    scanned metadata
     """
-    timeunits = nctime.units
-    units = timeunits.split(' ')[0]
-    tstart = dt.datetime.strptime(timeunits.split(' ')[-2], "%Y-%m-%d")
-    timelist = []
-    for t in nctime[:]:
-        if units == 'seconds':
-            current = tstart + dt.timedelta(seconds=t)
-        if units == 'days':
-            current = tstart + dt.timedelta(seconds=t*86400)
-
-        timelist.append(current.strftime("%Y-%m-%d  %H h"))
-
-    return timelist 
-
-
-def string2romsTime(timelist, ncfile):
-    if not isinstance(timelist, list):
-        timelist = [timelist]
-
-    varlist, axeslist, time = taste_ncfile(ncfile)
-    timeunits = time.units
-    units = timeunits.split(' ')[0]
-    tstart = dt.datetime.strptime(timeunits.split(' ')[-2], "%Y-%m-%d")
-
-    romstime = []
-    for timestr in timelist:
-        dttime = dt.datetime.strptime(timestr, "%Y-%m-%d  %H h")    
-        delta = dttime - tstart
-        if units == 'seconds':
-            current = delta.seconds
-        if units == 'days':
-            current = delta.days
-
-        romstime.append(current)
-
-    if len(romstime) == 1:
-        return romstime[0]
-    else:
-        return romstime
+    meta = ncfile.metadata
+    if meta.time_name is None:
+        raise ValueError("No time variable in %s" % ncfile.filename)
+    varlist = meta.fields()
+    if not varlist:
+        raise ValueError("No fields on rho, u or v points in %s" % ncfile.filename)
+    return varlist, ncfile.variables[meta.time_name]
 
 
 def load_bitmap(filename, direc=None):
@@ -0,0 +1,397 @@
+######################################################
+## Matplotlib rendering helpers for big ROMS grids
+######################################################
+import warnings
+
+import numpy as np
+
+
+class FieldPyramid(object):
+    """
+    Multi-resolution (level of detail) versions of a field on a
+    curvilinear grid. Level k is the field block-averaged over
+    2**k x 2**k cells, with its lon/lat block-averaged the same way;
+    blocks that are mostly land (NaN/masked) stay masked.
+    The coordinate levels only depend on the grid, so a new field on the
+    same grid is swapped in with set_field, and they can be given as
+    coords (see pyramid_coords), e.g. from a GridCache.
+    Usage: pyr = FieldPyramid(lon, lat, field)
+           level, (jslice, islice) = pyr.select(xlim, ylim, (width, height))
+           lon, lat, field = pyr.levels[level]
+    """
+    def __init__(self, lon, lat, field=None, min_size=64, coords=None):
+        if coords is None:
+            coords = pyramid_coords(lon, lat, min_size)
+        self.coords = [(coords[k], coords[k + 1]) for k in range(0, len(coords), 2)]
+        self.fields = []
+        if field is not None:
+            self.set_field(field)
+
+    def set_field(self, field):
+        if np.ma.isMaskedArray(field):
+            field = field.astype(np.float32).filled(np.nan)
+        field = np.asarray(field, dtype=np.float32)
+        self.fields = [field]
+        for level in range(1, len(self.coords)):
+            field = block_average(field, 2, min_valid=2)
+            self.fields.append(field)
+
+    @property
+    def levels(self):
+        return [coords + (field,) for coords, field in zip(self.coords, self.fields)]
+
+    def factor(self, level):
+        return 2 ** level
+
+    def visible_window(self, xlim, ylim):
+        """
+        Index bounds (j0, j1, i0, i1) of the full resolution grid that
+        cover the xlim/ylim extent, estimated on the coarsest level
+        """
+        level = len(self.coords) - 1
+        lon, lat = self.coords[level]
+        inside = ( (lon >= min(xlim)) & (lon <= max(xlim)) &
+                   (lat >= min(ylim)) & (lat <= max(ylim)) )
+        M, L = self.coords[0][0].shape
+        if not inside.any():
+            return 0, M, 0, L
+        rows = np.where(inside.any(axis=1))[0]
+        cols = np.where(inside.any(axis=0))[0]
+        # one coarse block of margin on each side
+        f = self.factor(level)
+        return ( max((rows[0] - 1) * f, 0), min((rows[-1] + 2) * f, M),
+                 max((cols[0] - 1) * f, 0), min((cols[-1] + 2) * f, L) )
+
+    def select(self, xlim, ylim, pixels, oversample=1.):
+        """
+        Chooses the coarsest level that still has about one grid cell per
+        screen pixel over the visible window, given the axes size in
+        pixels (width, height). Returns level, (jslice, islice) of that
+        level covering the window.
+        """
+        j0, j1, i0, i1 = self.visible_window(xlim, ylim)
+        width, height = max(pixels[0], 1), max(pixels[1], 1)
+        cells_per_pixel = max((i1 - i0) / float(width),
+                              (j1 - j0) / float(height)) / oversample
+        level = 0
+        while (level + 1 < len(self.coords) and
+               cells_per_pixel > self.factor(level)):
+            level += 1
+        f = self.factor(level)
+        return level, (slice(j0 // f, -(-j1 // f)), slice(i0 // f, -(-i1 // f)))
+
+
+class LodMesh(object):
+    """
+    pcolormesh of a big curvilinear field that only draws the pyramid
+    level matching the current zoom, and only its visible window.
+    It follows pan/zoom through the axes xlim/ylim callbacks.
+    A new field on the same grid (another time record or variable) only
+    replaces the data and colour limits of the existing QuadMesh, the
+    mesh geometry is rebuilt only when the level or window changes.
+    Usage: mesh = LodMesh(ax, cmap=plt.cm.jet)
+           mesh.set_grid(lon, lat)
+           mesh.set_data(field)
+    """
+    def __init__(self, ax, **kwargs):
+        self.ax = ax
+        self.kwargs = kwargs
+        self.pyramid = None
+        self.artist = None
+        self.view = None
+        self.cids = []
+
+    def set_grid(self, lon, lat, coords=None):
+        self.remove()
+        self.pyramid = FieldPyramid(lon, lat, coords=coords)
+        self.view = None
+
+    def set_field(self, lon, lat, field):
+        self.set_grid(lon, lat)
+        self.set_data(field)
+
+    def set_data(self, field, **kwargs):
+        """
+        Shows a new field of the same grid. Returns True if the mesh
+        geometry had to be rebuilt (a full canvas redraw is needed),
+        False if only the data of the existing artist changed.
+        """
+        self.kwargs.update(kwargs)
+        self.pyramid.set_field(field)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # all-NaN fields
+            self.clim = ( self.kwargs.get('vmin', np.nanmin(self.pyramid.fields[0])),
+                          self.kwargs.get('vmax', np.nanmax(self.pyramid.fields[0])) )
+        if not self.cids:
+            self.connect()
+        if self.artist is None or not self.covers(self.current_view()):
+            return self.update()
+
+        level, window = self.view
+        data = self.pyramid.fields[level][window]
+        self.artist.set_array(data.ravel()) # NaN takes the 'bad' colour
+        self.artist.set_clim(*self.clim)
+        if 'cmap' in kwargs:
+            self.artist.set_cmap(kwargs['cmap'])
+        return False
+
+    def set_visible(self, visible):
+        if self.artist is not None:
+            self.artist.set_visible(visible)
+        if visible:
+            self.connect()
+        else:
+            self.disconnect()
+
+    def connect(self):
+        self.disconnect()
+        self.cids = [self.ax.callbacks.connect(event, self.OnLimitsChanged)
+                     for event in ('xlim_changed', 'ylim_changed')]
+
+    def disconnect(self):
+        for cid in self.cids:
+            self.ax.callbacks.disconnect(cid)
+        self.cids = []
+
+    def remove(self):
+        self.disconnect()
+        if self.artist is not None:
+            try:
+                self.artist.remove()
+            except ValueError: # axes were already cleared
+                pass
+        self.artist = None
+
+    def OnLimitsChanged(self, ax):
+        if self.update():
+            ax.figure.canvas.draw_idle()
+
+    def current_view(self):
+        bbox = self.ax.get_window_extent()
+        return self.pyramid.select(self.ax.get_xlim(), self.ax.get_ylim(),
+                                   (bbox.width, bbox.height))
+
+    def covers(self, view):
+        """True when the drawn window already covers view at the same level"""
+        if self.view is None or self.view[0] != view[0]:
+            return False
+        (js, is_), (cjs, cis) = view[1], self.view[1]
+        return ( cjs.start <= js.start and js.stop <= cjs.stop and
+                 cis.start <= is_.start and is_.stop <= cis.stop )
+
+    def update(self):
+        """Rebuilds the mesh if the view needs another level/window"""
+        if self.pyramid is None or not self.pyramid.fields:
+            return False
+        view = self.current_view()
+        if self.covers(view):
+            return False
+
+        level, (jslice, islice) = view
+        # draw a window a bit larger than the view so small pans reuse it
+        nj, ni = jslice.stop - jslice.start, islice.stop - islice.start
+        M, L = self.pyramid.coords[level][0].shape
+        jslice = slice(max(jslice.start - nj // 4, 0), min(jslice.stop + nj // 4, M))
+        islice = slice(max(islice.start - ni // 4, 0), min(islice.stop + ni // 4, L))
+
+        lon, lat, field = self.pyramid.levels[level]
+        window = (jslice, islice)
+        visible = True
+        if self.artist is not None:
+            visible = self.artist.get_visible()
+            self.artist.remove()
+        kwargs = dict(self.kwargs)
+        kwargs['vmin'], kwargs['vmax'] = self.clim
+        # keep the limits: pcolormesh would autoscale to the window
+        xlim, ylim = self.ax.get_xlim(), self.ax.get_ylim()
+        self.artist = self.ax.pcolormesh(lon[window], lat[window], field[window],
+                                         **kwargs)
+        self.artist.set_visible(visible)
+        self.ax.set_xlim(xlim, emit=False)
+        self.ax.set_ylim(ylim, emit=False)
+        self.view = (level, window)
+        return True
+
+
+class QuiverLayer(object):
+    """
+    Vector arrows of a field on a curvilinear grid, thinned to about one
+    arrow every spacing pixels over the visible window, and rebuilt on
+    pan/zoom when the window or the thinning changes. A new field of the
+    same grid only replaces the arrow components. The arrow scale is
+    set per field, the 95th percentile of the speed spanning spacing
+    pixels, so arrows keep their length as the thinning changes.
+    Usage: layer = QuiverLayer(ax, color='k')
+           layer.set_grid(grid.lonr, grid.latr)
+           layer.set_data(*rho_vectors(u, v, grid.rotation()))
+    """
+    def __init__(self, ax, spacing=25, **kwargs):
+        self.ax = ax
+        self.spacing = spacing
+        self.kwargs = kwargs
+        self.pyramid = None
+        self.u = self.v = None
+        self.scale = 1.
+        self.artist = None
+        self.view = None
+        self.cids = []
+
+    def set_grid(self, lon, lat, coords=None):
+        self.remove()
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.pyramid = FieldPyramid(self.lon, self.lat, coords=coords)
+        self.view = None
+
+    def set_data(self, u, v):
+        """
+        Shows a new field of the same grid. Returns True if the arrows
+        had to be rebuilt (a full canvas redraw is needed), False if only
+        their components changed.
+        """
+        self.u, self.v = u, v
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # all-NaN fields
+            speed = np.nanpercentile(np.hypot(u[::4, ::4], v[::4, ::4]), 95)
+        self.scale = speed / float(self.spacing) if speed > 0 else 1.
+        if not self.cids:
+            self.connect()
+        if self.artist is None or self.view != self.current_view():
+            return self.update()
+        window = self.view
+        self.artist.scale = self.scale
+        self.artist.set_UVC(u[window], v[window])
+        return False
+
+    def current_view(self):
+        """(jslice, islice) with the stride of about spacing pixels per arrow"""
+        j0, j1, i0, i1 = self.pyramid.visible_window(self.ax.get_xlim(), self.ax.get_ylim())
+        bbox = self.ax.get_window_extent()
+        narrows = max(bbox.width / self.spacing, 1), max(bbox.height / self.spacing, 1)
+        stride = int(max(np.ceil((i1 - i0) / narrows[0]), np.ceil((j1 - j0) / narrows[1]), 1))
+        # aligned to the stride, so the arrows stay put while panning
+        return (slice(int(j0 // stride * stride), int(j1), stride),
+                slice(int(i0 // stride * stride), int(i1), stride))
+
+    def update(self):
+        """Rebuilds the arrows if the view needs another window/thinning"""
+        if self.pyramid is None or self.u is None:
+            return False
+        view = self.current_view()
+        if self.artist is not None and view == self.view:
+            return False
+        visible = True
+        if self.artist is not None:
+            visible = self.artist.get_visible()
+            self.artist.remove()
+        xlim, ylim = self.ax.get_xlim(), self.ax.get_ylim()
+        self.artist = self.ax.quiver(self.lon[view], self.lat[view], self.u[view],
+                                     self.v[view], scale=self.scale,
+                                     scale_units='dots', **self.kwargs)
+        self.artist.set_visible(visible)
+        self.ax.set_xlim(xlim, emit=False)
+        self.ax.set_ylim(ylim, emit=False)
+        self.view = view
+        return True
+
+    def OnLimitsChanged(self, ax):
+        if self.update():
+            ax.figure.canvas.draw_idle()
+
+    def connect(self):
+        self.disconnect()
+        self.cids = [self.ax.callbacks.connect(event, self.OnLimitsChanged)
+                     for event in ('xlim_changed', 'ylim_changed')]
+
+    def disconnect(self):
+        for cid in self.cids:
+            self.ax.callbacks.disconnect(cid)
+        self.cids = []
+
+    def remove(self):
+        self.disconnect()
+        if self.artist is not None:
+            try:
+                self.artist.remove()
+            except ValueError: # axes were already cleared
+                pass
+        self.artist = None
+
+
+class BlitManager(object):
+    """
+    Redraws only the artists that change between time records (the
+    field mesh, the title and whatever is drawn above the mesh) on top
+    of a saved copy of the static background (axes, ticks, labels).
+    The background is captured on the first update after any full draw,
+    and invalidated by every full draw (zoom, resize, ...).
+    dynamic() must return the changing artists in drawing order.
+    Usage: blit = BlitManager(canvas, dynamic)
+           mesh.set_data(field); blit.update()
+    """
+    def __init__(self, canvas, dynamic):
+        self.canvas = canvas
+        self.dynamic = dynamic
+        self.background = None
+        self.capturing = False
+        self.cid = canvas.mpl_connect('draw_event', self.OnDraw)
+
+    def OnDraw(self, evt):
+        if not self.capturing:
+            self.background = None
+
+    def capture(self, artists):
+        """Full draw without the dynamic artists, saved as background"""
+        self.capturing = True
+        try:
+            for artist in artists:
+                artist.set_animated(True)
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        finally:
+            for artist in artists:
+                artist.set_animated(False)
+            self.capturing = False
+
+    def update(self):
+        artists = [artist for artist in self.dynamic() if artist is not None]
+        if self.background is None:
+            self.capture(artists)
+        else:
+            self.canvas.restore_region(self.background)
+        figure = self.canvas.figure
+        for artist in artists:
+            if artist.get_visible():
+                figure.draw_artist(artist)
+        self.canvas.blit(figure.bbox)
+
+
+def pyramid_coords(lon, lat, min_size=64):
+    """
+    lon, lat of every level of a FieldPyramid, as a flat list
+    [lon0, lat0, lon1, lat1, ...]
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    coords = [lon, lat]
+    while min(lon.shape) // 2 >= min_size:
+        lon, lat = block_average(lon, 2), block_average(lat, 2)
+        coords += [lon, lat]
+    return coords
+
+
+def block_average(arr, factor, min_valid=1):
+    """
+    Averages arr over factor x factor blocks, ignoring NaNs. Blocks with
+    less than min_valid finite values are NaN. Trailing rows/columns that
+    do not fill a whole block are dropped.
+    """
+    M, L = arr.shape[0] // factor, arr.shape[1] // factor
+    blocks = arr[:M * factor, :L * factor].reshape(M, factor, L, factor)
+    valid = np.isfinite(blocks)
+    count = valid.sum(axis=3).sum(axis=1)
+    total = np.where(valid, blocks, 0).sum(axis=3).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = total / count
+    out[count < min_valid] = np.nan
+    return out.astype(arr.dtype)
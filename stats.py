@@ -0,0 +1,298 @@
+######################################################
+## Streaming statistics of ROMS fields over time
+## records: means, std, extremes and percentiles
+######################################################
+import time
+import multiprocessing
+
+import numpy as np
+
+from lib import RomsGrid, hslice, mask_land
+from ncio import RomsDataset, open_dataset, DEFAULT_READ_BYTES
+import derived
+from derived import add_derived
+
+
+STATS = ['mean', 'std', 'var', 'min', 'max', 'count']
+
+
+class RunningStats(object):
+    """
+    Single pass (Welford/Chan) accumulator of per-point count, mean,
+    sum of squared deviations, min and max over records. Blocks of
+    records are folded in with update(), and partial results of other
+    processes combined with merge(), both numerically stable. NaNs (land,
+    fill values) are skipped.
+    Usage: acc = RunningStats((M, L))
+           acc.update(block)        # block shape (nrec, M, L)
+           acc.merge(other); acc.result('std')
+    """
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf, dtype=np.float64)
+        self.max = np.full(shape, -np.inf, dtype=np.float64)
+        self.records = 0
+
+    def update(self, block):
+        """Folds a (nrec, ...) block of records in"""
+        block = np.asarray(block, dtype=np.float64)
+        valid = ~np.isnan(block)
+        count = valid.sum(axis=0)
+        total = np.where(valid, block, 0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, 0)
+        m2 = np.where(valid, (block - mean) ** 2, 0).sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            self.min = np.fmin(self.min, np.nanmin(np.where(valid, block, np.inf), axis=0))
+            self.max = np.fmax(self.max, np.nanmax(np.where(valid, block, -np.inf), axis=0))
+        self.combine(count, mean, m2)
+        self.records += block.shape[0]
+
+    def merge(self, other):
+        """Combines the partial result of another accumulator"""
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self.combine(other.count, other.mean, other.m2)
+        self.records += other.records
+
+    def combine(self, count, mean, m2):
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            frac = np.where(total > 0, count / np.maximum(total, 1).astype(np.float64), 0)
+            self.mean = self.mean + delta * frac
+            self.m2 = self.m2 + m2 + delta ** 2 * self.count * frac
+        self.count = total
+
+    def result(self, name):
+        """float32 field of a statistic (see STATS), NaN where there is no data"""
+        empty = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if name == 'mean':
+                out = self.mean
+            elif name == 'var':
+                out = self.m2 / np.maximum(self.count - 1, 1)
+            elif name == 'std':
+                out = np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+            elif name in ('min', 'max'):
+                out = getattr(self, name)
+            elif name == 'count':
+                return self.count.astype(np.float32)
+            else:
+                raise ValueError("Unknown statistic %r" % name)
+        out = out.astype(np.float32)
+        out[empty] = np.nan
+        return out
+
+
+class RunningHistogram(object):
+    """
+    Per-point histogram of records between known bounds (lo, hi), for
+    approximate percentiles of datasets that do not fit in memory.
+    Percentiles interpolate linearly between order statistics, like
+    np.nanpercentile, each order statistic being placed within its bin:
+    the error is less than one bin, (hi - lo) / nbins, at every point.
+    Counts are uint16 when there are fewer than 65535 records in all
+    (records), int32 otherwise.
+    Usage: hist = RunningHistogram(stats.min, stats.max, nbins=64, records=nrec)
+           hist.update(block); hist.percentile(90)
+    """
+    def __init__(self, lo, hi, nbins=64, records=None):
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.width = np.maximum(np.asarray(hi, dtype=np.float64) - self.lo, 1e-12) / nbins
+        self.width[~np.isfinite(self.width)] = 1.
+        self.nbins = nbins
+        small = records is not None and records < np.iinfo(np.uint16).max
+        self.counts = np.zeros(self.lo.shape + (nbins,),
+                               dtype=np.uint16 if small else np.int32)
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64).reshape((-1,) + self.lo.shape)
+        flat = self.counts.reshape(-1)
+        points = np.arange(self.lo.size).reshape(self.lo.shape) * self.nbins
+        for record in block:
+            valid = ~np.isnan(record)
+            bins = np.clip(((record[valid] - self.lo[valid]) / self.width[valid]).astype(np.int64),
+                           0, self.nbins - 1)
+            # every point appears once per record: no repeated indexes
+            flat[points[valid] + bins] += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def percentile(self, q):
+        """
+        float32 field of the q-th percentile (0-100): at rank
+        q / 100 * (count - 1), between the order statistics around it
+        """
+        cum = np.cumsum(self.counts, axis=-1, dtype=self.counts.dtype)
+        total = cum[..., -1].astype(np.int64)
+        last = np.maximum(total - 1, 0)
+        rank = q / 100. * last
+        lower = np.floor(rank)
+        low = self.order_statistic(cum, lower)
+        high = self.order_statistic(cum, np.minimum(lower + 1, last))
+        with np.errstate(invalid='ignore'): # NaN on land
+            out = (low + (rank - lower) * (high - low)).astype(np.float32)
+        out[total == 0] = np.nan
+        return out
+
+    def order_statistic(self, cum, rank):
+        """
+        Value of the record of a given rank (0 for the smallest) at every
+        point, the records of a bin being spread evenly across it
+        """
+        ibin = np.minimum((cum <= rank[..., None]).sum(axis=-1), self.nbins - 1)
+        below = np.where(ibin > 0, np.take_along_axis(cum, np.maximum(ibin - 1, 0)[..., None],
+                                                      -1)[..., 0], 0)
+        inbin = np.take_along_axis(self.counts, ibin[..., None], -1)[..., 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(inbin > 0, (rank - below + 0.5) / inbin, 0.5)
+        return self.lo + (ibin + frac) * self.width
+
+
+def read_records(var, grid, t0, t1, level='surface', max_bytes=DEFAULT_READ_BYTES):
+    """
+    Yields float32 blocks (nrec, M, L) of the horizontal slices of var
+    for records t0 to t1, at most max_bytes each, NaN on land and fill
+    values. Depth levels are interpolated one record at a time.
+    """
+    plane = int(np.prod(var.shape[-2:])) * 4
+    step = max(1, max_bytes // plane)
+    if len(var.dimensions) == 4 and level not in ('surface', 'bottom'):
+        step = 1
+    gridtype = var.dimensions[-1].split('_')[-1]
+    for start in range(t0, t1, step):
+        stop = min(start + step, t1)
+        if step == 1:
+            yield hslice(var, grid, start, level)[None]
+            continue
+        if len(var.dimensions) != 4:
+            block = var[start:stop, ...]
+        else:
+            block = var[start:stop, -1 if level == 'surface' else 0, ...]
+        yield mask_land(np.asarray(block, dtype=np.float32), grid, gridtype)
+
+
+def _open(files, grdname, registry=None):
+    if registry: # user registered derived variables, for worker processes
+        derived.REGISTRY.update(registry)
+    ncfile = open_dataset(files)
+    grd = RomsDataset(grdname) if grdname else None
+    grid = RomsGrid(grd, ncfile) if grd is not None else None
+    add_derived(ncfile, grid)
+    return ncfile, grd, grid
+
+
+def _accumulate(task):
+    """Worker: statistics (or histograms) of one run of records"""
+    files, grdname, varname, t0, t1, level, max_bytes, bounds, registry = task
+    ncfile, grd, grid = _open(files, grdname, registry)
+    try:
+        var = ncfile.variables[varname]
+        shape = var.shape[-2:]
+        if bounds is None:
+            acc = RunningStats(shape)
+        else:
+            acc = RunningHistogram(*bounds)
+        for block in read_records(var, grid, t0, t1, level, max_bytes):
+            acc.update(block)
+        return acc
+    finally:
+        ncfile.close()
+        if grd is not None:
+            grd.close()
+
+
+def _pool(processes):
+    """
+    A process pool started with forkserver (or spawn): forking the GUI
+    while one of its threads holds NC_LOCK or HDF5 state would deadlock
+    the children
+    """
+    try:
+        methods = multiprocessing.get_all_start_methods()
+    except AttributeError: # python 2 only forks
+        return multiprocessing.Pool(processes)
+    method = 'forkserver' if 'forkserver' in methods else 'spawn'
+    return multiprocessing.get_context(method).Pool(processes)
+
+
+def field_stats(files, varname, records=None, level='surface', grdname=None,
+                stats=('mean', 'std', 'min', 'max'), percentiles=(), nbins=64,
+                workers=None, max_bytes=DEFAULT_READ_BYTES, report=None):
+    """
+    Statistics over time records of the horizontal slices of varname,
+    computed in a single streamed pass: every process of a pool folds
+    a contiguous run of records into a RunningStats, read in blocks of
+    at most max_bytes, and the partial results are merged as they
+    arrive. Memory does not depend on the number of records. Percentiles
+    (e.g. (10, 90)) take a second pass through per-point histograms
+    bounded by the min/max of the first one.
+    records is a (start, stop) pair of record indexes, all by default.
+    grdname (the grid file) is needed for levels given as a depth.
+    Returns a dict of float32 2D fields ('mean', 'p90', ...). If a dict
+    is given as report, it gets the records, seconds and records/s.
+    Usage: out = field_stats('ocean_his_*.nc', 'temp', level='surface')
+           sst_mean = out['mean']
+    """
+    start = time.time()
+    workers = workers or multiprocessing.cpu_count()
+    ncfile, grd, grid = _open(files, grdname)
+    try:
+        ntimes = ncfile.variables[varname].shape[0]
+    finally:
+        ncfile.close()
+        if grd is not None:
+            grd.close()
+    t0, t1 = records if records is not None else (0, ntimes)
+    t1 = min(t1, ntimes)
+    nrec = t1 - t0
+    if nrec <= 0:
+        raise ValueError("No records between %d and %d" % (t0, t1))
+
+    # one run per worker: every partial result is a full field (a
+    # histogram is nbins of them), and contiguous records keep the
+    # reads sequential
+    nruns = min(nrec, workers)
+    edges = np.linspace(t0, t1, nruns + 1).astype(int)
+    runs = [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+    # derived variables registered in this session, unknown to new processes
+    registry = dict(derived.REGISTRY)
+
+    def run_pass(bounds):
+        tasks = [(files, grdname, varname, a, b, level, max_bytes, bounds, registry)
+                 for a, b in runs]
+        if workers == 1:
+            partials, pool = (_accumulate(task) for task in tasks), None
+        else:
+            pool = _pool(len(tasks))
+            partials = pool.imap_unordered(_accumulate, tasks)
+        try:
+            total = None
+            for partial in partials:
+                if total is None:
+                    total = partial
+                else:
+                    total.merge(partial)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return total
+
+    acc = run_pass(None)
+    out = dict( (name, acc.result(name)) for name in stats )
+    if percentiles:
+        hist = run_pass( (acc.min, acc.max, nbins, nrec) )
+        for q in percentiles:
+            out['p%g' % q] = hist.percentile(q)
+
+    if report is not None:
+        elapsed = time.time() - start
+        passes = 2 if percentiles else 1
+        report.update(records=nrec, seconds=elapsed, workers=workers,
+                      records_per_second=passes * nrec / max(elapsed, 1e-9))
+    return out